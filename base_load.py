@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import random
 import time
@@ -6,9 +7,10 @@ import argparse
 from aiohttp import web
 
 from env_default import EnvDefault
+from latency_histogram import LatencyHistogram
 
-import batch_rpc_provider
-from batch_rpc_provider import BatchRpcProvider, BatchRpcException
+from rpc_client import RpcClient
+from workload import Workload
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -22,13 +24,10 @@ async def hello(request):
     return web.Response(text="Hello, world")
 
 
-async def burst_call(context, target_url, token_holder, token_address, number_calls):
-    number_of_success_req = 0
-    number_of_failed_req = 0
-    p = BatchRpcProvider(target_url, 20)
-
+async def get_checked_block(context, p, request_timeout):
+    """Checks age of the latest block, returns number of the block that should be queried"""
     try:
-        latest_block = await p.get_block_by_number("latest", False)
+        latest_block = await asyncio.wait_for(p.get_block_by_number("latest", False), request_timeout)
         block_number = int(latest_block["number"], 0)
         block_checked = block_number - 10
         block_ts = int(latest_block["timestamp"], 0)
@@ -44,53 +43,279 @@ async def burst_call(context, target_url, token_holder, token_address, number_ca
     except Exception as ex:
         logger.error(f"Other error when getting request: {ex}")
         raise ex
-
-    token_address = token_address
-
-    single_holder_array = [token_holder]
-
-    max_steps = number_calls
-    while max_steps > 0:
-        max_steps -= 1
-        success = False
+    return block_checked
+
+
+def _method_stats(stats, method):
+    method_stats = stats.get(method)
+    if method_stats is None:
+        # latency of failed calls is kept apart, so it does not hide in (or skew) latency of answered ones
+        method_stats = {"succeeded": 0, "failed": 0, "latency": LatencyHistogram(),
+                        "failed_latency": LatencyHistogram()}
+        stats[method] = method_stats
+    return method_stats
+
+
+def add_method_stats(stats, other):
+    """Adds per method results from other to stats"""
+    for method, other_stats in other.items():
+        method_stats = _method_stats(stats, method)
+        method_stats["succeeded"] += other_stats["succeeded"]
+        method_stats["failed"] += other_stats["failed"]
+        method_stats["latency"].merge(other_stats["latency"])
+        method_stats["failed_latency"].merge(other_stats["failed_latency"])
+
+
+async def send_workload_request(p, workload, calls, request_timeout, stats, latency_start):
+    """
+    Sends workload calls (list of workload.next_call() results) in one http request
+    (json-rpc batch if more than one), records per method results in stats, latency of failed and timed out
+    calls goes to "failed_latency". Returns number of succeeded and failed calls
+    """
+    succeeded = 0
+    try:
+        if len(calls) == 1:
+            results = [await asyncio.wait_for(p.call(calls[0][1], calls[0][2]), request_timeout)]
+        else:
+            results = await asyncio.wait_for(p.batch_call([(method, params) for _, method, params in calls]),
+                                             request_timeout)
+    except asyncio.TimeoutError:
+        logger.debug(f"Request timed out after {request_timeout}s")
+        results = None
+    except Exception as ex:
+        logger.debug(f"Error when getting request: {ex}")
+        results = None
+
+    request_latency = time.monotonic() - latency_start
+    for idx, (label, _, _) in enumerate(calls):
+        method_stats = _method_stats(stats, label)
+        if results is None:
+            method_stats["failed"] += 1
+            method_stats["failed_latency"].record(request_latency)
+            continue
         try:
-            resp = await p.get_erc20_balance(single_holder_array[0], token_address, f"0x{block_checked:x}")
-            balance = resp
-            b = int(balance, 16) / 10 ** 18
-            logger.info(f"Block checked: {block_checked} Amount: {b}")
-            success = True
-        except BatchRpcException as ex:
-            logger.error(f"BatchRpcException when getting request: {ex}")
-            raise ex
+            workload.observe(label, results[idx])
         except Exception as ex:
-            logger.error(f"Other error when getting request: {ex}")
-            raise ex
+            logger.debug(f"Wrong result of {label}: {ex}")
+            method_stats["failed"] += 1
+            method_stats["failed_latency"].record(request_latency)
+            continue
+        method_stats["succeeded"] += 1
+        method_stats["latency"].record(request_latency)
+        succeeded += 1
+    return succeeded, len(calls) - succeeded
+
+
+def merge_method_latency(stats, key="latency"):
+    """Latency of all methods together, key "failed_latency" merges latency of failed calls"""
+    latency = LatencyHistogram()
+    for method_stats in stats.values():
+        latency.merge(method_stats[key])
+    return latency
+
+
+async def send_burst(p, workload, number_calls, concurrency, batch_size, request_timeout, stats):
+    """
+    Sends number_calls workload calls with at most concurrency requests in flight,
+    per method results are added to stats while the burst runs. Returns number of succeeded and failed calls
+    """
+    number_of_success_req = 0
+    number_of_failed_req = 0
 
-        if success:
-            number_of_success_req += 1
-        else:
-            number_of_failed_req += 1
+    # every entry is one http request, containing single call or a json-rpc batch of calls
+    request_sizes = [batch_size] * (number_calls // batch_size)
+    if number_calls % batch_size:
+        request_sizes.append(number_calls % batch_size)
+
+    async def worker():
+        nonlocal number_of_success_req, number_of_failed_req
+        while request_sizes:
+            calls = [workload.next_call() for _ in range(request_sizes.pop())]
+            succeeded, failed = await send_workload_request(p, workload, calls, request_timeout, stats,
+                                                            time.monotonic())
+            number_of_success_req += succeeded
+            number_of_failed_req += failed
+
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, len(request_sizes)))])
+    return number_of_success_req, number_of_failed_req
+
+
+def set_burst_results(context, stats, duration, number_of_success_req, number_of_failed_req):
+    latency = merge_method_latency(stats)
+    throughput = number_of_success_req / duration if duration > 0 else 0.0
+    context["burst_duration"] = duration
+    context["burst_throughput"] = throughput
+    context["burst_latency"] = latency
+    context["failed_latency"] = merge_method_latency(stats, "failed_latency")
+    context["methods"] = stats
 
     logger.info(f"Number of success requests: {number_of_success_req}")
     logger.info(f"Number of failed requests: {number_of_failed_req}")
+    if latency.total:
+        logger.info(f"Request latency p50 {latency.percentile(50):.1f}ms, p99 {latency.percentile(99):.1f}ms, "
+                    f"max {latency.max_ms:.1f}ms")
+
+
+async def burst_call(context, client, workload, number_calls,
+                     concurrency=1, batch_size=1, request_timeout=None):
+    """
+    client is RpcClient used for all calls of the burst, reusing it between bursts keeps connections
+    to the target open. Calls are taken from workload, results per method are stored in context["methods"]
+    """
+    p = client
+
+    block_checked = await get_checked_block(context, p, request_timeout)
+    workload.set_latest_block(block_checked + 10)
+
+    stats = {}
+    start = time.monotonic()
+    number_of_success_req, number_of_failed_req = await send_burst(p, workload, number_calls, concurrency,
+                                                                   batch_size, request_timeout, stats)
+    duration = time.monotonic() - start
+
+    set_burst_results(context, stats, duration, number_of_success_req, number_of_failed_req)
+    logger.info(f"Burst took {duration:.3f}s, throughput {context['burst_throughput']:.1f} calls/s "
+                f"(concurrency {concurrency}, batch size {batch_size})")
+
+    return number_of_success_req, number_of_failed_req
+
+
+async def send_open_loop(p, workload, rate, duration, arrival, max_outstanding, request_timeout, stats):
+    """
+    Sends workload calls at given rate for given duration, per method results are added to stats while it runs.
+    Returns numbers of succeeded, failed and not sent requests, number of scheduled requests and achieved rate
+    """
+    number_of_success_req = 0
+    number_of_failed_req = 0
+    number_of_dropped_req = 0
+    first_success_time = None
+    last_success_time = None
+
+    async def send_request(intended_time):
+        nonlocal number_of_success_req, number_of_failed_req, first_success_time, last_success_time
+        succeeded, failed = await send_workload_request(p, workload, [workload.next_call()], request_timeout,
+                                                        stats, intended_time)
+        if succeeded:
+            last_success_time = time.monotonic()
+            if first_success_time is None:
+                first_success_time = last_success_time
+        number_of_success_req += succeeded
+        number_of_failed_req += failed
+
+    in_flight = set()
+    scheduled = 0
+    start = time.monotonic()
+    end = start + duration
+    intended_time = start
+    try:
+        while intended_time < end:
+            delay = intended_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(in_flight) < max_outstanding:
+                task = asyncio.create_task(send_request(intended_time))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            else:
+                number_of_dropped_req += 1
+                # not sent request is failed call of the method it would have called, it waits at least
+                # as long as a request that timed out, so the saturated target is not reported faster
+                label, _, _ = workload.next_call()
+                method_stats = _method_stats(stats, label)
+                method_stats["failed"] += 1
+                method_stats["failed_latency"].record(max(time.monotonic() - intended_time, request_timeout or 0.0))
+            scheduled += 1
+            if arrival == "poisson":
+                intended_time += random.expovariate(rate)
+            else:
+                intended_time += 1.0 / rate
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
+    finally:
+        # requests are not left running when the check is cancelled
+        for task in list(in_flight):
+            task.cancel()
+    elapsed = time.monotonic() - start
+
+    # rate at which responses were coming back, not skewed by latency of the first and the last response
+    if number_of_success_req > 1 and last_success_time > first_success_time:
+        achieved_rate = (number_of_success_req - 1) / (last_success_time - first_success_time)
+    else:
+        achieved_rate = number_of_success_req / elapsed
+    return number_of_success_req, number_of_failed_req, number_of_dropped_req, scheduled, achieved_rate
+
+
+def set_open_loop_results(context, stats, elapsed, offered_rate, achieved_rate,
+                          number_of_success_req, number_of_failed_req, number_of_dropped_req):
+    latency = merge_method_latency(stats)
+    context["offered_rate"] = offered_rate
+    context["achieved_rate"] = achieved_rate
+    context["burst_duration"] = elapsed
+    context["burst_throughput"] = achieved_rate
+    context["burst_latency"] = latency
+    context["failed_latency"] = failed_latency = merge_method_latency(stats, "failed_latency")
+    context["methods"] = stats
+
+    logger.info(f"Open loop: offered {offered_rate:.1f} req/s, achieved {achieved_rate:.1f} req/s, "
+                f"success {number_of_success_req}, failed {number_of_failed_req} "
+                f"(not sent {number_of_dropped_req})")
+    if latency.total:
+        logger.info(f"Latency from intended send time p50 {latency.percentile(50):.1f}ms, "
+                    f"p99 {latency.percentile(99):.1f}ms, max {latency.max_ms:.1f}ms")
+    if failed_latency.total:
+        logger.info(f"Latency of failed and not sent requests from intended send time "
+                    f"p50 {failed_latency.percentile(50):.1f}ms, p99 {failed_latency.percentile(99):.1f}ms, "
+                    f"max {failed_latency.max_ms:.1f}ms")
+
+
+async def open_loop_call(context, client, workload, rate, duration,
+                         arrival="constant", max_outstanding=1000, request_timeout=None):
+    """
+    Sends requests at given rate (per second) for given duration, no matter how fast the target responds.
+    Arrival is "constant" (fixed spacing) or "poisson" (exponential spacing).
+    Latency is measured from the time the request was scheduled to be sent, so when the target
+    (or this monitor) falls behind, the waiting time is counted too (coordinated omission correction).
+    Failed and timed out requests are measured the same way in context["failed_latency"].
+    Requests over max_outstanding in flight are not sent and counted as failed with latency of at least
+    request_timeout
+    """
+    p = client
+
+    block_checked = await get_checked_block(context, p, request_timeout)
+    workload.set_latest_block(block_checked + 10)
+
+    stats = {}
+    start = time.monotonic()
+    (number_of_success_req, number_of_failed_req, number_of_dropped_req,
+     scheduled, achieved_rate) = await send_open_loop(p, workload, rate, duration, arrival, max_outstanding,
+                                                      request_timeout, stats)
+    elapsed = time.monotonic() - start
+
+    number_of_failed_req += number_of_dropped_req
+    set_open_loop_results(context, stats, elapsed, scheduled / duration, achieved_rate,
+                          number_of_success_req, number_of_failed_req, number_of_dropped_req)
 
     return number_of_success_req, number_of_failed_req
 
 
-def baseload_loop(args_sleep_time, target_url, token_holder, token_address, number_calls):
+async def baseload_loop(args_sleep_time, target_url, token_holder, token_address, number_calls,
+                        concurrency, batch_size, request_timeout):
     total_number_of_success_req = 0
     total_number_of_failed_req = 0
+    context = {}
+    client = RpcClient(target_url, concurrency)
+    workload = Workload.single_balance(token_address, token_holder)
     while True:
-
-
-        (number_of_success_req, number_of_failed_req) = burst_call(target_url, token_holder, token_address, number_calls)
+        (number_of_success_req, number_of_failed_req) = await burst_call(context, client, workload, number_calls,
+                                                                         concurrency, batch_size, request_timeout)
         total_number_of_success_req += number_of_success_req
         total_number_of_failed_req += number_of_failed_req
 
         logger.info(f"Total number of success requests: {total_number_of_success_req}")
         logger.info(f"Total number of failed requests: {total_number_of_failed_req}")
 
-        time.sleep(args_sleep_time)
+        await asyncio.sleep(args_sleep_time)
 
 
 if __name__ == "__main__":
@@ -111,9 +336,23 @@ if __name__ == "__main__":
     parser.add_argument('--sleep-time', dest="sleep_time", type=float, help='Number of requests to sent at once',
                         action=EnvDefault, envvar='BASELOAD_SLEEP_TIME',
                         default=5.0)
+    parser.add_argument('--burst-concurrency', dest="burst_concurrency", type=int,
+                        help='Maximum number of requests in flight during burst',
+                        action=EnvDefault, envvar='BASELOAD_BURST_CONCURRENCY',
+                        default=1)
+    parser.add_argument('--batch-size', dest="batch_size", type=int,
+                        help='Number of calls sent in single json-rpc batch request (1 - no batching)',
+                        action=EnvDefault, envvar='BASELOAD_BATCH_SIZE',
+                        default=1)
+    parser.add_argument('--request-timeout', dest="request_timeout", type=float,
+                        help='Timeout of single request (in seconds)',
+                        action=EnvDefault, envvar='BASELOAD_REQUEST_TIMEOUT',
+                        default=10.0)
 
     args = parser.parse_args()
 
-    baseload_loop(args.sleep_time, args.target_url, args.token_holder, args.token_address, args.request_burst)
+    asyncio.run(baseload_loop(args.sleep_time, args.target_url, args.token_holder, args.token_address,
+                              args.request_burst, args.burst_concurrency, args.batch_size,
+                              args.request_timeout))
 
 
@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+import aiohttp_jinja2
+import jinja2
+from aiohttp import web
+
+from base_load import burst_call
+from client_info import ClientCollection, ClientInfo, RequestType, HISTORY_SIZE, RESOLUTIONS
+from env_default import EnvDefault
+from latency_histogram import LatencyHistogram
+from load_workers import LoadWorkerPool
+from monitor import create_metrics, parser as monitor_parser, routes as monitor_routes
+from rpc_client import RpcClient
+from status_snapshot import StatusSnapshot
+from targets import target_from_args
+from workload import Workload, WORKLOAD_METHODS
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# (concurrency, batch size) of measured bursts
+BURST_CONFIGS = [(1, 1), (10, 1), (50, 1), (10, 10)]
+
+
+# Single measured value, higher_is_better decides which direction is a regression
+class BenchResult:
+    def __init__(self, name, value, unit, higher_is_better):
+        self.name = name
+        self.value = value
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+
+    def regression(self, baseline_value, tolerance):
+        if self.higher_is_better:
+            return self.value < baseline_value * (1 - tolerance)
+        return self.value > baseline_value * (1 + tolerance)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _start_mock_node(latency_ms, processes):
+    """Mock node runs in its own process, so its cost is not counted as monitor cost"""
+    port = _free_port()
+    process = await asyncio.create_subprocess_exec(sys.executable, "mock_node.py", "--port", str(port),
+                                                   "--latency-ms", str(latency_ms), "--processes", str(processes))
+    url = f"http://127.0.0.1:{port}/"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.post(url, json={"jsonrpc": "2.0", "method": "eth_blockNumber", "id": 1}):
+                    return process, url
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+    process.kill()
+    raise Exception(f"Mock node did not start on port {port}")
+
+
+async def bench_burst(node_url, request_burst, rounds):
+    results = []
+    workload = Workload.single_balance("0x2036807B0B3aaf5b1858EE822D0e111fDdac7018",
+                                       "0xc596aee002ebe98345ce3f967631aaf79cfbdf41")
+    for concurrency, batch_size in BURST_CONFIGS:
+        client = RpcClient(node_url, max(concurrency, 1))
+        context = {}
+        try:
+            # warm up connections, first burst opens them
+            await burst_call(context, client, workload, request_burst, concurrency, batch_size)
+            throughputs = []
+            for _ in range(rounds):
+                _, failed = await burst_call(context, client, workload, request_burst, concurrency, batch_size)
+                if failed:
+                    raise Exception(f"Burst against mock node failed {failed} calls")
+                throughputs.append(context["burst_throughput"])
+        finally:
+            await client.close()
+        results.append(BenchResult(f"burst_throughput_c{concurrency}_b{batch_size}", max(throughputs),
+                                   "calls/s", True))
+    return results
+
+
+async def bench_burst_processes(node_url, request_burst, rounds, processes):
+    """The heaviest single process burst config, with calls sent by load worker processes"""
+    concurrency, batch_size = 50, 1
+    args = monitor_parser.parse_args(["--work-mode", "baseload_check", "--target-url", node_url,
+                                      "--pool-size", str(concurrency)])
+    target = target_from_args(args, "bench", load_processes=processes)
+    workload = Workload.single_balance(target.token_address, target.token_holder)
+    client = RpcClient(node_url)
+    load = LoadWorkerPool(target, processes, workload)
+    context = {}
+    try:
+        # warm up, workers are started by the first burst
+        await load.burst_call(context, client, request_burst, concurrency, batch_size)
+        throughputs = []
+        for _ in range(rounds):
+            _, failed = await load.burst_call(context, client, request_burst, concurrency, batch_size)
+            if failed:
+                raise Exception(f"Burst against mock node failed {failed} calls")
+            throughputs.append(context["burst_throughput"])
+    finally:
+        await load.close()
+        await client.close()
+    return [BenchResult(f"burst_throughput_p{processes}_c{concurrency}_b{batch_size}", max(throughputs),
+                        "calls/s", True)]
+
+
+def bench_add_request(calls, rounds):
+    latency = LatencyHistogram()
+    latency.record(0.05)
+    results = []
+    for name, latency_arg in (("add_request", None), ("add_request_latency", latency)):
+        timings = []
+        for _ in range(rounds):
+            client_info = ClientInfo(1, "bench")
+            start = time.perf_counter()
+            for idx in range(calls):
+                client_info.add_request("target", RequestType.Succeeded, latency_arg)
+            timings.append((time.perf_counter() - start) / calls * 1000000)
+        results.append(BenchResult(name, min(timings), "us/call", False))
+    return results
+
+
+def _fill_usage(client_info, name, now):
+    """Request counts in every bucket of every history view, latency only in all-time totals"""
+    latency = LatencyHistogram()
+    latency.record(0.02)
+    client_info.add_request(name, RequestType.Succeeded, latency)
+    for resolution, attribute, _ in RESOLUTIONS:
+        time_series = client_info.get_time_series(getattr(client_info, attribute), name, resolution)
+        for idx in range(HISTORY_SIZE):
+            bucket = time_series.get_bucket(now - idx * resolution)
+            bucket.request_count += 100
+            bucket.request_failed_count += idx % 3
+
+
+def bench_client_collection(clients, rounds):
+    """Memory of ClientCollection with full usage history of every client and time of its json export"""
+    now = int(time.time())
+    tracemalloc.start()
+    collection = ClientCollection()
+    for idx in range(clients):
+        api_key = f"apikey_{idx}"
+        collection.add_client(api_key)
+        _fill_usage(collection.get_client(api_key), "polygon", now)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        collection.write_json(io.StringIO(), now)
+        timings.append((time.perf_counter() - start) * 1000)
+    return [BenchResult("client_memory", memory / clients / 1024, "KiB/client", False),
+            BenchResult("client_export", min(timings) / clients * 1000, "ms/1000 clients", False)]
+
+
+def _fill_history(client_info, name, now):
+    """Every bucket of every history view gets requests and latencies"""
+    client_info.add_request(name, RequestType.Succeeded)
+    for resolution, attribute, _ in RESOLUTIONS:
+        time_series = client_info.get_time_series(getattr(client_info, attribute), name, resolution)
+        for idx in range(HISTORY_SIZE):
+            bucket = time_series.get_bucket(now - idx * resolution)
+            bucket.request_count += 100
+            bucket.request_failed_count += idx % 3
+            latency = LatencyHistogram()
+            for sample in range(20):
+                latency.record(0.001 * (sample + 1) * (idx % 7 + 1))
+            time_series.add_latency(now - idx * resolution, latency)
+
+
+def _render_context(targets_count):
+    args = monitor_parser.parse_args(["--work-mode", "baseload_check"])
+    now = int(time.time())
+    client_info = ClientInfo(1, "bench")
+    context = {
+        'title': "benchmark",
+        'client_info': client_info,
+        'metrics': create_metrics(),
+        'status': StatusSnapshot(),
+        'targets': {},
+    }
+    for idx in range(targets_count):
+        target = target_from_args(args, f"target_{idx}")
+        latency = LatencyHistogram()
+        latency.record(0.02)
+        context['targets'][target.name] = {
+            "target": target,
+            "last_result": "success",
+            "block_age": 3,
+            "burst_duration": 1.5,
+            "burst_throughput": 330.0,
+            "methods": {method: {"succeeded": 100, "failed": 1, "latency": latency} for method in WORKLOAD_METHODS},
+        }
+        _fill_history(client_info, target.name, now)
+    return context
+
+
+async def bench_render(targets_count, requests):
+    app = web.Application()
+    app.add_routes(monitor_routes)
+    app['context'] = _render_context(targets_count)
+    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates'))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = _free_port()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+
+    results = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            for path in ("/", "/api/status"):
+                for cached in (False, True):
+                    timings = []
+                    for _ in range(requests):
+                        if not cached:
+                            app['context']['status'].invalidate()
+                        start = time.perf_counter()
+                        async with session.get(f"http://127.0.0.1:{port}{path}") as resp:
+                            await resp.read()
+                            if resp.status != 200:
+                                raise Exception(f"{path} returned {resp.status}")
+                        timings.append((time.perf_counter() - start) * 1000)
+                    name = "render_index" if path == "/" else "render_api_status"
+                    results.append(BenchResult(f"{name}_{'cached' if cached else 'rebuilt'}",
+                                               statistics.median(timings), "ms", False))
+    finally:
+        await runner.cleanup()
+    return results
+
+
+async def run_benchmarks(args):
+    results = []
+    process = None
+    node_url = args.node_url
+    if not node_url:
+        process, node_url = await _start_mock_node(args.node_latency_ms, args.node_processes)
+    try:
+        results += await bench_burst(node_url, args.request_burst, args.rounds)
+        if args.load_processes > 1:
+            results += await bench_burst_processes(node_url, args.request_burst, args.rounds, args.load_processes)
+    finally:
+        if process:
+            process.terminate()
+            await process.wait()
+    results += bench_add_request(args.add_request_calls, args.rounds)
+    results += bench_client_collection(args.clients, args.rounds)
+    results += await bench_render(args.render_targets, args.render_requests)
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Returns text of the report and names of regressed results"""
+    lines = []
+    regressions = []
+    for result in results:
+        line = f"{result.name:<36} {result.value:>12.2f} {result.unit}"
+        if result.name in baseline:
+            baseline_value = baseline[result.name]
+            change = (result.value - baseline_value) / baseline_value * 100 if baseline_value else 0.0
+            line += f"  (baseline {baseline_value:.2f}, {change:+.1f}%)"
+            if result.regression(baseline_value, tolerance):
+                line += "  REGRESSION"
+                regressions.append(result.name)
+        lines.append(line)
+    return "\n".join(lines) + "\n", regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark of rpc monitor against mock node')
+    parser.add_argument('--node-url', dest="node_url", type=str,
+                        help='Node to load, by default mock_node.py is started on free port',
+                        action=EnvDefault, envvar='BENCH_NODE_URL', required=False)
+    parser.add_argument('--node-latency-ms', dest="node_latency_ms", type=float,
+                        help='Latency of started mock node',
+                        action=EnvDefault, envvar='BENCH_NODE_LATENCY_MS',
+                        default=0.0, required=False)
+    parser.add_argument('--node-processes', dest="node_processes", type=int,
+                        help='Number of processes of started mock node, so it does not limit multi process load',
+                        action=EnvDefault, envvar='BENCH_NODE_PROCESSES',
+                        default=1)
+    parser.add_argument('--load-processes', dest="load_processes", type=int,
+                        help='Also measure burst sent by this many load worker processes',
+                        action=EnvDefault, envvar='BENCH_LOAD_PROCESSES',
+                        default=1)
+    parser.add_argument('--request-burst', dest="request_burst", type=int, help='Number of calls in single burst',
+                        action=EnvDefault, envvar='BENCH_REQUEST_BURST',
+                        default=1000)
+    parser.add_argument('--rounds', dest="rounds", type=int, help='Measurements taken, the best one is reported',
+                        action=EnvDefault, envvar='BENCH_ROUNDS',
+                        default=3)
+    parser.add_argument('--add-request-calls', dest="add_request_calls", type=int,
+                        help='Number of ClientInfo.add_request calls measured',
+                        action=EnvDefault, envvar='BENCH_ADD_REQUEST_CALLS',
+                        default=100000)
+    parser.add_argument('--clients', dest="clients", type=int,
+                        help='Number of clients (api keys) in measured ClientCollection',
+                        action=EnvDefault, envvar='BENCH_CLIENTS',
+                        default=1000)
+    parser.add_argument('--render-targets', dest="render_targets", type=int,
+                        help='Number of targets with full history on rendered status page',
+                        action=EnvDefault, envvar='BENCH_RENDER_TARGETS',
+                        default=10)
+    parser.add_argument('--render-requests', dest="render_requests", type=int,
+                        help='Number of requests per rendered page, median is reported',
+                        action=EnvDefault, envvar='BENCH_RENDER_REQUESTS',
+                        default=20)
+    parser.add_argument('--baseline', dest="baseline", type=str,
+                        help='Json file with results of previous run to compare with',
+                        action=EnvDefault, envvar='BENCH_BASELINE', required=False)
+    parser.add_argument('--save-baseline', dest="save_baseline", type=str,
+                        help='Store results as json file usable as --baseline',
+                        action=EnvDefault, envvar='BENCH_SAVE_BASELINE', required=False)
+    parser.add_argument('--tolerance', dest="tolerance", type=float,
+                        help='Relative change against baseline reported as regression',
+                        action=EnvDefault, envvar='BENCH_TOLERANCE',
+                        default=0.2)
+    parser.add_argument('--output', dest="output", type=str, help='Write report also to this file',
+                        action=EnvDefault, envvar='BENCH_OUTPUT',
+                        default="bench_output.txt")
+
+    args = parser.parse_args()
+    logging.getLogger("base_load").setLevel(logging.WARNING)
+
+    bench_results = asyncio.run(run_benchmarks(args))
+
+    baseline_values = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_values = json.load(f)
+    text, regressed = report(bench_results, baseline_values, args.tolerance)
+    print(text, end="")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({result.name: result.value for result in bench_results}, f, indent=4)
+    if regressed:
+        logger.error(f"Regressions against {args.baseline}: {', '.join(regressed)}")
+        sys.exit(1)
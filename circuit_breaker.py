@@ -0,0 +1,50 @@
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Stops sending load to a target that keeps failing.
+# After failure_threshold failed checks in a row the circuit opens: instead of the check only a single cheap
+# probe is sent on every tick. First successful probe closes the circuit and the next tick runs full check again
+# (a failure then opens it right away, without waiting for failure_threshold). failure_threshold 0 - never opens
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=3):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.consecutive_failures = 0
+        self.is_open = False
+        self.probing = False
+        self.opened_count = 0
+
+    @property
+    def state(self):
+        if self.is_open:
+            return "open"
+        return "half_open" if self.probing else "closed"
+
+    def record(self, success):
+        """Result of full check, returns True if the circuit opened"""
+        if success:
+            self.consecutive_failures = 0
+            self.probing = False
+            return False
+        self.consecutive_failures += 1
+        if self.failure_threshold and (self.probing or self.consecutive_failures >= self.failure_threshold):
+            self.is_open = True
+            self.probing = False
+            self.opened_count += 1
+            logger.info(f"Circuit of target {self.name} opened after {self.consecutive_failures} failed checks")
+            return True
+        return False
+
+    def record_probe(self, success):
+        """Result of probe sent while the circuit is open, returns True if the circuit closed"""
+        if not success:
+            return False
+        self.is_open = False
+        # target has to pass one full check before failures are counted from zero
+        self.probing = True
+        logger.info(f"Circuit of target {self.name} closed, probe succeeded")
+        return True
@@ -1,9 +1,10 @@
 import json
-from dataclasses import dataclass, field
-from datetime import datetime, timezone, timedelta
-from dataclasses_json import dataclass_json
+import time
+from array import array
 from enum import Enum
 
+from latency_histogram import LatencyHistogram
+
 
 class RequestType(Enum):
     Succeeded = 1
@@ -11,99 +12,297 @@ class RequestType(Enum):
     Failed = 3
 
 
-@dataclass_json
-@dataclass
+SECOND = 1
+MINUTE = 60
+HOUR = 60 * 60
+DAY = 24 * 60 * 60
+
+HISTORY_SIZE = 120
+# per second buckets are read by others (SLOs, probe pushes) when they are this old,
+# so checks finishing at the turn of the second are counted
+SETTLE_SECONDS = 2
+
+# time series of ClientInfo, with their name in json export
+RESOLUTIONS = [
+    (SECOND, "time_buckets_seconds", "seconds"),
+    (MINUTE, "time_buckets_minutes", "minutes"),
+    (HOUR, "time_buckets_hours", "hours"),
+    (DAY, "time_buckets_days", "days"),
+]
+
+
+# All-time totals of one network
 class ClientNetworkInfo:
-    request_count: int = field(default=0)
-    request_failed_count: int = field(default=0)
-    request_backup_count: int = field(default=0)
+    __slots__ = ("request_count", "request_failed_count", "request_backup_count", "latency")
+
+    def __init__(self, request_count=0, request_failed_count=0, request_backup_count=0, latency=None):
+        self.request_count = request_count
+        self.request_failed_count = request_failed_count
+        self.request_backup_count = request_backup_count
+        self.latency = latency or LatencyHistogram()
+
+    def reset(self):
+        self.request_count = 0
+        self.request_failed_count = 0
+        self.request_backup_count = 0
+        self.latency = LatencyHistogram()
+
+    def add(self, request_type, latency=None):
+        if request_type == RequestType.Succeeded:
+            self.request_count += 1
+        elif request_type == RequestType.Failed:
+            self.request_failed_count += 1
+        elif request_type == RequestType.Backup:
+            self.request_backup_count += 1
+        else:
+            raise Exception(f"Unknown request type: {request_type}")
+        if latency:
+            self.latency.merge(latency)
+
+
+# Latency of buckets where none was recorded, shared and read only: latency recorded to it would be lost
+class _NoLatency(LatencyHistogram):
+    __slots__ = ()
+
+    def record(self, latency_s):
+        raise TypeError("Latency of bucket is read only, record it with TimeSeries.add or add_latency")
+
+    def merge(self, other):
+        raise TypeError("Latency of bucket is read only, record it with TimeSeries.add or add_latency")
+
+
+NO_LATENCY = _NoLatency()
+
+
+# Bucket of TimeSeries, reads and writes its columns (latency is recorded with TimeSeries.add / add_latency)
+class Bucket:
+    __slots__ = ("_series", "_idx")
+
+    def __init__(self, series, idx):
+        self._series = series
+        self._idx = idx
+
+    @property
+    def request_count(self):
+        return self._series.request_counts[self._idx]
+
+    @request_count.setter
+    def request_count(self, value):
+        self._series.request_counts[self._idx] = value
+
+    @property
+    def request_failed_count(self):
+        return self._series.failed_counts[self._idx]
+
+    @request_failed_count.setter
+    def request_failed_count(self, value):
+        self._series.failed_counts[self._idx] = value
+
+    @property
+    def request_backup_count(self):
+        return self._series.backup_counts[self._idx]
+
+    @request_backup_count.setter
+    def request_backup_count(self, value):
+        self._series.backup_counts[self._idx] = value
+
+    @property
+    def latency(self):
+        """Latency of the bucket for reading, shared read only NO_LATENCY if none was recorded"""
+        return self._series.latencies.get(self._idx) or NO_LATENCY
+
+    def reset(self):
+        self._series.reset(self._idx)
+
+
+# Fixed size ring buffer of buckets indexed by epoch slot (epoch seconds // resolution).
+# Counters of all buckets are kept in arrays (one per counter), latency histograms only for buckets
+# where latency was recorded, so empty and count-only buckets are not python objects at all.
+# Bucket of the slot that falls out of the window is reused in place, so nothing has to be scanned or deleted
+class TimeSeries:
+    __slots__ = ("resolution", "size", "slots", "request_counts", "failed_counts", "backup_counts", "latencies")
+
+    def __init__(self, resolution, size=HISTORY_SIZE):
+        self.resolution = resolution
+        self.size = size
+        self.slots = array("q", [-1]) * size
+        self.request_counts = array("Q", bytes(8 * size))
+        self.failed_counts = array("Q", bytes(8 * size))
+        self.backup_counts = array("Q", bytes(8 * size))
+        # bucket index -> LatencyHistogram
+        self.latencies = {}
+
+    def reset(self, idx):
+        self.request_counts[idx] = 0
+        self.failed_counts[idx] = 0
+        self.backup_counts[idx] = 0
+        self.latencies.pop(idx, None)
+
+    def latency(self, idx):
+        latency = self.latencies.get(idx)
+        if latency is None:
+            latency = LatencyHistogram()
+            self.latencies[idx] = latency
+        return latency
+
+    def _current(self, epoch_seconds):
+        slot = epoch_seconds // self.resolution
+        idx = slot % self.size
+        if self.slots[idx] != slot:
+            self.slots[idx] = slot
+            self.reset(idx)
+        return idx
+
+    def bucket_at(self, idx):
+        return Bucket(self, idx)
+
+    def get_bucket(self, epoch_seconds):
+        return Bucket(self, self._current(epoch_seconds))
+
+    def find_bucket(self, epoch_seconds):
+        """Bucket of given time if it is still in the window, None otherwise (nothing is reset)"""
+        slot = epoch_seconds // self.resolution
+        idx = slot % self.size
+        return Bucket(self, idx) if self.slots[idx] == slot else None
+
+    def add(self, epoch_seconds, request_type, latency=None):
+        idx = self._current(epoch_seconds)
+        if request_type == RequestType.Succeeded:
+            self.request_counts[idx] += 1
+        elif request_type == RequestType.Failed:
+            self.failed_counts[idx] += 1
+        elif request_type == RequestType.Backup:
+            self.backup_counts[idx] += 1
+        else:
+            raise Exception(f"Unknown request type: {request_type}")
+        if latency:
+            self.latency(idx).merge(latency)
+
+    def add_latency(self, epoch_seconds, latency):
+        self.latency(self._current(epoch_seconds)).merge(latency)
+
+    def merge(self, epoch_seconds, request_count, failed_count, backup_count, latency=None):
+        """Adds counts of other series (e.g. pushed by probe) to bucket of given time, skipped if it is too old"""
+        slot = epoch_seconds // self.resolution
+        if self.slots[slot % self.size] > slot:
+            return
+        idx = self._current(epoch_seconds)
+        self.request_counts[idx] += request_count
+        self.failed_counts[idx] += failed_count
+        self.backup_counts[idx] += backup_count
+        if latency:
+            self.latency(idx).merge(latency)
+
+    def history(self, epoch_seconds):
+        """Yields (bucket start epoch, bucket) pairs still in the window, newest first"""
+        current_slot = epoch_seconds // self.resolution
+        for slot in range(current_slot, current_slot - self.size, -1):
+            idx = slot % self.size
+            if self.slots[idx] == slot:
+                yield slot * self.resolution, Bucket(self, idx)
+
+    def export(self, epoch_seconds):
+        """[bucket start, requests, failed, backup] of buckets in the window, oldest first"""
+        current_slot = epoch_seconds // self.resolution
+        first_slot = current_slot - self.size + 1
+        live = sorted((slot, idx) for idx, slot in enumerate(self.slots) if first_slot <= slot <= current_slot)
+        return [[slot * self.resolution, self.request_counts[idx], self.failed_counts[idx], self.backup_counts[idx]]
+                for slot, idx in live]
 
 
-@dataclass_json
-@dataclass
 class ClientInfo:
-    id: int
-    api_key: str
-    networks: dict = field(default_factory=dict)
-    time_buckets_seconds: dict = field(default_factory=dict)
-    time_buckets_minutes: dict = field(default_factory=dict)
-    time_buckets_hours: dict = field(default_factory=dict)
-    time_buckets_days: dict = field(default_factory=dict)
-
-    # @todo do not cleanup every call, it's inefficient
-    # move it to some kind of watcher or add time difference to the cleanup
-    def cleanup_history(self, time_buckets, last_valid_time):
-        keys_to_delete = []
-        for network_name in time_buckets:
-            time_bucket = time_buckets[network_name]
-            for time_str in time_bucket:
-                if time_str < last_valid_time:
-                    keys_to_delete.append(time_str)
-
-            for key in keys_to_delete:
-                del time_bucket[key]
-
-    def get_or_add_time_bucket(self, time_buckets, network_name, time_str: datetime):
-        if network_name not in time_buckets:
-            time_buckets[network_name] = {}
-        time_bucket = time_buckets[network_name]
-
-        if time_str not in time_bucket:
-            time_bucket[time_str] = ClientNetworkInfo()
-        return time_bucket[time_str]
-
-    def add_request(self, network_name, request_type):
-        current_time = datetime.now(timezone.utc)
-
-        day_format = "%Y-%m-%dT00:00:00"
-        hour_format = "%Y-%m-%dT%H:00:00"
-        minute_format = "%Y-%m-%dT%H:%M:00"
-        second_format = "%Y-%m-%dT%H:%M:%S"
-
-        SECONDS_BEFORE = 120
-        MINUTES_BEFORE = 120
-        HOURS_BEFORE = 120
-        DAYS_BEFORE = 120
-
-        self.cleanup_history(self.time_buckets_seconds, (current_time - timedelta(seconds=SECONDS_BEFORE)).strftime(second_format))
-        self.cleanup_history(self.time_buckets_minutes, (current_time - timedelta(minutes=MINUTES_BEFORE)).strftime(minute_format))
-        self.cleanup_history(self.time_buckets_hours, (current_time - timedelta(hours=HOURS_BEFORE)).strftime(hour_format))
-        self.cleanup_history(self.time_buckets_days, (current_time - timedelta(days=DAYS_BEFORE)).strftime(day_format))
-
-        days = current_time.strftime(day_format)
-        hours = current_time.strftime(hour_format)
-        minutes = current_time.strftime(minute_format)
-        seconds = current_time.strftime(second_format)
-
-        cl_infos = []
-        if network_name not in self.networks:
+    __slots__ = ("id", "api_key", "networks", "time_buckets_seconds", "time_buckets_minutes", "time_buckets_hours",
+                 "time_buckets_days", "_series", "merged_since")
+
+    def __init__(self, id, api_key):
+        self.id = id
+        self.api_key = api_key
+        self.networks = {}
+        self.time_buckets_seconds = {}
+        self.time_buckets_minutes = {}
+        self.time_buckets_hours = {}
+        self.time_buckets_days = {}
+        # network name -> its time series of all resolutions, so add_request does not look them up one by one
+        self._series = {}
+        # the oldest second added by merge since HistoryStore took it, it can be older than the last flush
+        self.merged_since = None
+
+    def get_time_series(self, time_buckets, network_name, resolution):
+        time_series = time_buckets.get(network_name)
+        if time_series is None:
+            time_series = TimeSeries(resolution)
+            time_buckets[network_name] = time_series
+        return time_series
+
+    def _network(self, network_name):
+        cl_info = self.networks.get(network_name)
+        if cl_info is None:
             cl_info = ClientNetworkInfo()
             self.networks[network_name] = cl_info
-        else:
-            cl_info = self.networks[network_name]
+        return cl_info
 
-        cl_infos.append(cl_info)
+    def _time_series(self, network_name):
+        series = self._series.get(network_name)
+        if series is None:
+            series = tuple(self.get_time_series(getattr(self, attribute), network_name, resolution)
+                           for resolution, attribute, _ in RESOLUTIONS)
+            self._series[network_name] = series
+        return series
 
-        cl_infos.append(self.get_or_add_time_bucket(self.time_buckets_seconds, network_name, seconds))
-        cl_infos.append(self.get_or_add_time_bucket(self.time_buckets_minutes, network_name, minutes))
-        cl_infos.append(self.get_or_add_time_bucket(self.time_buckets_hours, network_name, hours))
-        cl_infos.append(self.get_or_add_time_bucket(self.time_buckets_days, network_name, days))
+    def add_request(self, network_name, request_type, latency: LatencyHistogram = None):
+        current_time = int(time.time())
+        self._network(network_name).add(request_type, latency)
+        for time_series in self._time_series(network_name):
+            time_series.add(current_time, request_type, latency)
 
-        for cl_info in cl_infos:
-            if request_type == RequestType.Succeeded:
-                cl_info.request_count += 1
-            elif request_type == RequestType.Failed:
-                cl_info.request_failed_count += 1
-            elif request_type == RequestType.Backup:
-                cl_info.request_backup_count += 1
-            else:
-                raise Exception(f"Unknown request type: {request_type}")
+    def add_latency(self, network_name, latency: LatencyHistogram):
+        """Latency of calls of a check that is still running, the check itself is counted by add_request"""
+        current_time = int(time.time())
+        self._network(network_name).latency.merge(latency)
+        for time_series in self._time_series(network_name):
+            time_series.add_latency(current_time, latency)
 
+    def merge(self, network_name, epoch_seconds, request_count, failed_count, backup_count, latency=None):
+        """Adds counts of one second of other ClientInfo (e.g. pushed by probe) to totals and all time series"""
+        if self.merged_since is None or epoch_seconds < self.merged_since:
+            self.merged_since = epoch_seconds
+        cl_info = self._network(network_name)
+        cl_info.request_count += request_count
+        cl_info.request_failed_count += failed_count
+        cl_info.request_backup_count += backup_count
+        if latency:
+            cl_info.latency.merge(latency)
+        for time_series in self._time_series(network_name):
+            time_series.merge(epoch_seconds, request_count, failed_count, backup_count, latency)
 
-@dataclass_json
-@dataclass
+    def export(self, now=None):
+        """Plain dict with totals and history of every network, built from counter columns"""
+        now = int(time.time()) if now is None else now
+        networks = {}
+        for network_name, cl_info in self.networks.items():
+            network = {
+                "requests": cl_info.request_count,
+                "failed": cl_info.request_failed_count,
+                "backup": cl_info.request_backup_count,
+                "p50": cl_info.latency.percentile(50),
+                "p99": cl_info.latency.percentile(99),
+            }
+            for _, attribute, name in RESOLUTIONS:
+                time_series = getattr(self, attribute).get(network_name)
+                network[name] = time_series.export(now) if time_series else []
+            networks[network_name] = network
+        return {"id": self.id, "networks": networks}
+
+    def to_json(self):
+        return json.dumps(self.export())
+
+
+# Usage of many clients (api keys)
 class ClientCollection:
-    clients: dict = field(default_factory=dict)
+    __slots__ = ("clients",)
+
+    def __init__(self):
+        self.clients = {}
 
     def add_client(self, api_key: str):
         if api_key not in self.clients:
@@ -114,10 +313,32 @@ class ClientCollection:
     def get_client(self, api_key: str):
         return self.clients.get(api_key)
 
+    def iter_json(self, now=None):
+        """
+        Yields json of all clients in chunks, one client at a time, so the whole collection is never
+        materialized as one document:
+        {"clients": {"<api key>": {"id": 1, "networks": {"<network>": {"requests": 10, "failed": 1, "backup": 0,
+            "p50": 20.0, "p99": 45.0, "seconds": [[bucket start, requests, failed, backup], ...],
+            "minutes": [...], "hours": [...], "days": [...]}}}}}
+        """
+        now = int(time.time()) if now is None else now
+        yield '{"clients": {'
+        separator = ""
+        for api_key, client in self.clients.items():
+            yield f"{separator}{json.dumps(api_key)}: {json.dumps(client.export(now))}"
+            separator = ", "
+        yield "}}"
+
+    def write_json(self, f, now=None):
+        for chunk in self.iter_json(now):
+            f.write(chunk)
+
+    def to_json(self):
+        return "".join(self.iter_json())
 
 
 if __name__ == "__main__":
-    c = ClientInfo(networks={})
+    c = ClientInfo(1, "apikey")
     c.networks["polygon"] = ClientNetworkInfo(request_count=10, request_failed_count=2, request_backup_count=3)
 
     print(c.to_json())
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from array import array
+from datetime import datetime
+
+from aiohttp import web
+
+from client_info import HISTORY_SIZE, SETTLE_SECONDS, RequestType
+from latency_histogram import BUCKET_COUNT, LatencyHistogram
+from status_snapshot import target_state
+from targets import WORK_MODES
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# target state fields that are timestamps, collector keeps them as datetime like a local target context
+TIME_FIELDS = ("last_call", "last_success", "last_err_time")
+# other fields of target state (see status_snapshot.target_state), text or None
+TEXT_FIELDS = ("last_result", "last_err", "circuit")
+
+
+def encode_latency(latency):
+    """[total, max us, [[bucket index, count], ...]] with non empty buckets only"""
+    return [latency.total, latency.max_us, [[idx, count] for idx, count in enumerate(latency.counts) if count]]
+
+
+def _count(value):
+    if type(value) is not int or value < 0:
+        raise ValueError(f"Invalid count {value!r}")
+    return value
+
+
+def decode_latency(data):
+    total, max_us, pairs = data
+    if not _count(total):
+        return None
+    counts = array("Q", bytes(8 * BUCKET_COUNT))
+    for idx, count in pairs:
+        if type(idx) is not int or not 0 <= idx < BUCKET_COUNT:
+            raise ValueError(f"Invalid latency bucket {idx!r}")
+        counts[idx] = _count(count)
+    return LatencyHistogram(counts, total, _count(max_us))
+
+
+# Probe side: monitor running checks in one region pushes its results to the collector every interval.
+# Push holds the seconds finished since the last successful push, every second as
+# [start, requests, failed, backup, latency] with sparse latency histogram, and the last state of every target.
+# Size depends on the interval and number of targets, not on the number of requests sent.
+# Seconds not accepted by the collector are sent again with the next push (while they are in ClientInfo history)
+class ProbePusher:
+    def __init__(self, url, region, interval=10.0):
+        self._url = url.rstrip("/") + "/api/probe"
+        self._region = region
+        self._interval = interval
+        self._next_second = None
+
+    def build_push(self, ctx, now):
+        """
+        Push of seconds from the first not pushed one up to now - SETTLE_SECONDS. The first push (also after
+        restart of the probe) has whole history of seconds, the collector skips seconds it already merged
+        """
+        last_second = now - SETTLE_SECONDS
+        first_second = last_second - HISTORY_SIZE + 1
+        if self._next_second is not None:
+            first_second = max(self._next_second, first_second)
+        client_info = ctx['client_info']
+        targets = {}
+        for name, target_ctx in ctx['targets'].items():
+            buckets = []
+            time_series = client_info.time_buckets_seconds.get(name)
+            for second in range(first_second, last_second + 1):
+                bucket = time_series.find_bucket(second) if time_series else None
+                if bucket is None:
+                    continue
+                latency = bucket.latency
+                if bucket.request_count or bucket.request_failed_count or bucket.request_backup_count or \
+                        latency.total:
+                    buckets.append([second, bucket.request_count, bucket.request_failed_count,
+                                    bucket.request_backup_count, encode_latency(latency)])
+            targets[name] = {
+                "work_mode": target_ctx["target"].work_mode,
+                "state": target_state(target_ctx),
+                "buckets": buckets,
+            }
+        return {
+            "region": self._region,
+            "seconds": [first_second, last_second],
+            "targets": targets,
+        }, last_second + 1
+
+    async def push(self, session, ctx):
+        data, next_second = self.build_push(ctx, int(time.time()))
+        async with session.post(self._url, json=data) as resp:
+            if resp.status != 200:
+                raise Exception(f"Collector {self._url} returned {resp.status}")
+        self._next_second = next_second
+
+    async def run(self, session, ctx):
+        while True:
+            await asyncio.sleep(self._interval)
+            if 'targets' not in ctx:
+                continue
+            try:
+                await self.push(session, ctx)
+            except Exception as ex:
+                logger.warning(f"Failed to push results to collector {self._url}: {ex}")
+
+
+# Collector side: merges pushes of all probes into its ClientInfo, one network per region and target
+# ("<region>/<target>"), so history, status page, live updates, SLOs and metrics work on them like on local targets.
+# Seconds already merged from given region and target are skipped, so repeated push is not counted twice.
+# Whole push is validated before anything is merged, rejected push leaves no trace and can be sent again
+class Collector:
+    def __init__(self, create_target):
+        # creates Target of given name and work mode, shown on the status page
+        self._create_target = create_target
+        # network name -> last merged second
+        self._merged = {}
+
+    def _target_ctx(self, ctx, name, work_mode):
+        targets = ctx.setdefault('targets', {})
+        target_ctx = targets.get(name)
+        if target_ctx is None or target_ctx["target"].work_mode != work_mode:
+            target_ctx = {"target": self._create_target(name, work_mode)}
+            targets[name] = target_ctx
+            logger.info(f"New probe target {name} ({work_mode})")
+        return target_ctx
+
+    @staticmethod
+    def parse(data):
+        """
+        Validated push as (last second, [(network name, work mode, state, buckets), ...]) with timestamps
+        of the state as datetime and decoded latency of the buckets, raises ValueError for malformed push
+        """
+        region = data["region"]
+        if not isinstance(region, str) or not region:
+            raise ValueError(f"Invalid region {region!r}")
+        first_second, last_second = data["seconds"]
+        if _count(first_second) > _count(last_second):
+            raise ValueError(f"Invalid seconds {first_second}-{last_second}")
+        targets = []
+        for target_name, target_data in data["targets"].items():
+            name = f"{region}/{target_name}"
+            work_mode = target_data["work_mode"]
+            if work_mode not in WORK_MODES:
+                raise ValueError(f"Unknown work mode {work_mode} of target {name}")
+            state = {}
+            for key, value in target_data["state"].items():
+                if value is None:
+                    state[key] = None
+                elif key in TIME_FIELDS:
+                    state[key] = datetime.fromtimestamp(value)
+                elif key == "block_timestamp":
+                    state[key] = _count(value)
+                    state["block_age"] = int(time.time()) - value
+                elif key in TEXT_FIELDS and isinstance(value, str):
+                    state[key] = value
+                else:
+                    raise ValueError(f"Invalid state {key}={value!r} of target {name}")
+            buckets = []
+            for second, request_count, failed_count, backup_count, latency_data in target_data["buckets"]:
+                if not first_second <= _count(second) <= last_second:
+                    raise ValueError(f"Second {second} of {name} outside of pushed seconds")
+                buckets.append((second, _count(request_count), _count(failed_count), _count(backup_count),
+                                decode_latency(latency_data)))
+            targets.append((name, work_mode, state, buckets))
+        return last_second, targets
+
+    def merge(self, ctx, data):
+        client_info = ctx['client_info']
+        metrics = ctx['metrics']
+        last_second, targets = self.parse(data)
+        for name, work_mode, state, buckets in targets:
+            target_ctx = self._target_ctx(ctx, name, work_mode)
+            for key, value in state.items():
+                if value is None:
+                    target_ctx.pop(key, None)
+                else:
+                    target_ctx[key] = value
+
+            merged = self._merged.get(name, 0)
+            labels = (("target", name),)
+            for second, request_count, failed_count, backup_count, latency in buckets:
+                if second <= merged:
+                    continue
+                client_info.merge(name, second, request_count, failed_count, backup_count, latency)
+                for request_type, count in ((RequestType.Succeeded, request_count),
+                                            (RequestType.Failed, failed_count),
+                                            (RequestType.Backup, backup_count)):
+                    if count:
+                        metrics.inc("rpc_monitor_checks_total", labels + (("result", request_type.name.lower()),),
+                                    count)
+                if latency:
+                    metrics.observe("rpc_monitor_request_latency_seconds", labels, latency)
+            self._merged[name] = max(merged, last_second)
+        ctx['status'].invalidate()
+
+    async def handle(self, request):
+        try:
+            data = await request.json()
+            self.merge(request.app['context'], data)
+        except (AttributeError, KeyError, OverflowError, OSError, TypeError, ValueError) as ex:
+            logger.warning(f"Invalid push from {request.remote}: {ex}")
+            raise web.HTTPBadRequest(text=f"Invalid push: {ex}")
+        return web.Response(text="ok")
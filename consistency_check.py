@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections import Counter
+
+from golem_rpc_endpoint_check import CheckEndpointException, instance_url
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# results of these methods do not depend on the pinned block, they are never compared
+UNPINNED_METHODS = ("eth_gasPrice",)
+# queries are pinned this many blocks below the lowest head, so every instance has the block
+PIN_CONFIRMATIONS = 10
+DIGEST_SIZE = 8
+# digest of the query that failed, it is skipped when instances are compared
+NO_DIGEST = bytes(DIGEST_SIZE)
+# fork point is searched at most this many blocks below the pinned block
+FORK_SEARCH_DEPTH = 100000
+# divergent queries kept for the status page and alerts
+MAX_REPORTED_DIVERGENCES = 20
+
+
+def result_digest(result):
+    """Compact digest of json-rpc result, equal results give equal digests no matter the key order"""
+    data = json.dumps(result, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(data.encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def compare_digests(digests):
+    """
+    digests - list of query digests per instance (NO_DIGEST where query failed).
+    Returns indexes of queries where the instance differs from the majority, per instance.
+    When the vote is tied, every instance taking part in it is reported
+    """
+    diverging = {instance: [] for instance in digests}
+    # one digest of the whole cycle per instance, in the usual case that all agree nothing else is compared
+    combined = {hashlib.blake2b(b"".join(instance_digests), digest_size=DIGEST_SIZE).digest()
+                for instance_digests in digests.values()}
+    if len(combined) <= 1:
+        return diverging
+
+    for idx, query_digests in enumerate(zip(*digests.values())):
+        votes = Counter(digest for digest in query_digests if digest != NO_DIGEST)
+        if len(votes) <= 1:
+            continue
+        (majority, majority_count), (_, runner_up_count) = votes.most_common(2)
+        if majority_count == runner_up_count:
+            majority = None
+        for instance, digest in zip(digests, query_digests):
+            if digest != NO_DIGEST and digest != majority:
+                diverging[instance].append(idx)
+    return diverging
+
+
+def _query_block(params):
+    """Block the query is pinned to, None for queries not bound to a block (e.g. receipt by hash)"""
+    for param in reversed(params):
+        if isinstance(param, dict) and "toBlock" in param:
+            return int(param["toBlock"], 0)
+        # block number, not an address or hash
+        if isinstance(param, str) and param.startswith("0x") and len(param) <= 18:
+            return int(param, 0)
+    return None
+
+
+async def get_instance_urls(session, endpoint):
+    """Rpc urls of gateway instances by instance id"""
+    async with session.get(endpoint) as resp:
+        if resp.status != 200:
+            raise CheckEndpointException(f"Endpoint {endpoint} returned {resp.status}")
+        data = await resp.json(content_type=None)
+
+    urls = {}
+    for instance_id, instance in data["instances"].items():
+        url = instance_url(instance)
+        if url:
+            urls[instance_id] = url
+        else:
+            logger.warning(f"Instance {instance_id} has no url, its responses can not be compared")
+    return urls
+
+
+async def query_digests(client, calls, concurrency, batch_size, request_timeout, workload=None):
+    """
+    Sends calls (list of workload.next_call() results) in json-rpc batches of batch_size, with at most
+    concurrency requests in flight. Returns digest of every result (json-rpc errors are digested too,
+    NO_DIGEST if the request failed). Results are passed to workload.observe, if given
+    """
+    digests = [NO_DIGEST] * len(calls)
+    chunks = [range(start, min(start + batch_size, len(calls))) for start in range(0, len(calls), batch_size)]
+
+    async def worker():
+        while chunks:
+            chunk = chunks.pop()
+            try:
+                results = await asyncio.wait_for(
+                    client.batch_call([calls[idx][1:] for idx in chunk], return_errors=True), request_timeout)
+            except Exception as ex:
+                logger.debug(f"Error when getting request: {ex}")
+                continue
+            for idx, result in zip(chunk, results):
+                digests[idx] = result_digest(result)
+                if workload and not (isinstance(result, dict) and "error" in result):
+                    try:
+                        workload.observe(calls[idx][0], result)
+                    except Exception:
+                        pass
+
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, len(chunks)))])
+    return digests
+
+
+async def _block_hash(client, number, request_timeout):
+    block = await asyncio.wait_for(client.get_block_by_number(number, False), request_timeout)
+    return block["hash"] if block else None
+
+
+async def find_fork_block(client, reference, low, high, request_timeout):
+    """
+    Bisects for the first block with different hash on client than on reference in (low, high],
+    returns None if they differ already at low
+    """
+    hashes = await asyncio.gather(_block_hash(client, low, request_timeout),
+                                  _block_hash(reference, low, request_timeout))
+    if hashes[0] != hashes[1]:
+        return None
+    while high - low > 1:
+        middle = (low + high) // 2
+        hashes = await asyncio.gather(_block_hash(client, middle, request_timeout),
+                                      _block_hash(reference, middle, request_timeout))
+        if hashes[0] == hashes[1]:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+async def _instance_head(client, request_timeout):
+    block = await asyncio.wait_for(client.get_block_by_number("latest", False), request_timeout)
+    return int(block["number"], 0)
+
+
+async def consistency_call(context, session, endpoint, get_client, workload, number_queries, concurrency=1,
+                           batch_size=1, request_timeout=None):
+    """
+    Sends the same number_queries workload calls, pinned below the lowest head, to every instance behind
+    the gateway endpoint (get_client returns RpcClient of instance url) and compares digests of the results.
+    Report is stored in context["consistency"]. Returns number of matched, diverged and failed queries
+    """
+    urls = await asyncio.wait_for(get_instance_urls(session, endpoint), request_timeout)
+    clients = {instance_id: get_client(url) for instance_id, url in sorted(urls.items())}
+
+    heads = await asyncio.gather(*[_instance_head(client, request_timeout) for client in clients.values()],
+                                 return_exceptions=True)
+    unavailable = []
+    for instance_id, head in zip(list(clients), heads):
+        if isinstance(head, Exception):
+            logger.warning(f"Instance {instance_id} did not return its head: {head}")
+            unavailable.append(instance_id)
+            del clients[instance_id]
+    if len(clients) < 2:
+        raise CheckEndpointException(f"Only {len(clients)} of {len(urls)} instances respond, nothing to compare")
+    pinned_block = min(head for head in heads if not isinstance(head, Exception)) - PIN_CONFIRMATIONS
+
+    # the same calls for every instance, the first one is always the pinned block itself
+    workload.set_latest_block(pinned_block + 10)
+    calls = [("eth_getBlockByNumber", "eth_getBlockByNumber", [hex(pinned_block), False])]
+    calls += [call for call in (workload.next_call() for _ in range(number_queries - 1))
+              if call[0] not in UNPINNED_METHODS]
+
+    instance_digests = await asyncio.gather(*[
+        query_digests(client, calls, concurrency, batch_size, request_timeout, workload if idx == 0 else None)
+        for idx, client in enumerate(clients.values())])
+    digests = dict(zip(clients, instance_digests))
+    diverging = compare_digests(digests)
+
+    instances = []
+    divergences = []
+    matched = diverged = failed = 0
+    for instance_id, queries in diverging.items():
+        instance_failed = digests[instance_id].count(NO_DIGEST)
+        blocks = [_query_block(calls[idx][2]) for idx in queries]
+        blocks = [block for block in blocks if block is not None]
+        fork_block = None
+        if queries and queries[0] == 0:
+            # pinned block itself differs, instance is on other fork than the reference (majority if there is one)
+            references = [other for other in clients
+                          if digests[other][0] not in (NO_DIGEST, digests[instance_id][0])]
+            references.sort(key=lambda other: diverging[other][:1] == [0])
+            if references:
+                try:
+                    fork_block = await find_fork_block(clients[instance_id], clients[references[0]],
+                                                       max(pinned_block - FORK_SEARCH_DEPTH, 0), pinned_block,
+                                                       request_timeout)
+                except Exception as ex:
+                    logger.warning(f"Failed to find fork block of instance {instance_id}: {ex}")
+        instances.append({
+            "instance": instance_id,
+            "matched": len(calls) - len(queries) - instance_failed,
+            "diverged": len(queries),
+            "failed": instance_failed,
+            "first_block": min(blocks) if blocks else None,
+            "fork_block": fork_block,
+        })
+        for idx in queries[:MAX_REPORTED_DIVERGENCES - len(divergences)]:
+            divergences.append({"instance": instance_id, "method": calls[idx][0],
+                                "block": _query_block(calls[idx][2])})
+        matched += len(calls) - len(queries) - instance_failed
+        diverged += len(queries)
+        failed += instance_failed
+    for instance_id in unavailable:
+        instances.append({"instance": instance_id, "matched": 0, "diverged": 0, "failed": len(calls),
+                          "first_block": None, "fork_block": None})
+        failed += len(calls)
+
+    context["consistency"] = {
+        "pinned_block": pinned_block,
+        "queries": len(calls),
+        "instances": instances,
+        "divergences": divergences,
+    }
+    logger.info(f"Compared {len(calls)} queries pinned at block {pinned_block} on {len(clients)} instances: "
+                f"{matched} matched, {diverged} diverged, {failed} failed")
+    return matched, diverged, failed
@@ -1,64 +1,181 @@
-import requests
+import asyncio
+import aiohttp
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import timedelta
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Discord rejects messages longer than that
+MAX_MESSAGE_LENGTH = 2000
+
+
 # DiscordManager is responsible for sending messages to Discord webhook
+# post_*_message calls only queue the message, background sender task merges messages
+# queued for the same topic within coalesce window into one digest and sends it respecting rate limits.
+# After a digest is sent, the topic is held for min_resend time of its last state: changes of state (flapping)
+# during that time are merged into the next digest instead of being sent one by one
 class DiscordManager:
     def __init__(self, webhook_url,
                  min_resend_error_time=timedelta(seconds=30),
-                 min_resend_success_time=timedelta(seconds=30)
+                 min_resend_success_time=timedelta(seconds=30),
+                 coalesce_window=timedelta(seconds=5),
+                 max_pending_topics=50,
+                 max_messages_per_topic=10,
+                 max_send_retries=5
                  ):
         self._webhook_url = webhook_url
+        if max_messages_per_topic < 1:
+            raise Exception(f"max_messages_per_topic has to be at least 1, got {max_messages_per_topic}")
 
-        self._last_send_success = {}
-        self._last_send_failure = {}
+        # topic -> (True for failure / False for success, monotonic time the state was last queued)
+        self._last_state = {}
         self._min_resend_error_time = min_resend_error_time
         self._min_resend_success_time = min_resend_success_time
 
-    def check_webhook(self):
-        resp = requests.get(self._webhook_url)
+        self._coalesce_window = coalesce_window
+        self._max_pending_topics = max_pending_topics
+        self._max_messages_per_topic = max_messages_per_topic
+        self._max_send_retries = max_send_retries
+        # topic -> messages waiting for next digest, dict keeps topics in order of arrival
+        self._pending = {}
+        # topic -> number of messages merged away because queue for topic was full
+        self._merged_count = {}
+        # topic -> monotonic time its first pending message was queued
+        self._pending_since = {}
+        # topic -> monotonic time until which next digest of topic waits
+        self._hold_until = {}
+        self._wakeup = asyncio.Event()
+        self._session = None
+        self._sender_task = None
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self._sender_task = asyncio.create_task(self._sender_loop())
+
+    async def close(self):
+        if self._sender_task:
+            self._sender_task.cancel()
+            try:
+                await self._sender_task
+            except asyncio.CancelledError:
+                pass
+        if self._session:
+            await self._session.close()
 
-        webhook_info = resp.json()
+    async def check_webhook(self):
+        async with self._session.get(self._webhook_url) as resp:
+            webhook_info = await resp.json(content_type=None)
         logger.debug(f"Webhook info: {webhook_info}")
         # if webhook_info["id"] != self._webhook_id:
         #     raise Exception("Webhook id check failed")
         # if webhook_info["token"] != self._webhook_token:
         #     raise Exception("Webhook token check failed")
 
-    # noinspection DuplicatedCode
     def post_failure_message(self, topic, message):
         logger.debug(f"Sending failure message. topic: {topic}, message: {message}")
-        if topic in self._last_send_failure:
-            last_failure_sent_diff = datetime.utcnow() - self._last_send_failure[topic]
-            logger.debug(f"Last failure message sent {last_failure_sent_diff}")
-            if last_failure_sent_diff < self._min_resend_error_time:
-                logger.debug(f"Skipping sent {last_failure_sent_diff} < {self._min_resend_error_time}")
-                return
-
-        data = {"content": message}
-        response = requests.post(self._webhook_url, json=data)
-
-        self._last_send_failure[topic] = datetime.utcnow()
-        if topic in self._last_send_success:
-            del self._last_send_success[topic]
+        self._post(topic, message, True, self._min_resend_error_time)
 
-    # noinspection DuplicatedCode
     def post_success_message(self, topic, message):
         logger.debug(f"Sending success message. topic: {topic}, message: {message}")
-        if topic in self._last_send_success:
-            last_success_sent_diff = datetime.utcnow() - self._last_send_success[topic]
-            logger.debug(f"Last success message sent {last_success_sent_diff}")
-            if last_success_sent_diff < self._min_resend_success_time:
-                logger.debug(f"Skipping sent {last_success_sent_diff} < {self._min_resend_success_time}")
+        self._post(topic, message, False, self._min_resend_success_time)
+
+    def _post(self, topic, message, failure, min_resend_time):
+        """Repeated message of unchanged state is skipped within min_resend_time, change of state is always queued"""
+        now = time.monotonic()
+        last_state = self._last_state.get(topic)
+        if last_state and last_state[0] == failure:
+            last_sent_diff = timedelta(seconds=now - last_state[1])
+            logger.debug(f"Last {'failure' if failure else 'success'} message sent {last_sent_diff}")
+            if last_sent_diff < min_resend_time:
+                logger.debug(f"Skipping sent {last_sent_diff} < {min_resend_time}")
                 return
+        self._last_state[topic] = (failure, now)
+        self._enqueue(topic, message)
+
+    def _enqueue(self, topic, message):
+        if topic not in self._pending and len(self._pending) >= self._max_pending_topics:
+            oldest_topic = next(iter(self._pending))
+            logger.warning(f"Notification queue full, dropping messages for topic {oldest_topic}")
+            del self._pending[oldest_topic]
+            self._merged_count.pop(oldest_topic, None)
+            self._pending_since.pop(oldest_topic, None)
+
+        self._pending_since.setdefault(topic, time.monotonic())
+        messages = self._pending.setdefault(topic, [])
+        if len(messages) >= self._max_messages_per_topic:
+            # keep the first message (what started the burst) and the newest ones,
+            # with room for one message only the newest (current state) is kept
+            del messages[min(1, len(messages) - 1)]
+            self._merged_count[topic] = self._merged_count.get(topic, 0) + 1
+        messages.append(message)
+        self._wakeup.set()
+
+    @staticmethod
+    def _format_digest(topic, messages, merged_count):
+        if len(messages) == 1 and not merged_count:
+            content = messages[0]
+        else:
+            content = f"{len(messages) + merged_count} notifications for {topic}:\n" + "\n".join(messages)
+            if merged_count:
+                content += f"\n({merged_count} more notifications omitted)"
+        if len(content) > MAX_MESSAGE_LENGTH:
+            content = content[:MAX_MESSAGE_LENGTH - 3] + "..."
+        return content
 
-        data = {"content": message}
-        response = requests.post(self._webhook_url, json=data)
+    def _due(self, topic):
+        """Time the pending digest of topic is sent: coalesce window after its first message, not before hold ends"""
+        return max(self._pending_since[topic] + self._coalesce_window.total_seconds(),
+                   self._hold_until.get(topic, 0.0))
 
-        self._last_send_success[topic] = datetime.utcnow()
-        if topic in self._last_send_failure:
-            del self._last_send_failure[topic]
+    async def _sender_loop(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = {topic: self._due(topic) for topic in self._pending}
+            if not due or min(due.values()) > now:
+                # woken up early by new message, due times are computed again
+                timeout = min(due.values()) - now if due else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for topic in [topic for topic, topic_due in due.items() if topic_due <= now]:
+                messages = self._pending.pop(topic)
+                merged_count = self._merged_count.pop(topic, 0)
+                del self._pending_since[topic]
+                failure = self._last_state[topic][0]
+                hold = self._min_resend_error_time if failure else self._min_resend_success_time
+                self._hold_until[topic] = time.monotonic() + hold.total_seconds()
+                try:
+                    await self._send(self._format_digest(topic, messages, merged_count))
+                except Exception as ex:
+                    logger.error(f"Failed to send discord message for topic {topic}: {ex}")
+
+    async def _send(self, content):
+        backoff = 1.0
+        for attempt in range(self._max_send_retries):
+            async with self._session.post(self._webhook_url, json={"content": content}) as resp:
+                if resp.status == 429:
+                    body = await resp.json(content_type=None)
+                    retry_after = float(body.get("retry_after", resp.headers.get("Retry-After", backoff)))
+                    logger.warning(f"Discord rate limit hit, retrying after {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                    continue
+                if resp.status >= 500:
+                    logger.warning(f"Discord returned {resp.status}, retrying after {backoff}s")
+                    await asyncio.sleep(backoff)
+                    backoff *= 2
+                    continue
+                if resp.status >= 400:
+                    logger.error(f"Discord rejected message with status {resp.status}: {await resp.text()}")
+                    return
+                # bucket exhausted, wait until it resets instead of running into 429
+                if resp.headers.get("X-RateLimit-Remaining") == "0":
+                    await asyncio.sleep(float(resp.headers.get("X-RateLimit-Reset-After", 0)))
+                return
+        logger.error(f"Giving up sending discord message after {self._max_send_retries} attempts")
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import requests
 import logging
 
@@ -10,12 +12,92 @@ class CheckEndpointException(Exception):
     pass
 
 
-def check_endpoint_health(endpoint, expected_instances_count):
-    resp = requests.get(endpoint)
+# keys under which instance entry may carry its own rpc url, used for direct probing
+INSTANCE_URL_KEYS = ("url", "endpoint")
+
+
+def instance_url(instance):
+    """Rpc url of the instance entry returned by gateway, None if it does not expose one"""
+    return next((instance[key] for key in INSTANCE_URL_KEYS if key in instance), None)
+
+
+def _decode(content, sample, timing):
+    if timing:
+        timing.body_read(sample)
+    data = json.loads(content)
+    if timing:
+        timing.decoded(sample)
+        timing.finish(sample)
+    return data
+
+
+def check_endpoint_health(endpoint, expected_instances_count, timeout=None):
+    resp = requests.get(endpoint, timeout=timeout)
     if resp.status_code != 200:
         raise CheckEndpointException(f"Endpoint {endpoint} returned {resp.status_code}")
     data = resp.json()
 
+    return parse_endpoint_health(data, expected_instances_count)
+
+
+async def probe_instance_head(session, url, timing=None):
+    call_data = {
+        "jsonrpc": "2.0",
+        "method": "eth_getBlockByNumber",
+        "params": ["latest", False],
+        "id": 1
+    }
+    sample = timing.sample() if timing else None
+    try:
+        async with session.post(url, json=call_data, trace_request_ctx=sample) as resp:
+            if resp.status != 200:
+                return {"error": f"Instance {url} returned {resp.status}"}
+            content = await resp.read()
+        rpc_resp = _decode(content, sample, timing)
+        if "error" in rpc_resp:
+            return {"error": rpc_resp["error"]}
+        block = rpc_resp["result"]
+        return {
+            "timestamp": int(block["timestamp"], 0),
+            "number": int(block["number"], 0),
+        }
+    except asyncio.TimeoutError:
+        return {"error": f"Instance {url} timed out"}
+    except Exception as ex:
+        return {"error": f"Instance {url} probe failed: {ex}"}
+
+
+async def check_endpoint_health_async(session, endpoint, expected_instances_count, probe_instances=False,
+                                      timing=None):
+    """
+    Non-blocking version of check_endpoint_health, deadlines are taken from the session timeout.
+    With probe_instances every instance exposing its url is asked for its head block directly
+    (all of them in parallel) instead of trusting block_info cached by the gateway.
+    Phases of requests are recorded in timing (RequestTiming), if given
+    """
+    sample = timing.sample() if timing else None
+    async with session.get(endpoint, trace_request_ctx=sample) as resp:
+        if resp.status != 200:
+            raise CheckEndpointException(f"Endpoint {endpoint} returned {resp.status}")
+        content = await resp.read()
+    data = _decode(content, sample, timing)
+
+    if probe_instances:
+        probed = {}
+        for instance_id, instance in data["instances"].items():
+            url = instance_url(instance)
+            if url:
+                probed[instance_id] = probe_instance_head(session, url, timing)
+            else:
+                logger.warning(f"Instance {instance_id} has no url, using block info from gateway")
+        results = await asyncio.gather(*probed.values())
+        for instance_id, block_info in zip(probed, results):
+            data["instances"][instance_id]["block_info"] = block_info
+
+    return parse_endpoint_health(data, expected_instances_count)
+
+
+def parse_endpoint_health(data, expected_instances_count):
     if len(data["instances"]) != expected_instances_count:
         raise CheckEndpointException(f"Number of instances should be {expected_instances_count}")
 
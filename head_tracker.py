@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from golem_rpc_endpoint_check import instance_url
+from latency_histogram import LatencyHistogram
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# keys under which instance entry may carry its websocket url, otherwise it is derived from rpc url
+INSTANCE_WS_URL_KEYS = ("ws_url", "ws")
+# number of recent blocks for which the first appearance is remembered
+SEEN_BLOCKS_SIZE = 256
+# lag of instances that do not report new heads is evaluated this often (in seconds)
+EVALUATE_INTERVAL = 0.25
+# how long instance is polled over http before websocket subscription is tried again (in seconds)
+WS_RETRY_INTERVAL = 60
+# how often the list of instances is refreshed from the gateway (in seconds)
+DISCOVER_INTERVAL = 60
+
+
+def _ws_url(instance, rpc_url):
+    ws_url = next((instance[key] for key in INSTANCE_WS_URL_KEYS if key in instance), None)
+    if ws_url:
+        return ws_url
+    if rpc_url.startswith("https://"):
+        return "wss://" + rpc_url[len("https://"):]
+    if rpc_url.startswith("http://"):
+        return "ws://" + rpc_url[len("http://"):]
+    return None
+
+
+# Head of single instance as seen by the tracker
+class InstanceHead:
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        # "ws" or "http", depending on how heads are currently received
+        self.source = None
+        self.number = None
+        self.hash = None
+        self.seen_at = None
+        # how long after the first instance this one reported the same block
+        self.propagation = LatencyHistogram()
+        self.lag_blocks = 0
+        self.lag_ms = 0.0
+        self.lagging = False
+        self.error = None
+
+    def summary(self):
+        return {
+            "instance": self.instance_id,
+            "source": self.source,
+            "number": self.number,
+            "seen_at": self.seen_at,
+            "lag_blocks": self.lag_blocks,
+            "lag_ms": self.lag_ms,
+            "propagation_p50": self.propagation.percentile(50),
+            "propagation_p99": self.propagation.percentile(99),
+            "lagging": self.lagging,
+            "error": self.error,
+        }
+
+
+# Follows heads of all instances behind the gateway, independently of the check interval.
+# Every instance is subscribed to newHeads over websocket, polled over http when subscription is not possible.
+# Lag of the instance is the number of blocks it is behind the best head and the time since the first block
+# it is missing appeared on any other instance. Instance over max_lag_blocks or max_lag_time is reported
+# to on_lag_change, and again when it gets below half of the limits. Every new head is reported to on_head
+class HeadTracker:
+    def __init__(self, endpoint, max_lag_blocks, max_lag_time, poll_interval, on_head=None, on_lag_change=None):
+        self._endpoint = endpoint
+        self._max_lag_blocks = max_lag_blocks
+        self._max_lag_ms = max_lag_time * 1000.0
+        self._poll_interval = poll_interval
+        self._on_head = on_head
+        self._on_lag_change = on_lag_change
+        self._session = None
+        self.heads = {}
+        self._followers = {}
+        # block hash -> monotonic time it was first reported by any instance
+        self._first_seen = {}
+        # block number -> monotonic time first block of this number was reported
+        self._first_seen_number = {}
+
+    def summary(self):
+        return [head.summary() for _, head in sorted(self.heads.items())]
+
+    def _remember(self, seen, key, now):
+        if key not in seen:
+            seen[key] = now
+            if len(seen) > SEEN_BLOCKS_SIZE:
+                # dicts keep insertion order, the oldest entry goes first
+                del seen[next(iter(seen))]
+        return seen[key]
+
+    def report_head(self, instance_id, number, block_hash, source):
+        head = self.heads.get(instance_id)
+        if head is None or block_hash == head.hash:
+            return
+        now = time.monotonic()
+        first_seen = self._remember(self._first_seen, block_hash, now)
+        self._remember(self._first_seen_number, number, now)
+        propagation_delay = now - first_seen
+        head.propagation.record(propagation_delay)
+        head.number = number
+        head.hash = block_hash
+        head.seen_at = time.time()
+        head.source = source
+        head.error = None
+        self._evaluate(now)
+        if self._on_head:
+            self._on_head(self, head, propagation_delay)
+
+    def _evaluate(self, now):
+        numbers = [head.number for head in self.heads.values() if head.number is not None]
+        if not numbers:
+            return
+        best = max(numbers)
+        for head in self.heads.values():
+            if head.number is None:
+                continue
+            head.lag_blocks = best - head.number
+            # only remembered blocks are looked at, instance may be millions of blocks behind
+            missing_since = [first_seen for number, first_seen in self._first_seen_number.items()
+                             if head.number < number <= best]
+            head.lag_ms = (now - min(missing_since)) * 1000.0 if missing_since else 0.0
+
+            if head.lagging:
+                # instance has to get well below the limits to catch up, so lag hovering around them does not flap
+                lagging = head.lag_blocks > self._max_lag_blocks // 2 or head.lag_ms > self._max_lag_ms / 2
+            else:
+                lagging = head.lag_blocks > self._max_lag_blocks or head.lag_ms > self._max_lag_ms
+            if lagging == head.lagging:
+                continue
+            head.lagging = lagging
+            if lagging:
+                message = (f"Instance {head.instance_id} lags {head.lag_blocks} blocks "
+                           f"({head.lag_ms / 1000:.1f}s) behind head {best}")
+            else:
+                message = f"Instance {head.instance_id} caught up with head {best}"
+            logger.warning(message)
+            if self._on_lag_change:
+                self._on_lag_change(self, head, message)
+
+    async def _evaluate_loop(self):
+        while True:
+            await asyncio.sleep(EVALUATE_INTERVAL)
+            self._evaluate(time.monotonic())
+
+    async def _follow_ws(self, instance_id, ws_url):
+        async with self._session.ws_connect(ws_url, heartbeat=30) as ws:
+            await ws.send_json({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]})
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                data = json.loads(msg.data)
+                if "error" in data:
+                    raise Exception(f"Subscription rejected: {data['error']}")
+                if data.get("method") == "eth_subscription":
+                    header = data["params"]["result"]
+                    self.report_head(instance_id, int(header["number"], 0), header["hash"], "ws")
+        raise Exception("Subscription closed")
+
+    async def _poll(self, instance_id, rpc_url):
+        call_data = {"jsonrpc": "2.0", "method": "eth_getBlockByNumber", "params": ["latest", False], "id": 1}
+        while True:
+            try:
+                async with self._session.post(rpc_url, json=call_data) as resp:
+                    if resp.status != 200:
+                        raise Exception(f"returned {resp.status}")
+                    rpc_resp = await resp.json(content_type=None)
+                if "error" in rpc_resp:
+                    raise Exception(rpc_resp["error"])
+                block = rpc_resp["result"]
+                self.report_head(instance_id, int(block["number"], 0), block["hash"], "http")
+            except Exception as ex:
+                self.heads[instance_id].error = f"Polling {rpc_url} failed: {ex}"
+            await asyncio.sleep(self._poll_interval)
+
+    async def _follow(self, instance_id, rpc_url, ws_url):
+        while True:
+            if ws_url:
+                try:
+                    await self._follow_ws(instance_id, ws_url)
+                except Exception as ex:
+                    logger.warning(f"No head subscription for instance {instance_id}, polling it instead: {ex}")
+                    self.heads[instance_id].error = f"Subscription failed: {ex}"
+                try:
+                    await asyncio.wait_for(self._poll(instance_id, rpc_url), WS_RETRY_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._poll(instance_id, rpc_url)
+
+    async def _discover(self):
+        async with self._session.get(self._endpoint) as resp:
+            if resp.status != 200:
+                raise Exception(f"Endpoint {self._endpoint} returned {resp.status}")
+            data = await resp.json(content_type=None)
+
+        for instance_id, instance in data["instances"].items():
+            if instance_id in self._followers:
+                continue
+            rpc_url = instance_url(instance)
+            if not rpc_url:
+                logger.warning(f"Instance {instance_id} has no url, its head can not be tracked")
+                continue
+            logger.info(f"Tracking head of instance {instance_id} ({rpc_url})")
+            self.heads[instance_id] = InstanceHead(instance_id)
+            self._followers[instance_id] = asyncio.create_task(
+                self._follow(instance_id, rpc_url, _ws_url(instance, rpc_url)))
+
+        for instance_id in list(self._followers):
+            if instance_id not in data["instances"]:
+                logger.info(f"Instance {instance_id} is gone, not tracking its head anymore")
+                self._followers.pop(instance_id).cancel()
+                del self.heads[instance_id]
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(connect=5, sock_read=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self._session = session
+            evaluator = asyncio.create_task(self._evaluate_loop())
+            try:
+                while True:
+                    try:
+                        await self._discover()
+                    except Exception as ex:
+                        logger.error(f"Failed to get instances from {self._endpoint}: {ex}")
+                    await asyncio.sleep(DISCOVER_INTERVAL)
+            finally:
+                evaluator.cancel()
+                for follower in self._followers.values():
+                    follower.cancel()
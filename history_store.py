@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+from array import array
+
+from client_info import ClientNetworkInfo, RESOLUTIONS
+from latency_histogram import BUCKET_COUNT
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# last byte is the format version
+FILE_MAGIC = b"GRMH\x02"
+
+RECORD_NETWORK = 1
+RECORD_BUCKET = 2
+
+# type, network id, name length, followed by utf-8 name
+NETWORK_HEADER = struct.Struct("<BHH")
+# type, network id, resolution (0 for all time totals), slot, request count, failed count, backup count,
+# latency total, latency max (us), number of non empty latency buckets followed by (index, count) pairs
+BUCKET_HEADER = struct.Struct("<BHIqQQQQqH")
+LATENCY_PAIR = struct.Struct("<HQ")
+
+# resolution -> attribute of ClientInfo with its time series
+RESOLUTION_ATTRIBUTES = {resolution: attribute for resolution, attribute, _ in RESOLUTIONS}
+
+
+def _pack_bucket(network_id, resolution, slot, bucket):
+    latency = bucket.latency
+    pairs = [(idx, count) for idx, count in enumerate(latency.counts) if count]
+    return BUCKET_HEADER.pack(RECORD_BUCKET, network_id, resolution, slot,
+                              bucket.request_count, bucket.request_failed_count, bucket.request_backup_count,
+                              latency.total, latency.max_us, len(pairs)) + \
+        b"".join(LATENCY_PAIR.pack(idx, count) for idx, count in pairs)
+
+
+# Append-only binary log of ClientInfo buckets.
+# Every flush appends records of buckets that could have changed since previous flush,
+# on restore the last record of given bucket wins. When the log grows much bigger than the data
+# it describes, it is rewritten with only live buckets
+class HistoryStore:
+    def __init__(self, path, client_info, flush_interval=5.0, compact_ratio=10):
+        self._path = path
+        self._client_info = client_info
+        self._flush_interval = flush_interval
+        self._compact_ratio = compact_ratio
+        self._network_ids = {}
+        self._last_flush_time = 0
+        self._records_in_file = 0
+        self._compact_pending = False
+
+    def _network_id(self, network_name, new_names):
+        network_id = self._network_ids.get(network_name)
+        if network_id is None:
+            network_id = len(self._network_ids)
+            self._network_ids[network_name] = network_id
+            encoded = network_name.encode("utf-8")
+            new_names.append(NETWORK_HEADER.pack(RECORD_NETWORK, network_id, len(encoded)) + encoded)
+        return network_id
+
+    def restore(self):
+        if not os.path.exists(self._path):
+            logger.info(f"History file {self._path} not found, starting with empty history")
+            return
+        start = time.perf_counter()
+        with open(self._path, "rb") as f:
+            data = f.read()
+        if data.startswith(FILE_MAGIC[:-1]) and not data.startswith(FILE_MAGIC):
+            # counters of version 1 were 32 bit, the file is rewritten on first flush
+            logger.warning(f"History file {self._path} has old format, starting with empty history")
+            self._compact_pending = True
+            return
+        if not data.startswith(FILE_MAGIC):
+            raise Exception(f"File {self._path} is not a history file")
+
+        client_info = self._client_info
+        names = {}
+        offset = len(FILE_MAGIC)
+        records = 0
+        while offset < len(data):
+            record_type = data[offset]
+            if record_type == RECORD_NETWORK:
+                if offset + NETWORK_HEADER.size > len(data):
+                    break
+                _, network_id, name_len = NETWORK_HEADER.unpack_from(data, offset)
+                offset += NETWORK_HEADER.size
+                names[network_id] = data[offset:offset + name_len].decode("utf-8")
+                offset += name_len
+            elif record_type == RECORD_BUCKET:
+                if offset + BUCKET_HEADER.size > len(data):
+                    break
+                (_, network_id, resolution, slot, request_count, failed_count, backup_count,
+                 latency_total, latency_max, pair_count) = BUCKET_HEADER.unpack_from(data, offset)
+                record_end = offset + BUCKET_HEADER.size + pair_count * LATENCY_PAIR.size
+                if record_end > len(data):
+                    break
+                network_name = names[network_id]
+                if resolution == 0:
+                    bucket = client_info.networks.get(network_name)
+                    if bucket is None:
+                        bucket = ClientNetworkInfo()
+                        client_info.networks[network_name] = bucket
+                else:
+                    time_buckets = getattr(client_info, RESOLUTION_ATTRIBUTES[resolution])
+                    time_series = client_info.get_time_series(time_buckets, network_name, resolution)
+                    idx = slot % time_series.size
+                    if time_series.slots[idx] > slot:
+                        offset = record_end
+                        continue
+                    time_series.slots[idx] = slot
+                    bucket = time_series.bucket_at(idx)
+                bucket.reset()
+                bucket.request_count = request_count
+                bucket.request_failed_count = failed_count
+                bucket.request_backup_count = backup_count
+                if latency_total:
+                    latency = bucket.latency if resolution == 0 else time_series.latency(idx)
+                    latency.counts = array("Q", bytes(8 * BUCKET_COUNT))
+                    for pair_idx, count in LATENCY_PAIR.iter_unpack(
+                            data[offset + BUCKET_HEADER.size:record_end]):
+                        latency.counts[pair_idx] = count
+                    latency.total = latency_total
+                    latency.max_us = latency_max
+                offset = record_end
+            else:
+                break
+            records += 1
+
+        if offset < len(data):
+            logger.warning(f"History file {self._path} has {len(data) - offset} bytes of incomplete data at the end")
+
+        self._records_in_file = records
+        # rewrite everything on first flush, it also drops incomplete tail
+        self._compact_pending = True
+        logger.info(f"Restored {records} history records from {self._path} "
+                    f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def _collect(self, since, now):
+        """Serializes buckets that could have changed since given time (all live buckets if since is 0)"""
+        client_info = self._client_info
+        new_names = []
+        records = []
+        for network_name, bucket in client_info.networks.items():
+            records.append(_pack_bucket(self._network_id(network_name, new_names), 0, 0, bucket))
+
+        for resolution, attribute, _ in RESOLUTIONS:
+            for network_name, time_series in getattr(client_info, attribute).items():
+                network_id = self._network_id(network_name, new_names)
+                current_slot = now // resolution
+                first_slot = max(since // resolution, current_slot - time_series.size + 1)
+                for slot in range(first_slot, current_slot + 1):
+                    idx = slot % time_series.size
+                    if time_series.slots[idx] == slot:
+                        records.append(_pack_bucket(network_id, resolution, slot, time_series.bucket_at(idx)))
+        return b"".join(new_names + records), len(new_names) + len(records)
+
+    def _append(self, data):
+        with open(self._path, "ab") as f:
+            if f.tell() == 0:
+                f.write(FILE_MAGIC)
+            f.write(data)
+
+    def _rewrite(self, data):
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    async def flush(self):
+        now = int(time.time())
+        loop = asyncio.get_running_loop()
+        merged_since = self._client_info.merged_since
+        self._client_info.merged_since = None
+        if self._compact_pending or \
+                self._records_in_file > self._compact_ratio * max(self._live_records(), 1):
+            self._compact_pending = False
+            self._network_ids = {}
+            data, count = self._collect(0, now)
+            await loop.run_in_executor(None, self._rewrite, data)
+            self._records_in_file = count
+        else:
+            since = self._last_flush_time
+            if merged_since is not None:
+                # seconds merged late (pushed by probes) change buckets older than the last flush
+                since = min(since, merged_since)
+            data, count = self._collect(since, now)
+            await loop.run_in_executor(None, self._append, data)
+            self._records_in_file += count
+        self._last_flush_time = now
+
+    def _live_records(self):
+        client_info = self._client_info
+        return len(client_info.networks) + sum(
+            time_series.size for _, attribute, _ in RESOLUTIONS for time_series in getattr(client_info, attribute).values()
+        )
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.error(f"Failed to write history to {self._path}: {ex}")
@@ -0,0 +1,91 @@
+import math
+from array import array
+
+# HDR-style log-linear buckets over microseconds.
+# Values below 2 * SUB_BUCKET_COUNT are stored exactly, above that every power of two
+# is split into SUB_BUCKET_COUNT linear sub buckets, so relative error is below 1 / SUB_BUCKET_COUNT
+SUB_BUCKET_BITS = 3
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+# about 134 seconds, slower requests are counted in the last bucket
+MAX_TRACKABLE_US = (1 << 27) - 1
+
+
+def bucket_index(value_us):
+    if value_us < 2 * SUB_BUCKET_COUNT:
+        return max(value_us, 0)
+    value_us = min(value_us, MAX_TRACKABLE_US)
+    shift = value_us.bit_length() - SUB_BUCKET_BITS - 1
+    return SUB_BUCKET_COUNT * (shift + 1) + (value_us >> shift) - SUB_BUCKET_COUNT
+
+
+def bucket_range(index):
+    if index < 2 * SUB_BUCKET_COUNT:
+        return index, index
+    shift = index // SUB_BUCKET_COUNT - 1
+    lowest = (index % SUB_BUCKET_COUNT + SUB_BUCKET_COUNT) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+BUCKET_COUNT = bucket_index(MAX_TRACKABLE_US) + 1
+
+
+def _empty_counts():
+    return array("Q", bytes(8 * BUCKET_COUNT))
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "total", "max_us")
+
+    def __init__(self, counts=None, total=0, max_us=0):
+        # allocated on first record, so empty time buckets cost nothing
+        self.counts = counts if counts is not None else []
+        self.total = total
+        self.max_us = max_us
+
+    def record(self, latency_s):
+        value_us = int(latency_s * 1000000)
+        if not self.counts:
+            self.counts = _empty_counts()
+        self.counts[bucket_index(value_us)] += 1
+        self.total += 1
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def merge(self, other):
+        if not other.total:
+            return
+        if not self.counts:
+            self.counts = _empty_counts()
+        counts = self.counts
+        for idx, count in enumerate(other.counts):
+            if count:
+                counts[idx] += count
+        self.total += other.total
+        if other.max_us > self.max_us:
+            self.max_us = other.max_us
+
+    def percentile(self, percent):
+        """Returns latency in milliseconds below which given percent of requests fall, None if empty"""
+        if not self.total:
+            return None
+        rank = max(math.ceil(self.total * percent / 100.0), 1)
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                lowest, highest = bucket_range(idx)
+                return min((lowest + highest) / 2, self.max_us) / 1000.0
+        return self.max_us / 1000.0
+
+    def count_above(self, threshold_s):
+        """Number of recorded values above threshold (up to the resolution of the bucket holding threshold)"""
+        if not self.total:
+            return 0
+        first_idx = bucket_index(int(threshold_s * 1000000)) + 1
+        return sum(self.counts[first_idx:])
+
+    @property
+    def max_ms(self):
+        if not self.total:
+            return None
+        return self.max_us / 1000.0
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from aiohttp import web
+
+from status_snapshot import HISTORY_VIEWS, history_row, target_state
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# changes are collected and pushed at most this often (in seconds)
+PUSH_INTERVAL = 1.0
+# comment is sent to idle streams this often, so proxies do not close them (in seconds)
+KEEPALIVE_INTERVAL = 15.0
+# viewer with more messages waiting than this is too slow, it is disconnected and starts over when it reconnects
+MAX_QUEUED_MESSAGES = 30
+
+KEEPALIVE_MESSAGE = b": keepalive\n\n"
+
+
+def _event(data):
+    return f"data: {json.dumps(data, separators=(',', ':'))}\n\n".encode("utf-8")
+
+
+# Open status page (or other client) subscribed to /api/updates
+class _Viewer:
+    def __init__(self, first_message):
+        self.messages = deque([first_message])
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        self.dropped = False
+
+
+# Pushes changes of monitor state to open status pages over Server-Sent Events.
+# After StatusSnapshot.invalidate() state of every target is compared with the state pushed last time,
+# only changed fields and history buckets are encoded (once) and the same message is queued for every viewer,
+# so the cost grows with the number of changes, not with viewers. New viewer gets the whole pushed state first
+class LiveUpdates:
+    def __init__(self, status):
+        self._status = status
+        self._viewers = set()
+        # target name -> state as last pushed to viewers
+        self._pushed = {}
+        self._full_message = None
+
+    def _history_rows(self, client_info, name, now):
+        """
+        Buckets of every history view changed since the last push: the current one and the ones that started
+        after the newest bucket pushed last time (newest first)
+        """
+        rows = {}
+        if name not in client_info.networks:
+            return rows
+        for attribute, title, time_format in HISTORY_VIEWS:
+            pushed_rows = self._pushed.get(name, {}).get(title)
+            since = pushed_rows[0]["start"] if pushed_rows else now
+            view_rows = []
+            for bucket_start, bucket in getattr(client_info, attribute)[name].history(now):
+                if view_rows and bucket_start < since:
+                    break
+                view_rows.append({**history_row(bucket_start, bucket, time_format), "start": bucket_start})
+            rows[title] = view_rows
+        return rows
+
+    def _delta(self, ctx):
+        now = int(time.time())
+        client_info = ctx['client_info']
+        delta = {}
+        for name, target_ctx in ctx['targets'].items():
+            state = target_state(target_ctx)
+            state.update(self._history_rows(client_info, name, now))
+            pushed = self._pushed.setdefault(name, {})
+            changed = {key: value for key, value in state.items() if pushed.get(key) != value}
+            if changed:
+                pushed.update(changed)
+                delta[name] = changed
+        return delta
+
+    def publish(self, delta):
+        message = _event(delta)
+        self._full_message = None
+        for viewer in list(self._viewers):
+            if len(viewer.messages) >= MAX_QUEUED_MESSAGES:
+                viewer.dropped = True
+                self._viewers.discard(viewer)
+            else:
+                viewer.messages.append(message)
+            viewer.wakeup.set()
+
+    def _update(self, ctx):
+        if 'targets' in ctx:
+            delta = self._delta(ctx)
+            if delta:
+                self.publish(delta)
+
+    async def run(self, ctx):
+        while True:
+            await self._status.changed.wait()
+            self._status.changed.clear()
+            # without viewers nothing is compared
+            if self._viewers:
+                self._update(ctx)
+            await asyncio.sleep(PUSH_INTERVAL)
+
+    async def stream(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        # pushed state is not kept up to date while nobody watches
+        self._update(request.app['context'])
+        if self._full_message is None:
+            self._full_message = _event(self._pushed)
+        viewer = _Viewer(self._full_message)
+        self._viewers.add(viewer)
+        try:
+            while not viewer.dropped:
+                try:
+                    await asyncio.wait_for(viewer.wakeup.wait(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(KEEPALIVE_MESSAGE)
+                    continue
+                viewer.wakeup.clear()
+                while viewer.messages:
+                    await response.write(viewer.messages.popleft())
+        except ConnectionResetError:
+            pass
+        finally:
+            self._viewers.discard(viewer)
+        if viewer.dropped:
+            logger.info(f"Live update viewer {request.remote} is too slow, disconnecting it")
+        return response
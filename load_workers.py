@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from base_load import (add_method_stats, get_checked_block, merge_method_latency, send_burst, send_open_loop,
+                       set_burst_results, set_open_loop_results)
+from latency_histogram import LatencyHistogram
+from request_timing import RequestTiming
+from rpc_client import RpcClient
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# how often workers send partial results of running jobs to the parent (in seconds)
+PROGRESS_INTERVAL = 0.5
+
+
+def _split(total, parts):
+    return [total // parts + (1 if idx < total % parts else 0) for idx in range(parts)]
+
+
+def _take_stats(stats):
+    """Moves collected results out of stats, running job keeps adding new ones to the emptied dict"""
+    taken = dict(stats)
+    stats.clear()
+    return taken
+
+
+async def _run_job(conn, client, workload, job_id, kind, params):
+    stats = {}
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if stats:
+                conn.send(("progress", job_id, _take_stats(stats)))
+
+    reporter = asyncio.create_task(report_progress())
+    try:
+        workload.set_latest_block(params["latest_block"])
+        if kind == "burst":
+            success, failed = await send_burst(client, workload, params["number_calls"], params["concurrency"],
+                                               params["batch_size"], params["request_timeout"], stats)
+            result = {"succeeded": success, "failed": failed}
+        else:
+            success, failed, dropped, scheduled, achieved_rate = await send_open_loop(
+                client, workload, params["rate"], params["duration"], params["arrival"], params["max_outstanding"],
+                params["request_timeout"], stats)
+            result = {"succeeded": success, "failed": failed, "dropped": dropped, "scheduled": scheduled,
+                      "achieved_rate": achieved_rate}
+    except Exception as ex:
+        conn.send(("error", job_id, str(ex)))
+        return
+    finally:
+        reporter.cancel()
+    result["methods"] = _take_stats(stats)
+    result["connections_created"] = client.connections_created
+    result["connections_reused"] = client.connections_reused
+    result["connect_latency"] = client.take_connect_latency()
+    result["timing"] = client.timing.take()
+    conn.send(("done", job_id, result))
+
+
+async def _worker_loop(conn, worker_idx, target_url, pool_size, dns_cache_ttl, timing_sample_rate, workload):
+    workload.reseed(f"{worker_idx}:{os.getpid()}")
+    client = RpcClient(target_url, pool_size, dns_cache_ttl, timing_sample_rate)
+    commands = asyncio.Queue()
+    # job id -> task
+    jobs = {}
+
+    def on_command():
+        try:
+            commands.put_nowait(conn.recv())
+        except (EOFError, OSError):
+            # parent is gone
+            commands.put_nowait(None)
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.fileno(), on_command)
+    try:
+        while True:
+            command = await commands.get()
+            if command is None:
+                break
+            job_id, kind, params = command
+            if kind == "cancel":
+                # check that started the job was cancelled at its deadline
+                if job_id in jobs:
+                    jobs[job_id].cancel()
+                continue
+            # jobs run concurrently, next open loop window may start while the previous one drains
+            job = asyncio.create_task(_run_job(conn, client, workload, job_id, kind, params))
+            jobs[job_id] = job
+            job.add_done_callback(lambda _, job_id=job_id: jobs.pop(job_id, None))
+    finally:
+        loop.remove_reader(conn.fileno())
+        for job in list(jobs.values()):
+            job.cancel()
+        await client.close()
+
+
+def _worker_main(conn, worker_idx, target_url, pool_size, dns_cache_ttl, timing_sample_rate, workload):
+    # parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_loop(conn, worker_idx, target_url, pool_size, dns_cache_ttl, timing_sample_rate, workload))
+
+
+# Load of one target generated by several worker processes, each with its own event loop and RpcClient,
+# so encoding and decoding of calls is not limited to one core.
+# Workers stream partial per method results while a job runs, they are merged into the target context
+# (and passed to on_progress) as they arrive. Connection counters and request timing are summed over workers
+# like in RpcClient
+class LoadWorkerPool:
+    def __init__(self, target, processes, workload, dns_cache_ttl=300):
+        self._target = target
+        self._processes = processes
+        self._workload = workload
+        self._dns_cache_ttl = dns_cache_ttl
+        # (process, connection) per worker, None if not running
+        self._workers = [None] * processes
+        self._worker_connections = [(0, 0)] * processes
+        self._last_job_id = 0
+        self._jobs = {}
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connect_latency = LatencyHistogram()
+        self._new_connect_latency = LatencyHistogram()
+        self.timing = RequestTiming(target.timing_sample_rate)
+
+    def _start_worker(self, idx):
+        mp_context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = mp_context.Pipe()
+        pool_size = -(-self._target.pool_size // self._processes)
+        process = mp_context.Process(target=_worker_main, name=f"load-{self._target.name}-{idx}", daemon=True,
+                                     args=(child_conn, idx, self._target.target_url, pool_size,
+                                           self._dns_cache_ttl, self._target.timing_sample_rate,
+                                           self._workload))
+        process.start()
+        child_conn.close()
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self._on_message, idx)
+        self._workers[idx] = (process, parent_conn)
+        self._worker_connections[idx] = (0, 0)
+        logger.info(f"Started load worker {idx} of {self._target.name} (pid {process.pid})")
+
+    def _worker_exited(self, idx):
+        process, conn = self._workers[idx]
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        conn.close()
+        self._workers[idx] = None
+        logger.error(f"Load worker {idx} of {self._target.name} exited")
+        for job in self._jobs.values():
+            future = job["futures"].get(idx)
+            if future and not future.done():
+                future.set_exception(Exception(f"Load worker {idx} of {self._target.name} exited"))
+
+    def _add_results(self, job, methods):
+        add_method_stats(job["stats"], methods)
+        if job["on_progress"] and methods:
+            job["on_progress"](merge_method_latency(methods))
+
+    def _on_message(self, idx):
+        try:
+            kind, job_id, payload = self._workers[idx][1].recv()
+        except (EOFError, OSError):
+            self._worker_exited(idx)
+            return
+        job = self._jobs.get(job_id)
+        if job is None:
+            # results of the job that already failed
+            return
+        future = job["futures"][idx]
+        if kind == "progress":
+            self._add_results(job, payload)
+        elif kind == "done":
+            self._add_results(job, payload.pop("methods"))
+            self._worker_connections[idx] = (payload["connections_created"], payload["connections_reused"])
+            self.connections_created = sum(created for created, _ in self._worker_connections)
+            self.connections_reused = sum(reused for _, reused in self._worker_connections)
+            self.connect_latency.merge(payload["connect_latency"])
+            self._new_connect_latency.merge(payload["connect_latency"])
+            self.timing.merge(payload.pop("timing"))
+            if not future.done():
+                future.set_result(payload)
+        elif not future.done():
+            future.set_exception(Exception(f"Load worker {idx} of {self._target.name} failed: {payload}"))
+
+    def take_connect_latency(self):
+        latency = self._new_connect_latency
+        self._new_connect_latency = LatencyHistogram()
+        return latency
+
+    async def _run(self, kind, worker_params, stats, on_progress):
+        """Sends job to workers (worker_params has params for each of them), returns their results"""
+        loop = asyncio.get_running_loop()
+        self._last_job_id += 1
+        job_id = self._last_job_id
+        job = {"futures": {}, "stats": stats, "on_progress": on_progress}
+        self._jobs[job_id] = job
+        try:
+            for idx, params in enumerate(worker_params):
+                if params is None:
+                    continue
+                if self._workers[idx] is None:
+                    self._start_worker(idx)
+                job["futures"][idx] = loop.create_future()
+                self._workers[idx][1].send((job_id, kind, params))
+            return await asyncio.gather(*job["futures"].values())
+        except asyncio.CancelledError:
+            # workers stop sending the load of cancelled check
+            for idx in job["futures"]:
+                if self._workers[idx] is not None:
+                    try:
+                        self._workers[idx][1].send((job_id, "cancel", None))
+                    except OSError:
+                        pass
+            raise
+        finally:
+            del self._jobs[job_id]
+
+    async def burst_call(self, context, client, number_calls, concurrency=1, batch_size=1, request_timeout=None,
+                         on_progress=None):
+        """
+        Same as base_load.burst_call with calls and concurrency split between workers.
+        Concurrency lower than number of processes leaves some workers idle, so it is never exceeded.
+        client is used only to check the latest block
+        """
+        block_checked = await get_checked_block(context, client, request_timeout)
+        workers = max(min(self._processes, concurrency), 1)
+        worker_params = [{
+            "latest_block": block_checked + 10,
+            "number_calls": worker_calls,
+            "concurrency": worker_concurrency,
+            "batch_size": batch_size,
+            "request_timeout": request_timeout,
+        } if worker_calls else None
+            for worker_calls, worker_concurrency in zip(_split(number_calls, workers), _split(concurrency, workers))]
+
+        stats = {}
+        context["methods"] = stats
+        start = time.monotonic()
+        results = await self._run("burst", worker_params, stats, on_progress)
+        duration = time.monotonic() - start
+
+        number_of_success_req = sum(result["succeeded"] for result in results)
+        number_of_failed_req = sum(result["failed"] for result in results)
+        set_burst_results(context, stats, duration, number_of_success_req, number_of_failed_req)
+        logger.info(f"Burst took {duration:.3f}s, throughput {context['burst_throughput']:.1f} calls/s "
+                    f"({self._processes} processes, concurrency {concurrency}, batch size {batch_size})")
+        return number_of_success_req, number_of_failed_req
+
+    async def open_loop_call(self, context, client, rate, duration, arrival="constant", max_outstanding=1000,
+                             request_timeout=None, on_progress=None):
+        """
+        Same as base_load.open_loop_call with rate and max_outstanding split between workers.
+        client is used only to check the latest block
+        """
+        block_checked = await get_checked_block(context, client, request_timeout)
+        worker_params = [{
+            "latest_block": block_checked + 10,
+            "rate": rate / self._processes,
+            "duration": duration,
+            "arrival": arrival,
+            "max_outstanding": max(worker_max_outstanding, 1),
+            "request_timeout": request_timeout,
+        } for worker_max_outstanding in _split(max_outstanding, self._processes)]
+
+        stats = {}
+        context["methods"] = stats
+        start = time.monotonic()
+        results = await self._run("open_loop", worker_params, stats, on_progress)
+        elapsed = time.monotonic() - start
+
+        number_of_success_req = sum(result["succeeded"] for result in results)
+        number_of_dropped_req = sum(result["dropped"] for result in results)
+        number_of_failed_req = sum(result["failed"] for result in results) + number_of_dropped_req
+        scheduled = sum(result["scheduled"] for result in results)
+        achieved_rate = sum(result["achieved_rate"] for result in results)
+        set_open_loop_results(context, stats, elapsed, scheduled / duration, achieved_rate,
+                              number_of_success_req, number_of_failed_req, number_of_dropped_req)
+        return number_of_success_req, number_of_failed_req
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        for idx, worker in enumerate(self._workers):
+            if worker is None:
+                continue
+            process, conn = worker
+            loop.remove_reader(conn.fileno())
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+            self._workers[idx] = None
+
+
+# LoadWorkerPool per target, started on first use and stopped on monitor shutdown
+class LoadWorkerPools:
+    def __init__(self, dns_cache_ttl=300):
+        self._dns_cache_ttl = dns_cache_ttl
+        self._pools = {}
+
+    def get(self, target, workload):
+        pool = self._pools.get(target.name)
+        if pool is None:
+            pool = LoadWorkerPool(target, target.load_processes, workload, self._dns_cache_ttl)
+            self._pools[target.name] = pool
+        return pool
+
+    async def close(self):
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools = {}
@@ -0,0 +1,100 @@
+from latency_histogram import BUCKET_COUNT, bucket_range
+
+# upper bounds (in seconds) of histogram buckets exposed to prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _le_index(latency_bucket_idx):
+    lowest, highest = bucket_range(latency_bucket_idx)
+    upper_s = (highest + 1) / 1000000.0
+    for le_idx, le in enumerate(LATENCY_BUCKETS):
+        if upper_s <= le:
+            return le_idx
+    return len(LATENCY_BUCKETS)
+
+
+# every LatencyHistogram bucket is counted in the first prometheus bucket covering it whole (or +Inf)
+LE_INDEX = [_le_index(idx) for idx in range(BUCKET_COUNT)]
+MIDPOINT_S = [sum(bucket_range(idx)) / 2 / 1000000.0 for idx in range(BUCKET_COUNT)]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+# Prometheus text exposition kept up to date incrementally.
+# Every change re-renders only lines of the series it touches, so scrape just joins cached lines
+class Metrics:
+    def __init__(self):
+        # name -> (type, help), in registration order
+        self._families = {}
+        # name -> {labels tuple -> rendered lines}
+        self._lines = {}
+        self._values = {}
+        self._histograms = {}
+
+    def register(self, name, metric_type, help_text):
+        self._families[name] = (metric_type, help_text)
+        self._lines[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + value
+        self._lines[name][labels] = f"{name}{_format_labels(labels)} {_format_value(self._values[key])}\n"
+
+    def set(self, name, labels=(), value=0):
+        self._values[(name, labels)] = value
+        self._lines[name][labels] = f"{name}{_format_labels(labels)} {_format_value(value)}\n"
+
+    def observe(self, name, labels, latency):
+        """Adds all values recorded in LatencyHistogram to prometheus histogram"""
+        if not latency.total:
+            return
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = _Histogram()
+            self._histograms[key] = histogram
+        for idx, count in enumerate(latency.counts):
+            if count:
+                histogram.counts[LE_INDEX[idx]] += count
+                histogram.sum += MIDPOINT_S[idx] * count
+        histogram.count += latency.total
+
+        lines = []
+        cumulative = 0
+        for le, count in zip(LATENCY_BUCKETS + (float("inf"),), histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(le)),))} {cumulative}\n")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum!r}\n")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}\n")
+        self._lines[name][labels] = "".join(lines)
+
+    def render(self):
+        parts = []
+        for name, (metric_type, help_text) in self._families.items():
+            series = self._lines[name]
+            if not series:
+                continue
+            parts.append(f"# HELP {name} {help_text}\n# TYPE {name} {metric_type}\n")
+            parts.extend(series.values())
+        return "".join(parts)
@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import random
+import time
+from dataclasses import dataclass
+
+from aiohttp import WSMsgType, web
+
+from env_default import EnvDefault
+from workload import ERC20_TRANSFER_TOPIC
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+# eth_getLogs over more blocks than this is rejected, as most of the public nodes do
+MAX_LOGS_BLOCK_RANGE = 10000
+TXS_PER_BLOCK = 5
+# how often websocket subscriptions check for new head (in seconds)
+HEAD_PUSH_INTERVAL = 0.05
+
+
+def _hash(text):
+    return "0x" + hashlib.sha256(text.encode()).hexdigest()
+
+
+def _address(text):
+    return "0x" + hashlib.sha256(text.encode()).hexdigest()[-40:]
+
+
+# Behaviour of the mock, defaults answer every call immediately and correctly
+@dataclass
+class MockNodeConfig:
+    latency_distribution: str = "constant"
+    # mean latency of single http request (whole batch is answered after one delay)
+    latency_ms: float = 0.0
+    # spread of lognormal distribution
+    latency_sigma: float = 0.5
+    # fraction of calls answered with json-rpc error
+    error_rate: float = 0.0
+    # fraction of http requests answered with 503
+    http_error_rate: float = 0.0
+    # fraction of http requests never answered (until client gives up)
+    hang_rate: float = 0.0
+    # head stops advancing after this many seconds (0 - never)
+    stall_after: float = 0.0
+    # batches bigger than this are rejected with 413 (0 - no limit)
+    max_batch_size: int = 0
+    block_time: float = 2.0
+    # time of start_block, 0 - when the mock starts
+    genesis_time: float = 0.0
+    start_block: int = 30000000
+    # gateway /instances shape
+    instances: int = 3
+    lagging_instances: int = 0
+    lag_blocks: int = 20
+    failing_instances: int = 0
+    # instances on their own fork of the chain, starting at fork_block
+    forked_instances: int = 0
+    fork_block: int = 0
+    # instances without websocket, followed over http only
+    no_ws_instances: int = 0
+
+
+# Deterministic chain: block n, its transactions, transfer logs and holder balances are derived from n,
+# so the same call always returns the same result and any block range can be queried without storing anything
+class MockChain:
+    def __init__(self, config):
+        self._config = config
+        self._started = config.genesis_time or time.time()
+
+    def head(self, lag_blocks=0):
+        elapsed = time.time() - self._started
+        if self._config.stall_after:
+            elapsed = min(elapsed, self._config.stall_after)
+        return self._config.start_block + int(elapsed / self._config.block_time) - lag_blocks
+
+    def _fork_prefix(self, number, forked):
+        return "fork:" if forked and number >= (self._config.fork_block or self._config.start_block) else ""
+
+    def block(self, number, full_transactions=False, forked=False):
+        timestamp = int(self._started + (number - self._config.start_block) * self._config.block_time)
+        prefix = self._fork_prefix(number, forked)
+        tx_hashes = [_hash(f"{prefix}tx:{number}:{idx}") for idx in range(TXS_PER_BLOCK)]
+        return {
+            "number": hex(number),
+            "hash": _hash(f"{prefix}block:{number}"),
+            "parentHash": _hash(f"{self._fork_prefix(number - 1, forked)}block:{number - 1}"),
+            "timestamp": hex(timestamp),
+            "transactions": [self.transaction(tx_hash, number) for tx_hash in tx_hashes]
+            if full_transactions else tx_hashes,
+        }
+
+    @staticmethod
+    def transaction(tx_hash, block_number):
+        return {"hash": tx_hash, "blockNumber": hex(block_number), "from": _address(f"from:{tx_hash}"),
+                "to": _address(f"to:{tx_hash}"), "value": "0x0"}
+
+    @staticmethod
+    def logs(address, from_block, to_block):
+        logs = []
+        for number in range(from_block, to_block + 1):
+            tx_hash = _hash(f"tx:{number}:0")
+            logs.append({
+                "address": address,
+                "blockNumber": hex(number),
+                "transactionHash": tx_hash,
+                "logIndex": "0x0",
+                "topics": [
+                    ERC20_TRANSFER_TOPIC,
+                    "0x" + "0" * 24 + _address(f"from:{tx_hash}")[2:],
+                    "0x" + "0" * 24 + _address(f"to:{tx_hash}")[2:],
+                ],
+                "data": "0x" + hashlib.sha256(tx_hash.encode()).hexdigest(),
+            })
+        return logs
+
+    def balance(self, token, holder, number=0, forked=False):
+        prefix = self._fork_prefix(number, forked)
+        return "0x" + hashlib.sha256(f"{prefix}{token}:{holder.lower()}".encode()).hexdigest()
+
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+# JSON-RPC node and gateway stand-in.
+# POST / answers eth_* calls from the chain head, POST /instance/{id} from the head of single gateway instance
+# (GET /instance/{id} is its websocket with newHeads subscription),
+# GET /instances returns the json checked by check_endpoint_health
+class MockNode:
+    def __init__(self, config=None, seed=None):
+        self.config = config or MockNodeConfig()
+        if self.config.latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise Exception(f"Unknown latency distribution {self.config.latency_distribution}, "
+                            f"possible values: {LATENCY_DISTRIBUTIONS}")
+        self.chain = MockChain(self.config)
+        self._random = random.Random(seed)
+        self.requests_served = 0
+        self.calls_served = 0
+
+    def _instance_ids(self):
+        return [f"instance_{idx}" for idx in range(self.config.instances)]
+
+    def _instance_lag(self, instance_id):
+        idx = int(instance_id.rsplit("_", 1)[1])
+        return self.config.lag_blocks if idx < self.config.lagging_instances else 0
+
+    def _instance_failing(self, instance_id):
+        idx = int(instance_id.rsplit("_", 1)[1])
+        return idx >= self.config.instances - self.config.failing_instances
+
+    def _instance_forked(self, instance_id):
+        idx = int(instance_id.rsplit("_", 1)[1])
+        return self.config.lagging_instances <= idx < self.config.lagging_instances + self.config.forked_instances
+
+    def _instance_no_ws(self, instance_id):
+        idx = int(instance_id.rsplit("_", 1)[1])
+        first_failing = self.config.instances - self.config.failing_instances
+        return first_failing - self.config.no_ws_instances <= idx < first_failing
+
+    def _latency(self):
+        mean = self.config.latency_ms / 1000.0
+        if mean <= 0:
+            return 0.0
+        distribution = self.config.latency_distribution
+        if distribution == "uniform":
+            return self._random.uniform(0, 2 * mean)
+        if distribution == "exponential":
+            return self._random.expovariate(1.0 / mean)
+        if distribution == "lognormal":
+            sigma = self.config.latency_sigma
+            return self._random.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+        return mean
+
+    def _block_param(self, param, head):
+        if param in ("latest", "pending", "safe", "finalized"):
+            return head
+        if param == "earliest":
+            return 0
+        return int(param, 0)
+
+    def _answer(self, method, params, head, forked=False):
+        if method == "eth_blockNumber":
+            return hex(head)
+        if method == "eth_chainId":
+            return "0x89"
+        if method == "net_version":
+            return "137"
+        if method == "eth_gasPrice":
+            return hex(30000000000 + self._random.randrange(1000000000))
+        if method == "eth_getBlockByNumber":
+            number = self._block_param(params[0], head)
+            return self.chain.block(number, params[1], forked) if number <= head else None
+        if method == "eth_getBalance":
+            number = self._block_param(params[1], head)
+            return self.chain.balance("native", params[0], number, forked)
+        if method == "eth_call":
+            data = params[0].get("data", "")
+            if len(data) < 74:
+                return "0x"
+            number = self._block_param(params[1], head)
+            return self.chain.balance(params[0]["to"], "0x" + data[-40:], number, forked)
+        if method == "eth_getLogs":
+            log_filter = params[0]
+            to_block = min(self._block_param(log_filter.get("toBlock", "latest"), head), head)
+            from_block = self._block_param(log_filter.get("fromBlock", "latest"), head)
+            if to_block - from_block >= MAX_LOGS_BLOCK_RANGE:
+                raise RpcError(-32005, f"query exceeds max block range {MAX_LOGS_BLOCK_RANGE}")
+            return self.chain.logs(log_filter.get("address"), from_block, to_block)
+        if method == "eth_getTransactionReceipt":
+            # the same receipt from every instance, no matter its head
+            return {"transactionHash": params[0], "blockNumber": hex(self.config.start_block), "status": "0x1",
+                    "gasUsed": "0x5208", "logs": []}
+        raise RpcError(-32601, f"the method {method} does not exist/is not available")
+
+    def _call(self, call, head, forked=False):
+        self.calls_served += 1
+        response = {"jsonrpc": "2.0", "id": call.get("id")}
+        try:
+            if self._random.random() < self.config.error_rate:
+                raise RpcError(-32000, "injected error")
+            response["result"] = self._answer(call.get("method"), call.get("params", []), head, forked)
+        except RpcError as ex:
+            response["error"] = {"code": ex.code, "message": str(ex)}
+        except Exception as ex:
+            response["error"] = {"code": -32602, "message": f"invalid params: {ex}"}
+        return response
+
+    async def _delay(self):
+        if self._random.random() < self.config.hang_rate:
+            await asyncio.sleep(3600)
+        delay = self._latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _rpc_response(self, request, head, forked=False):
+        self.requests_served += 1
+        await self._delay()
+        if self._random.random() < self.config.http_error_rate:
+            return web.Response(status=503, text="injected http error")
+        body = await request.json()
+        if isinstance(body, list):
+            if self.config.max_batch_size and len(body) > self.config.max_batch_size:
+                return web.Response(status=413, text=f"batch limit is {self.config.max_batch_size}")
+            return web.json_response([self._call(call, head, forked) for call in body])
+        return web.json_response(self._call(body, head, forked))
+
+    async def handle_rpc(self, request):
+        return await self._rpc_response(request, self.chain.head())
+
+    async def handle_instance_rpc(self, request):
+        instance_id = request.match_info["instance_id"]
+        if instance_id not in self._instance_ids():
+            raise web.HTTPNotFound()
+        if self._instance_failing(instance_id):
+            return web.Response(status=502, text="instance unavailable")
+        return await self._rpc_response(request, self.chain.head(self._instance_lag(instance_id)),
+                                        self._instance_forked(instance_id))
+
+    async def _push_heads(self, ws, lag_blocks, forked):
+        last_head = None
+        while True:
+            head = self.chain.head(lag_blocks)
+            if head != last_head:
+                last_head = head
+                block = self.chain.block(head, forked=forked)
+                header = {key: block[key] for key in ("number", "hash", "parentHash", "timestamp")}
+                await ws.send_json({"jsonrpc": "2.0", "method": "eth_subscription",
+                                    "params": {"subscription": "0x1", "result": header}})
+            await asyncio.sleep(HEAD_PUSH_INTERVAL)
+
+    async def handle_instance_ws(self, request):
+        """Websocket json-rpc of the instance, supports newHeads subscription"""
+        instance_id = request.match_info["instance_id"]
+        if instance_id not in self._instance_ids() or self._instance_no_ws(instance_id):
+            raise web.HTTPNotFound()
+        if self._instance_failing(instance_id):
+            return web.Response(status=502, text="instance unavailable")
+        lag_blocks = self._instance_lag(instance_id)
+        forked = self._instance_forked(instance_id)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        pusher = None
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                call = json.loads(msg.data)
+                if call.get("method") == "eth_subscribe" and call.get("params") == ["newHeads"]:
+                    await ws.send_json({"jsonrpc": "2.0", "id": call.get("id"), "result": "0x1"})
+                    if pusher is None:
+                        pusher = asyncio.create_task(self._push_heads(ws, lag_blocks, forked))
+                else:
+                    await ws.send_json(self._call(call, self.chain.head(lag_blocks), forked))
+        finally:
+            if pusher:
+                pusher.cancel()
+        return ws
+
+    async def handle_instances(self, request):
+        self.requests_served += 1
+        await self._delay()
+        base_url = f"{request.scheme}://{request.host}"
+        instances = {}
+        for instance_id in self._instance_ids():
+            if self._instance_failing(instance_id):
+                block_info = {"error": "instance unavailable"}
+            else:
+                head = self.chain.head(self._instance_lag(instance_id))
+                block_info = {"number": head, "timestamp": int(self.chain.block(head)["timestamp"], 0)}
+            instances[instance_id] = {"url": f"{base_url}/instance/{instance_id}", "block_info": block_info}
+        return web.json_response({"instances": instances})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/', self.handle_rpc)
+        app.router.add_post('/instance/{instance_id}', self.handle_instance_rpc)
+        app.router.add_get('/instance/{instance_id}', self.handle_instance_ws)
+        app.router.add_get('/instances', self.handle_instances)
+        return app
+
+
+def serve(config, seed, host, port, reuse_port=False):
+    node = MockNode(config, seed)
+    web.run_app(node.create_app(), host=host, port=port, reuse_port=reuse_port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mock json-rpc node and gateway for local testing')
+    parser.add_argument('--host', dest="host", type=str, help='Address to listen on',
+                        action=EnvDefault, envvar='MOCK_HOST',
+                        default="127.0.0.1")
+    parser.add_argument('--port', dest="port", type=int, help='Port to listen on',
+                        action=EnvDefault, envvar='MOCK_PORT',
+                        default=8545)
+    parser.add_argument('--latency-distribution', dest="latency_distribution", type=str,
+                        help=f'Possible values: {", ".join(LATENCY_DISTRIBUTIONS)}',
+                        action=EnvDefault, envvar='MOCK_LATENCY_DISTRIBUTION',
+                        default="constant")
+    parser.add_argument('--latency-ms', dest="latency_ms", type=float, help='Mean latency of single request',
+                        action=EnvDefault, envvar='MOCK_LATENCY_MS',
+                        default=0.0, required=False)
+    parser.add_argument('--latency-sigma', dest="latency_sigma", type=float,
+                        help='Spread of lognormal latency distribution',
+                        action=EnvDefault, envvar='MOCK_LATENCY_SIGMA',
+                        default=0.5)
+    parser.add_argument('--error-rate', dest="error_rate", type=float,
+                        help='Fraction of calls answered with json-rpc error',
+                        action=EnvDefault, envvar='MOCK_ERROR_RATE',
+                        default=0.0, required=False)
+    parser.add_argument('--http-error-rate', dest="http_error_rate", type=float,
+                        help='Fraction of requests answered with http 503',
+                        action=EnvDefault, envvar='MOCK_HTTP_ERROR_RATE',
+                        default=0.0, required=False)
+    parser.add_argument('--hang-rate', dest="hang_rate", type=float,
+                        help='Fraction of requests never answered',
+                        action=EnvDefault, envvar='MOCK_HANG_RATE',
+                        default=0.0, required=False)
+    parser.add_argument('--stall-after', dest="stall_after", type=float,
+                        help='Head stops advancing after this many seconds (0 - never)',
+                        action=EnvDefault, envvar='MOCK_STALL_AFTER',
+                        default=0.0, required=False)
+    parser.add_argument('--max-batch-size', dest="max_batch_size", type=int,
+                        help='Bigger json-rpc batches are rejected with 413 (0 - no limit)',
+                        action=EnvDefault, envvar='MOCK_MAX_BATCH_SIZE',
+                        default=0, required=False)
+    parser.add_argument('--block-time', dest="block_time", type=float, help='Seconds between blocks',
+                        action=EnvDefault, envvar='MOCK_BLOCK_TIME',
+                        default=2.0)
+    parser.add_argument('--instances', dest="instances", type=int, help='Number of instances behind gateway',
+                        action=EnvDefault, envvar='MOCK_INSTANCES',
+                        default=3)
+    parser.add_argument('--lagging-instances', dest="lagging_instances", type=int,
+                        help='Number of instances behind the chain head',
+                        action=EnvDefault, envvar='MOCK_LAGGING_INSTANCES',
+                        default=0, required=False)
+    parser.add_argument('--lag-blocks', dest="lag_blocks", type=int, help='How far lagging instances are behind',
+                        action=EnvDefault, envvar='MOCK_LAG_BLOCKS',
+                        default=20)
+    parser.add_argument('--failing-instances', dest="failing_instances", type=int,
+                        help='Number of instances reporting error',
+                        action=EnvDefault, envvar='MOCK_FAILING_INSTANCES',
+                        default=0, required=False)
+    parser.add_argument('--forked-instances', dest="forked_instances", type=int,
+                        help='Number of instances on their own fork of the chain',
+                        action=EnvDefault, envvar='MOCK_FORKED_INSTANCES',
+                        default=0, required=False)
+    parser.add_argument('--fork-block', dest="fork_block", type=int,
+                        help='First block of the fork (0 - start block)',
+                        action=EnvDefault, envvar='MOCK_FORK_BLOCK',
+                        default=0, required=False)
+    parser.add_argument('--no-ws-instances', dest="no_ws_instances", type=int,
+                        help='Number of instances without websocket',
+                        action=EnvDefault, envvar='MOCK_NO_WS_INSTANCES',
+                        default=0, required=False)
+    parser.add_argument('--processes', dest="processes", type=int,
+                        help='Number of processes serving requests on the same port',
+                        action=EnvDefault, envvar='MOCK_PROCESSES',
+                        default=1)
+    parser.add_argument('--seed', dest="seed", type=int, help='Seed of injected latency and errors',
+                        action=EnvDefault, envvar='MOCK_SEED', required=False)
+
+    args = parser.parse_args()
+
+    mock_config = MockNodeConfig(
+        latency_distribution=args.latency_distribution,
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        http_error_rate=args.http_error_rate,
+        hang_rate=args.hang_rate,
+        stall_after=args.stall_after,
+        max_batch_size=args.max_batch_size,
+        block_time=args.block_time,
+        instances=args.instances,
+        lagging_instances=args.lagging_instances,
+        lag_blocks=args.lag_blocks,
+        failing_instances=args.failing_instances,
+        forked_instances=args.forked_instances,
+        fork_block=args.fork_block,
+        no_ws_instances=args.no_ws_instances,
+        # all processes serve the same chain
+        genesis_time=time.time(),
+    )
+    for idx in range(1, args.processes):
+        seed = None if args.seed is None else args.seed + idx
+        multiprocessing.Process(target=serve, args=(mock_config, seed, args.host, args.port, True),
+                                daemon=True).start()
+    logger.info(f"Mock node listening on http://{args.host}:{args.port}/ (gateway: /instances), "
+                f"{args.processes} processes")
+    serve(mock_config, args.seed, args.host, args.port, args.processes > 1)
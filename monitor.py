@@ -1,20 +1,39 @@
 import argparse
 import asyncio
+import functools
 import json
+import math
 import os
 import time
 import random
 
 import requests
+import aiohttp
 from aiohttp import web
 
-from base_load import burst_call
+from base_load import burst_call, open_loop_call
+from circuit_breaker import CircuitBreaker
 from client_info import ClientInfo, RequestType
+from collector import Collector, ProbePusher
+from consistency_check import FORK_SEARCH_DEPTH, consistency_call, get_instance_urls
+from latency_histogram import LatencyHistogram
+from live_updates import LiveUpdates
+from load_workers import LoadWorkerPools
+from metrics import Metrics
+from request_timing import DEFAULT_SAMPLE_RATE, RequestTiming, timing_summary, timing_trace_config
 from discord_manager import DiscordManager
 import logging
 
 from env_default import EnvDefault
-from golem_rpc_endpoint_check import check_endpoint_health, CheckEndpointException
+from golem_rpc_endpoint_check import check_endpoint_health_async, CheckEndpointException
+from head_tracker import HeadTracker
+from history_store import HistoryStore
+from rpc_client import RpcClientPool
+from scheduler import Scheduler
+from slo import SloEngine, load_slos
+from status_snapshot import StatusSnapshot
+from targets import load_targets, target_from_args
+from workload import Workload, load_workload
 from datetime import timedelta, datetime
 import aiohttp_jinja2
 import jinja2
@@ -27,7 +46,7 @@ logger.setLevel(logging.DEBUG)
 parser = argparse.ArgumentParser(description='Golem rpc monitor params')
 parser.add_argument('--work-mode', dest="work_mode", type=str,
                     action=EnvDefault, envvar='MONITOR_WORK_MODE',
-                    help='Possible values: health_check, baseload_check',
+                    help='Possible values: health_check, baseload_check, openload_check, consistency_check',
                     default="health_check")
 parser.add_argument('--title', dest="title", type=str,
                     action=EnvDefault, envvar='MONITOR_TITLE',
@@ -35,24 +54,103 @@ parser.add_argument('--title', dest="title", type=str,
                     default="default_title")
 parser.add_argument('--no-discord', dest="no_discord", action='store_true')
 parser.set_defaults(no_discord=False)
+parser.add_argument('--config', dest="config", type=str,
+                    action=EnvDefault, envvar='MONITOR_CONFIG', required=False,
+                    help='Json file with list of targets to monitor, other arguments are used as target defaults')
+parser.add_argument('--max-concurrent-checks', dest="max_concurrent_checks", type=int,
+                    action=EnvDefault, envvar='MONITOR_MAX_CONCURRENT_CHECKS',
+                    help='How many checks of single target can run at the same time', default="1")
+parser.add_argument('--timing-sample-rate', dest="timing_sample_rate", type=float,
+                    action=EnvDefault, envvar='MONITOR_TIMING_SAMPLE_RATE',
+                    help='Fraction of requests for which dns, connect, ttfb, body and decode time is recorded '
+                         '(1 - every request)', default=str(DEFAULT_SAMPLE_RATE))
+parser.add_argument('--history-file', dest="history_file", type=str,
+                    action=EnvDefault, envvar='MONITOR_HISTORY_FILE', required=False,
+                    help='File where request history is kept between restarts (no persistence if not set)')
+parser.add_argument('--history-flush-interval', dest="history_flush_interval", type=float,
+                    action=EnvDefault, envvar='MONITOR_HISTORY_FLUSH_INTERVAL',
+                    help='How often history is written to history file (in seconds)', default="5")
+parser.add_argument('--http-port', dest="http_port", type=int,
+                    action=EnvDefault, envvar='MONITOR_HTTP_PORT',
+                    help='Port of status page, metrics and api', default="8080")
+
+# distributed mode, probes run checks and push results to the collector
+parser.add_argument('--collector', dest="collector", action='store_true',
+                    help='Run no checks, merge results pushed by probes (POST /api/probe) per region and target')
+parser.set_defaults(collector=False)
+parser.add_argument('--push-url', dest="push_url", type=str,
+                    action=EnvDefault, envvar='MONITOR_PUSH_URL', required=False,
+                    help='Url of the collector this monitor pushes its results to (no pushing if not set)')
+parser.add_argument('--region', dest="region", type=str,
+                    action=EnvDefault, envvar='MONITOR_REGION',
+                    help='Region of this probe, its targets are shown as <region>/<target> by the collector',
+                    default="local")
+parser.add_argument('--push-interval', dest="push_interval", type=float,
+                    action=EnvDefault, envvar='MONITOR_PUSH_INTERVAL',
+                    help='How often results are pushed to the collector (in seconds)', default="10")
 
 # arguments for work mode health_check
 parser.add_argument('--endpoint', dest="endpoint", type=str,
                     action=EnvDefault, envvar='MONITOR_ENDPOINT',
                     help='Endpoint to check',
                     default="https://gateway.golem.network/mumbai/instances")
-parser.add_argument('--check-interval', dest="check_interval", type=int,
+parser.add_argument('--check-interval', dest="check_interval", type=float,
                     action=EnvDefault, envvar='MONITOR_CHECK_INTERVAL',
                     help='Check interval (in seconds)', default="10")
+parser.add_argument('--min-check-interval', dest="min_check_interval", type=float,
+                    action=EnvDefault, envvar='MONITOR_MIN_CHECK_INTERVAL',
+                    help='Check interval of failing and recovering target (in seconds, 0 - check interval)',
+                    default="0")
+parser.add_argument('--max-check-interval', dest="max_check_interval", type=float,
+                    action=EnvDefault, envvar='MONITOR_MAX_CHECK_INTERVAL',
+                    help='Longest check interval of target stable for a long time (in seconds, 0 - check interval)',
+                    default="0")
+parser.add_argument('--check-jitter', dest="check_jitter", type=float,
+                    action=EnvDefault, envvar='MONITOR_CHECK_JITTER',
+                    help='Fraction of check interval by which checks are randomly moved', default="0.1")
+parser.add_argument('--check-timeout', dest="check_timeout", type=float,
+                    action=EnvDefault, envvar='MONITOR_CHECK_TIMEOUT',
+                    help='Check still running after this time is cancelled and counted as failed '
+                         '(in seconds, 0 - time the work of the check can take with every request timing out, '
+                         'at most 3 check intervals plus request timeout)', default="0")
+parser.add_argument('--breaker-failures', dest="breaker_failures", type=int,
+                    action=EnvDefault, envvar='MONITOR_BREAKER_FAILURES',
+                    help='Failed load checks in a row after which only single probe request is sent instead of '
+                         'the check, until the target responds again (0 - never)', default="3")
 parser.add_argument('--success-interval', dest="success_interval", type=int,
                     action=EnvDefault, envvar='MONITOR_SUCCESS_INTERVAL',
                     help='Success message anti spam interval (in seconds)', default="60")
 parser.add_argument('--error-interval', dest="error_interval", type=int,
                     action=EnvDefault, envvar='MONITOR_ERROR_INTERVAL',
                     help='Failure message anti spam interval (in seconds)', default="60")
+parser.add_argument('--notification-window', dest="notification_window", type=float,
+                    action=EnvDefault, envvar='MONITOR_NOTIFICATION_WINDOW',
+                    help='Messages for the same topic within this window are sent as one (in seconds)', default="5")
 parser.add_argument('--expected-instances', dest="expected_instances", type=int,
                     action=EnvDefault, envvar='EXPECTED_INSTANCES',
                     help='How many instances are expected', default="2")
+parser.add_argument('--connect-timeout', dest="connect_timeout", type=float,
+                    action=EnvDefault, envvar='MONITOR_CONNECT_TIMEOUT',
+                    help='Health check connect timeout (in seconds)', default="5")
+parser.add_argument('--read-timeout', dest="read_timeout", type=float,
+                    action=EnvDefault, envvar='MONITOR_READ_TIMEOUT',
+                    help='Health check read timeout (in seconds)', default="10")
+parser.add_argument('--probe-instances', dest="probe_instances", action='store_true',
+                    help='Ask every instance for its head block instead of using block info cached by gateway')
+parser.set_defaults(probe_instances=False)
+parser.add_argument('--track-heads', dest="track_heads", action='store_true',
+                    help='Follow heads of all instances (websocket newHeads or http polling) and alert on lag')
+parser.set_defaults(track_heads=False)
+parser.add_argument('--max-lag-blocks', dest="max_lag_blocks", type=int,
+                    action=EnvDefault, envvar='MONITOR_MAX_LAG_BLOCKS',
+                    help='Instance more blocks behind the best head is reported as lagging', default="5")
+parser.add_argument('--max-lag-time', dest="max_lag_time", type=float,
+                    action=EnvDefault, envvar='MONITOR_MAX_LAG_TIME',
+                    help='Instance missing block seen by others for longer is reported as lagging (in seconds)',
+                    default="10")
+parser.add_argument('--head-poll-interval', dest="head_poll_interval", type=float,
+                    action=EnvDefault, envvar='MONITOR_HEAD_POLL_INTERVAL',
+                    help='How often heads of instances without websocket are polled (in seconds)', default="0.5")
 
 # arguments for work mode baseload_check
 # noinspection DuplicatedCode
@@ -71,6 +169,51 @@ parser.add_argument('--request-burst', dest="request_burst", type=int, help='Num
 parser.add_argument('--sleep-time', dest="sleep_time", type=float, help='Number of requests to sent at once',
                     action=EnvDefault, envvar='BASELOAD_SLEEP_TIME',
                     default=5.0)
+parser.add_argument('--burst-concurrency', dest="burst_concurrency", type=int,
+                    help='Maximum number of requests in flight during burst',
+                    action=EnvDefault, envvar='BASELOAD_BURST_CONCURRENCY',
+                    default=1)
+parser.add_argument('--batch-size', dest="batch_size", type=int,
+                    help='Number of calls sent in single json-rpc batch request (1 - no batching)',
+                    action=EnvDefault, envvar='BASELOAD_BATCH_SIZE',
+                    default=1)
+parser.add_argument('--request-timeout', dest="request_timeout", type=float,
+                    help='Timeout of single request (in seconds)',
+                    action=EnvDefault, envvar='BASELOAD_REQUEST_TIMEOUT',
+                    default=10.0)
+parser.add_argument('--workload', dest="workload", type=str,
+                    help='Json file with weighted mix of rpc calls, by default only token holder balance is checked',
+                    action=EnvDefault, envvar='BASELOAD_WORKLOAD', required=False)
+parser.add_argument('--pool-size', dest="pool_size", type=int,
+                    help='Maximum number of open connections to single target',
+                    action=EnvDefault, envvar='BASELOAD_POOL_SIZE',
+                    default=100)
+parser.add_argument('--load-processes', dest="load_processes", type=int,
+                    help='Number of worker processes generating baseload / openload (1 - monitor process only)',
+                    action=EnvDefault, envvar='BASELOAD_LOAD_PROCESSES',
+                    default=1)
+parser.add_argument('--dns-cache-ttl', dest="dns_cache_ttl", type=int,
+                    help='How long resolved target addresses are cached (in seconds)',
+                    action=EnvDefault, envvar='BASELOAD_DNS_CACHE_TTL',
+                    default=300)
+
+# arguments for work mode openload_check (it uses target url, token and timeout arguments of baseload_check)
+parser.add_argument('--target-rps', dest="target_rps", type=float,
+                    help='Requests per second sent to target no matter how fast it responds',
+                    action=EnvDefault, envvar='OPENLOAD_TARGET_RPS',
+                    default=50.0)
+parser.add_argument('--arrival', dest="arrival", type=str,
+                    help='Spacing of requests, possible values: constant, poisson',
+                    action=EnvDefault, envvar='OPENLOAD_ARRIVAL',
+                    default="constant")
+parser.add_argument('--max-outstanding', dest="max_outstanding", type=int,
+                    help='Requests in flight above this limit are not sent and counted as failed',
+                    action=EnvDefault, envvar='OPENLOAD_MAX_OUTSTANDING',
+                    default=1000)
+parser.add_argument('--min-achieved-ratio', dest="min_achieved_ratio", type=float,
+                    help='Check fails when achieved rate is lower than this part of offered rate',
+                    action=EnvDefault, envvar='OPENLOAD_MIN_ACHIEVED_RATIO',
+                    default=0.95)
 
 
 def post_failure_message(discord_manager, topic, message):
@@ -87,56 +230,424 @@ def post_success_message(discord_manager, topic, message):
         logger.info(message)
 
 
-async def main_loop(discord_manager, args, context):
-    context['client_info'] = ClientInfo(1, "apikey")
-    while True:
-        try:
-
-            endpoint = args.endpoint
-            if args.work_mode == "health_check":
-                logger.info(f"Checking endpoint {endpoint}")
-                health_status = None
-                try:
-                    health_status = check_endpoint_health(endpoint, args.expected_instances)
-                except CheckEndpointException as ex:
-                    post_failure_message(discord_manager, "main", f"Failure when validating {endpoint}\n{ex}")
-                except Exception as ex:
-                    post_failure_message(discord_manager, "main", f"Other exception when validating {endpoint}\n{ex}")
-
-                if health_status:
-                    health_status_formatted = json.dumps(health_status, indent=4, default=str)
-                    post_success_message("main",
-                                         f"Successfully validated {endpoint} \n```{health_status_formatted}```")
-            elif args.work_mode == "baseload_check":
-                target_url = args.target_url
-                logger.info(f"Checking target url: {target_url}")
-                try:
-                    # burst_call returns success_request_count and failure_request_count
-                    (s_r, f_r) = await burst_call(context, target_url, args.token_holder, args.token_address,
-                                                  args.request_burst)
-                    if f_r == 0 and s_r > 0:
-                        context["last_success"] = datetime.now()
-                        context["last_result"] = "success"
-                        context['client_info'].add_request("test", RequestType.Succeeded)
-                        post_success_message(discord_manager, "baseload", f"Successfully called {s_r} times")
-                    else:
-                        context["last_result"] = "failure"
-                        context['client_info'].add_request("test", RequestType.Failed)
-                        post_failure_message(discord_manager, "baseload", f"Failed to call {f_r} times")
-                except Exception as ex:
-                    context["last_result"] = "error"
-                    context["last_err"] = ex
-                    context["last_err_time"] = datetime.now()
-                    context['client_info'].add_request("test", RequestType.Failed)
-                    post_failure_message(discord_manager, "baseload",
-                                         f"Other exception when calling burst call {target_url}\n{ex}")
-                context["last_call"] = datetime.now()
+def create_metrics():
+    metrics = Metrics()
+    metrics.register("rpc_monitor_checks_total", "counter", "Number of finished checks")
+    metrics.register("rpc_monitor_calls_total", "counter", "Number of rpc calls sent during baseload bursts")
+    metrics.register("rpc_monitor_request_latency_seconds", "histogram", "Latency of checked requests")
+    metrics.register("rpc_monitor_block_age_seconds", "gauge", "Age of the latest block seen by baseload check")
+    metrics.register("rpc_monitor_burst_duration_seconds", "gauge", "Duration of the last baseload burst")
+    metrics.register("rpc_monitor_burst_throughput", "gauge", "Calls per second reached in the last baseload burst")
+    metrics.register("rpc_monitor_offered_rate", "gauge", "Requests per second scheduled by open loop load")
+    metrics.register("rpc_monitor_method_calls_total", "counter", "Number of baseload calls per rpc method")
+    metrics.register("rpc_monitor_method_latency_seconds", "histogram", "Latency of baseload calls per rpc method")
+    metrics.register("rpc_monitor_method_failed_latency_seconds", "histogram",
+                     "Latency of failed, timed out and not sent baseload calls per rpc method")
+    metrics.register("rpc_monitor_connections_total", "counter", "Connections to target opened or reused by baseload")
+    metrics.register("rpc_monitor_connect_latency_seconds", "histogram", "Setup time of new connections (tcp + tls)")
+    metrics.register("rpc_monitor_request_phase_seconds", "histogram",
+                     "Time spent in request phases (queue, dns, connect, ttfb, body, decode) of sampled requests")
+    metrics.register("rpc_monitor_instance_head", "gauge", "Latest block reported by instance")
+    metrics.register("rpc_monitor_instance_lag_blocks", "gauge", "Number of blocks instance is behind the best head")
+    metrics.register("rpc_monitor_instance_lag_seconds", "gauge", "Time since instance misses block seen by others")
+    metrics.register("rpc_monitor_block_propagation_seconds", "histogram",
+                     "Delay of block on instance after it was reported by the first one")
+    metrics.register("rpc_monitor_consistency_queries_total", "counter",
+                     "Queries compared across instances, by result (matched, diverged, failed)")
+    metrics.register("rpc_monitor_check_timeouts_total", "counter", "Checks cancelled at their deadline")
+    metrics.register("rpc_monitor_circuit_open", "gauge", "1 if only probe requests are sent to the target")
+    metrics.register("rpc_monitor_slo_burn_rate", "gauge", "Rate of spending error budget of SLO over window")
+    metrics.register("rpc_monitor_slo_firing", "gauge", "1 if SLO burns its error budget too fast")
+    return metrics
+
+
+def record_check(context, target, request_type, latency=None):
+    context['client_info'].add_request(target.name, request_type, latency)
+    context['status'].invalidate()
+    metrics = context['metrics']
+    labels = (("target", target.name),)
+    metrics.inc("rpc_monitor_checks_total", labels + (("result", request_type.name.lower()),))
+    if latency:
+        metrics.observe("rpc_monitor_request_latency_seconds", labels, latency)
+
+
+def record_timing(context, target, target_ctx, phases):
+    """Phases of requests sampled during the check"""
+    target_ctx["timing"] = timing_summary(phases)
+    for phase, latency in phases.items():
+        context['metrics'].observe("rpc_monitor_request_phase_seconds",
+                                   (("target", target.name), ("phase", phase)), latency)
+
+
+def record_progress(context, target, latency):
+    """Latency of calls already finished by load workers, the check itself is recorded when it ends"""
+    context['client_info'].add_latency(target.name, latency)
+    context['metrics'].observe("rpc_monitor_request_latency_seconds", (("target", target.name),), latency)
+    context['status'].invalidate()
+
+
+def slo_changed(discord_manager, context, rule, message):
+    topic = f"slo {rule.name}"
+    if rule.firing:
+        post_failure_message(discord_manager, topic, message)
+    else:
+        post_success_message(discord_manager, topic, message)
+    context['status'].invalidate()
+
+
+def record_slos(context, rules):
+    metrics = context['metrics']
+    for rule in rules:
+        labels = (("slo", rule.name), ("target", rule.target))
+        metrics.set("rpc_monitor_slo_firing", labels, 1 if rule.firing else 0)
+        for window in rule.windows.values():
+            metrics.set("rpc_monitor_slo_burn_rate", labels + (("window", f"{window.length}s"),),
+                        window.burn_rate(rule.error_budget))
+
+
+async def health_check(discord_manager, target, target_ctx, context, session):
+    endpoint = target.endpoint
+    topic = target.name
+    logger.info(f"Checking endpoint {endpoint}")
+    health_status = None
+    latency = LatencyHistogram()
+    check_start = time.monotonic()
+    try:
+        health_status = await asyncio.wait_for(
+            check_endpoint_health_async(session, endpoint, target.expected_instances, target.probe_instances,
+                                        target_ctx["request_timing"]), target.request_timeout)
+    except asyncio.TimeoutError:
+        post_failure_message(discord_manager, topic,
+                             f"Endpoint {endpoint} did not respond in {target.request_timeout}s")
+    except CheckEndpointException as ex:
+        post_failure_message(discord_manager, topic, f"Failure when validating {endpoint}\n{ex}")
+    except Exception as ex:
+        post_failure_message(discord_manager, topic, f"Other exception when validating {endpoint}\n{ex}")
+    latency.record(time.monotonic() - check_start)
+    record_timing(context, target, target_ctx, target_ctx["request_timing"].take())
+
+    if health_status:
+        target_ctx["last_success"] = datetime.now()
+        target_ctx["last_result"] = "success"
+        record_check(context, target, RequestType.Succeeded, latency)
+        health_status_formatted = json.dumps(health_status, indent=4, default=str)
+        post_success_message(discord_manager, topic,
+                             f"Successfully validated {endpoint} \n```{health_status_formatted}```")
+    else:
+        target_ctx["last_result"] = "failure"
+        record_check(context, target, RequestType.Failed, latency)
+    target_ctx["last_call"] = datetime.now()
+    context['status'].invalidate()
+    return target_ctx["last_result"] == "success"
+
+
+def head_reported(context, target, target_ctx, tracker, head, propagation_delay):
+    metrics = context['metrics']
+    labels = (("target", target.name), ("instance", head.instance_id))
+    propagation = LatencyHistogram()
+    propagation.record(propagation_delay)
+    metrics.observe("rpc_monitor_block_propagation_seconds", labels, propagation)
+    for instance_head in tracker.heads.values():
+        if instance_head.number is None:
+            continue
+        instance_labels = (("target", target.name), ("instance", instance_head.instance_id))
+        metrics.set("rpc_monitor_instance_head", instance_labels, instance_head.number)
+        metrics.set("rpc_monitor_instance_lag_blocks", instance_labels, instance_head.lag_blocks)
+        metrics.set("rpc_monitor_instance_lag_seconds", instance_labels, instance_head.lag_ms / 1000.0)
+    target_ctx["heads"] = tracker.summary()
+    context['status'].invalidate()
+
+
+def head_lag_changed(discord_manager, context, target, target_ctx, tracker, head, message):
+    topic = f"{target.name} {head.instance_id}"
+    if head.lagging:
+        post_failure_message(discord_manager, topic, message)
+    else:
+        post_success_message(discord_manager, topic, message)
+    context['metrics'].set("rpc_monitor_instance_lag_seconds",
+                           (("target", target.name), ("instance", head.instance_id)), head.lag_ms / 1000.0)
+    target_ctx["heads"] = tracker.summary()
+    context['status'].invalidate()
+
+
+async def baseload_check(discord_manager, target, target_ctx, context):
+    target_url = target.target_url
+    topic = target.name
+    logger.info(f"Checking target url: {target_url}")
+    try:
+        # burst_call and open_loop_call return success_request_count and failure_request_count
+        client = context['rpc_clients'].get(target)
+        workload = target_ctx["workload"]
+        # connections are opened by the monitor process or by load workers
+        connections = client
+        check_latency = None
+        if target.load_processes > 1:
+            load = context['load_workers'].get(target, workload)
+            connections = load
+            # latency is recorded while load workers report it, not at the end of the check
+            on_progress = functools.partial(record_progress, context, target)
+            if target.work_mode == "openload_check":
+                (s_r, f_r) = await load.open_loop_call(target_ctx, client,
+                                                       target.target_rps, target.check_interval, target.arrival,
+                                                       target.max_outstanding, target.request_timeout, on_progress)
             else:
-                raise Exception(f"Unknown work mode {args.work_mode}")
-        except Exception as ex:
-            logger.error(f"Discord manager exception: {ex}")
-
-        await asyncio.sleep(args.check_interval)
+                (s_r, f_r) = await load.burst_call(target_ctx, client,
+                                                   target.request_burst, target.burst_concurrency, target.batch_size,
+                                                   target.request_timeout, on_progress)
+        elif target.work_mode == "openload_check":
+            (s_r, f_r) = await open_loop_call(target_ctx, client, workload,
+                                              target.target_rps, target.check_interval, target.arrival,
+                                              target.max_outstanding, target.request_timeout)
+            check_latency = target_ctx["burst_latency"]
+        else:
+            (s_r, f_r) = await burst_call(target_ctx, client, workload,
+                                          target.request_burst, target.burst_concurrency, target.batch_size,
+                                          target.request_timeout)
+            check_latency = target_ctx["burst_latency"]
+        if target.work_mode == "openload_check":
+            rate_ok = target_ctx["achieved_rate"] >= target.min_achieved_ratio * target_ctx["offered_rate"]
+        else:
+            rate_ok = True
+        target_ctx["calls_succeeded"] = s_r
+        target_ctx["connections_created"] = connections.connections_created
+        target_ctx["connections_reused"] = connections.connections_reused
+        target_ctx["connect_p50"] = connections.connect_latency.percentile(50)
+        metrics = context['metrics']
+        labels = (("target", target.name),)
+        metrics.set("rpc_monitor_connections_total", labels + (("state", "new"),), connections.connections_created)
+        metrics.set("rpc_monitor_connections_total", labels + (("state", "reused"),),
+                    connections.connections_reused)
+        metrics.observe("rpc_monitor_connect_latency_seconds", labels, connections.take_connect_latency())
+        record_timing(context, target, target_ctx, connections.timing.take())
+        metrics.inc("rpc_monitor_calls_total", labels + (("result", "succeeded"),), s_r)
+        metrics.inc("rpc_monitor_calls_total", labels + (("result", "failed"),), f_r)
+        metrics.set("rpc_monitor_block_age_seconds", labels, target_ctx["block_age"])
+        metrics.set("rpc_monitor_burst_duration_seconds", labels, target_ctx["burst_duration"])
+        metrics.set("rpc_monitor_burst_throughput", labels, target_ctx["burst_throughput"])
+        if "offered_rate" in target_ctx:
+            metrics.set("rpc_monitor_offered_rate", labels, target_ctx["offered_rate"])
+        for method, method_stats in target_ctx["methods"].items():
+            method_labels = labels + (("method", method),)
+            metrics.inc("rpc_monitor_method_calls_total", method_labels + (("result", "succeeded"),),
+                        method_stats["succeeded"])
+            metrics.inc("rpc_monitor_method_calls_total", method_labels + (("result", "failed"),),
+                        method_stats["failed"])
+            metrics.observe("rpc_monitor_method_latency_seconds", method_labels, method_stats["latency"])
+            metrics.observe("rpc_monitor_method_failed_latency_seconds", method_labels,
+                            method_stats["failed_latency"])
+        if f_r == 0 and s_r > 0 and rate_ok:
+            target_ctx["last_success"] = datetime.now()
+            target_ctx["last_result"] = "success"
+            record_check(context, target, RequestType.Succeeded, check_latency)
+            post_success_message(discord_manager, topic,
+                                 f"Successfully called {target_url} {s_r} times in "
+                                 f"{target_ctx['burst_duration']:.2f}s ({target_ctx['burst_throughput']:.1f} calls/s)")
+        elif not rate_ok:
+            target_ctx["last_result"] = "failure"
+            record_check(context, target, RequestType.Failed, check_latency)
+            post_failure_message(discord_manager, topic,
+                                 f"{target_url} sustained only {target_ctx['achieved_rate']:.1f} of "
+                                 f"{target_ctx['offered_rate']:.1f} requests/s ({f_r} failed)")
+        else:
+            target_ctx["last_result"] = "failure"
+            record_check(context, target, RequestType.Failed, check_latency)
+            post_failure_message(discord_manager, topic, f"Failed to call {target_url} {f_r} times")
+    except Exception as ex:
+        target_ctx["last_result"] = "error"
+        target_ctx["last_err"] = ex
+        target_ctx["last_err_time"] = datetime.now()
+        record_check(context, target, RequestType.Failed)
+        post_failure_message(discord_manager, topic,
+                             f"Other exception when calling burst call {target_url}\n{ex}")
+    target_ctx["last_call"] = datetime.now()
+    context['status'].invalidate()
+    return target_ctx["last_result"] == "success"
+
+
+async def consistency_check(discord_manager, target, target_ctx, context, session):
+    endpoint = target.endpoint
+    topic = target.name
+    logger.info(f"Comparing responses of instances of {endpoint}")
+    latency = LatencyHistogram()
+    check_start = time.monotonic()
+    try:
+        get_client = functools.partial(context['rpc_clients'].get, target)
+        (matched, diverged, failed) = await consistency_call(target_ctx, session, endpoint, get_client,
+                                                             target_ctx["workload"], target.request_burst,
+                                                             target.burst_concurrency, target.batch_size,
+                                                             target.request_timeout)
+        latency.record(time.monotonic() - check_start)
+        report = target_ctx["consistency"]
+        metrics = context['metrics']
+        for instance in report["instances"]:
+            labels = (("target", target.name), ("instance", instance["instance"]))
+            for result in ("matched", "diverged", "failed"):
+                metrics.inc("rpc_monitor_consistency_queries_total", labels + (("result", result),), instance[result])
+        summary = "\n".join(
+            f"{instance['instance']}: {instance['matched']} matched, {instance['diverged']} diverged"
+            + (f" from block {instance['first_block']}" if instance["first_block"] is not None else "")
+            + (f" (fork at block {instance['fork_block']})" if instance["fork_block"] is not None else "")
+            + f", {instance['failed']} failed"
+            for instance in report["instances"])
+        if diverged == 0 and failed == 0 and matched > 0:
+            target_ctx["last_success"] = datetime.now()
+            target_ctx["last_result"] = "success"
+            record_check(context, target, RequestType.Succeeded, latency)
+            post_success_message(discord_manager, topic,
+                                 f"Instances of {endpoint} agree on {report['queries']} queries pinned at block "
+                                 f"{report['pinned_block']}\n```{summary}```")
+        else:
+            target_ctx["last_result"] = "failure"
+            record_check(context, target, RequestType.Failed, latency)
+            post_failure_message(discord_manager, topic,
+                                 f"Instances of {endpoint} diverge on queries pinned at block "
+                                 f"{report['pinned_block']}\n```{summary}```")
+    except Exception as ex:
+        target_ctx["last_result"] = "error"
+        target_ctx["last_err"] = ex
+        target_ctx["last_err_time"] = datetime.now()
+        record_check(context, target, RequestType.Failed)
+        post_failure_message(discord_manager, topic, f"Other exception when comparing instances of {endpoint}\n{ex}")
+    target_ctx["last_call"] = datetime.now()
+    context['status'].invalidate()
+    return target_ctx["last_result"] == "success"
+
+
+def check_work_time(target):
+    """
+    Longest time the work of one check can take when every round of requests (and the latest block lookup
+    before the load) takes up to request timeout
+    """
+    if target.work_mode == "health_check":
+        # gateway request, then instance probes in parallel
+        return 2 * target.request_timeout
+    if target.work_mode == "openload_check":
+        # latest block lookup, load window of check interval, draining requests in flight
+        return target.check_interval + 2 * target.request_timeout
+    rounds = math.ceil(target.request_burst / max(target.batch_size, 1) / max(target.burst_concurrency, 1))
+    if target.work_mode == "consistency_check":
+        # instance list, heads and queries (instances in parallel), bisection for the fork block
+        return (rounds + 2 + math.ceil(math.log2(FORK_SEARCH_DEPTH))) * target.request_timeout
+    return (rounds + 1) * target.request_timeout
+
+
+def check_deadline(target):
+    """
+    Hard bound of one check. If not set, it is the work time of the check, but never more than three check
+    intervals plus request timeout, so one hung check does not hold the target for long
+    """
+    if target.check_timeout:
+        return target.check_timeout
+    return min(check_work_time(target), 3 * target.check_interval + target.request_timeout)
+
+
+def target_down(target_ctx):
+    """
+    Check failed because the target does not answer (error, deadline or no successful call).
+    Target that is slow or saturated but still answers is not down, it keeps getting full load
+    """
+    return target_ctx.get("last_result") == "error" or target_ctx.get("calls_succeeded") == 0
+
+
+def update_circuit(context, target, target_ctx, breaker):
+    target_ctx["circuit"] = breaker.state
+    context['metrics'].set("rpc_monitor_circuit_open", (("target", target.name),), 1 if breaker.is_open else 0)
+    context['status'].invalidate()
+
+
+async def probe_target(discord_manager, target, target_ctx, context, probe, breaker):
+    """Sends single probe request instead of the check while circuit of the target is open"""
+    try:
+        await asyncio.wait_for(probe(), target.request_timeout)
+        success = True
+    except Exception as ex:
+        logger.info(f"Probe of {target.name} failed: {str(ex) or type(ex).__name__}")
+        success = False
+        # target is still down, it counts as failed check
+        record_check(context, target, RequestType.Failed)
+    target_ctx["last_call"] = datetime.now()
+    if breaker.record_probe(success):
+        post_success_message(discord_manager, target.name, f"{target.name} responds again, resuming full checks")
+    update_circuit(context, target, target_ctx, breaker)
+    return success
+
+
+async def guarded_check(discord_manager, target, target_ctx, context, check, probe=None, breaker=None):
+    """
+    Runs check cancelled at its deadline (requests still in flight are cancelled with it), so hung connection
+    can not stall the target. While circuit breaker of the target is open only probe is sent instead of the check
+    """
+    if breaker and breaker.is_open:
+        return await probe_target(discord_manager, target, target_ctx, context, probe, breaker)
+
+    deadline = check_deadline(target)
+    try:
+        success = await asyncio.wait_for(check(), deadline)
+    except asyncio.TimeoutError:
+        message = f"Check of {target.name} did not finish in {deadline:.1f}s, it was cancelled"
+        target_ctx["last_result"] = "error"
+        target_ctx["last_err"] = message
+        target_ctx["last_err_time"] = datetime.now()
+        target_ctx["last_call"] = datetime.now()
+        context['metrics'].inc("rpc_monitor_check_timeouts_total", (("target", target.name),))
+        record_check(context, target, RequestType.Failed)
+        post_failure_message(discord_manager, target.name, message)
+        success = False
+
+    if breaker:
+        if breaker.record(success or not target_down(target_ctx)):
+            post_failure_message(discord_manager, target.name,
+                                 f"{target.name} failed {breaker.consecutive_failures} checks in a row, "
+                                 f"only single probe request is sent until it responds")
+        update_circuit(context, target, target_ctx, breaker)
+    return success
+
+
+async def main_loop(discord_manager, targets, context, session):
+    context['targets'] = {}
+
+    scheduler = Scheduler()
+    head_trackers = []
+    for target in targets:
+        target_ctx = {"target": target}
+        context['targets'][target.name] = target_ctx
+        max_concurrent_checks = target.max_concurrent_checks
+        if target.work_mode == "health_check":
+            target_ctx["request_timing"] = RequestTiming(target.timing_sample_rate)
+            check = functools.partial(health_check, discord_manager, target, target_ctx, context, session)
+            # health check is a single request already, it is never replaced by probe
+            probe = breaker = None
+            if target.track_heads:
+                head_trackers.append(HeadTracker(
+                    target.endpoint, target.max_lag_blocks, target.max_lag_time, target.head_poll_interval,
+                    functools.partial(head_reported, context, target, target_ctx),
+                    functools.partial(head_lag_changed, discord_manager, context, target, target_ctx)))
+        else:
+            if target.workload:
+                target_ctx["workload"] = load_workload(target.workload, target.token_address, target.token_holder)
+            else:
+                target_ctx["workload"] = Workload.single_balance(target.token_address, target.token_holder)
+            if target.work_mode == "consistency_check":
+                check = functools.partial(consistency_check, discord_manager, target, target_ctx, context, session)
+                probe = functools.partial(get_instance_urls, session, target.endpoint)
+            else:
+                check = functools.partial(baseload_check, discord_manager, target, target_ctx, context)
+                probe = functools.partial(context['rpc_clients'].get(target).get_block_by_number, "latest", False)
+            breaker = CircuitBreaker(target.name, target.breaker_failures)
+            target_ctx["circuit"] = breaker.state
+        check = functools.partial(guarded_check, discord_manager, target, target_ctx, context, check, probe, breaker)
+        if target.work_mode == "openload_check":
+            # open loop window lasts whole interval, next one has to start while the previous one drains
+            max_concurrent_checks = max(max_concurrent_checks, 2)
+            # length of the window is the check interval, it can not adapt
+            scheduler.add(target.name, target.check_interval, check, max_concurrent_checks,
+                          jitter=target.check_jitter)
+        else:
+            scheduler.add(target.name, target.check_interval, check, max_concurrent_checks,
+                          target.min_check_interval, target.max_check_interval, target.check_jitter)
+
+    # head trackers run all the time, independently of checks
+    await asyncio.gather(scheduler.run(), *[tracker.run() for tracker in head_trackers])
 
 
 routes = web.RouteTableDef()
@@ -145,49 +656,31 @@ routes = web.RouteTableDef()
 @routes.get('/')
 async def hello(request):
     ctx = request.app['context']
+    return ctx['status'].html_response(request, ctx, 'status.jinja2')
 
-    def get_history(buckets, title):
-        hist = []
-        for key in reversed(buckets):
-            time1 = key
-            el = buckets[key]
-            if el.request_count > 0 and el.request_failed_count:
-                class_name = "warning"
-            elif el.request_failed_count > 0:
-                class_name = "error"
-            elif el.request_count > 0:
-                class_name = "success"
-            else:
-                class_name = "warning"
-
-
-            hist.append({
-                "time": time1,
-                "requests": el.request_count,
-                "failures": el.request_failed_count,
-                'class': class_name
-            })
-        return {
-            "hist": hist,
-            "title": title
-        }
-
-    hist_seconds = get_history(ctx['client_info'].time_buckets_seconds["test"], "Seconds")
-    hist_minutes = get_history(ctx['client_info'].time_buckets_minutes["test"], "Minutes")
-    hist_hours = get_history(ctx['client_info'].time_buckets_hours["test"], "Hours")
-    hist_days = get_history(ctx['client_info'].time_buckets_days["test"], "Days")
-
-
-    ctx["current"] = {
-        "block_age": int(time.time()) - ctx["block_timestamp"] if "block_timestamp" in ctx else 0,
-        "call_age": int(time.time()) - int(ctx["last_call"].timestamp()),
-        "history": [hist_seconds, hist_minutes,hist_hours, hist_days],
-    }
-    response = aiohttp_jinja2.render_template('status.jinja2',
-                                              request,
-                                              ctx
-                                              )
-    return response
+
+@routes.get('/api/status')
+async def api_status(request):
+    ctx = request.app['context']
+    return ctx['status'].json_response(request, ctx)
+
+
+@routes.get('/api/updates')
+async def api_updates(request):
+    return await request.app['context']['live_updates'].stream(request)
+
+
+@routes.post('/api/probe')
+async def api_probe(request):
+    collector = request.app['context'].get('collector')
+    if collector is None:
+        raise web.HTTPNotFound(text="Monitor is not running as collector")
+    return await collector.handle(request)
+
+
+@routes.get('/metrics')
+async def metrics_handler(request):
+    return web.Response(text=request.app['context']['metrics'].render(), content_type="text/plain")
 
 
 async def main():
@@ -203,27 +696,82 @@ async def main():
     logger.info("Starting rpc monitor...")
     logger.debug(json.dumps(args.__dict__, indent=4))
 
+    if args.collector:
+        # targets come from probes, slos refer to them as <region>/<target>
+        targets = []
+        slos = load_slos(args.config, None) if args.config else []
+        logger.info("Collecting results of probes...")
+    else:
+        if args.config:
+            targets = load_targets(args.config, args)
+        else:
+            targets = [target_from_args(args)]
+        logger.info(f"Monitoring targets: {', '.join(target.name for target in targets)}")
+        slos = load_slos(args.config, [target.name for target in targets]) if args.config else []
+
     if args.no_discord:
         discord_manager = None
         logger.info("Running without discord messaging...")
     else:
         discord_manager = DiscordManager(webhook_url=webhook_url,
                                          min_resend_error_time=timedelta(seconds=args.error_interval),
-                                         min_resend_success_time=timedelta(seconds=args.success_interval))
+                                         min_resend_success_time=timedelta(seconds=args.success_interval),
+                                         coalesce_window=timedelta(seconds=args.notification_window))
 
+        await discord_manager.start()
         logger.info("Checking discord webhook...")
-        discord_manager.check_webhook()
+        await discord_manager.check_webhook()
 
     app = web.Application()
     app.add_routes(routes)
+    status = StatusSnapshot()
     app['context'] = {
         'title': args.title,
+        'client_info': ClientInfo(1, "apikey"),
+        'metrics': create_metrics(),
+        'status': status,
+        'live_updates': LiveUpdates(status),
+        'rpc_clients': RpcClientPool(args.dns_cache_ttl),
+        'load_workers': LoadWorkerPools(args.dns_cache_ttl),
     }
+    if args.collector:
+        app['context']['targets'] = {}
+        app['context']['collector'] = Collector(
+            lambda name, work_mode: target_from_args(args, name, work_mode=work_mode))
+
+    history_store = None
+    if args.history_file:
+        history_store = HistoryStore(args.history_file, app['context']['client_info'], args.history_flush_interval)
+        history_store.restore()
+        history_task = asyncio.create_task(history_store.run())
+    updates_task = asyncio.create_task(app['context']['live_updates'].run(app['context']))
+    if slos:
+        logger.info(f"Evaluating SLOs: {', '.join(rule.name for rule in slos)}")
+        app['context']['slo'] = SloEngine(slos, functools.partial(slo_changed, discord_manager, app['context']),
+                                          functools.partial(record_slos, app['context']))
+        slo_task = asyncio.create_task(app['context']['slo'].run(app['context']))
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates'))
     app_task = asyncio.create_task(
-        web._run_app(app, port=8080, handle_signals=False)  # noqa
+        web._run_app(app, port=args.http_port, handle_signals=False)  # noqa
     )
-    await main_loop(discord_manager, args, app['context'])
+    timeout = aiohttp.ClientTimeout(connect=args.connect_timeout, sock_read=args.read_timeout)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout, trace_configs=[timing_trace_config()]) as session:
+            if args.push_url:
+                logger.info(f"Pushing results to collector {args.push_url} as region {args.region}")
+                pusher = ProbePusher(args.push_url, args.region, args.push_interval)
+                push_task = asyncio.create_task(pusher.run(session, app['context']))
+            if args.collector:
+                await app_task
+            else:
+                await main_loop(discord_manager, targets, app['context'], session)
+    finally:
+        await app['context']['rpc_clients'].close()
+        await app['context']['load_workers'].close()
+        if history_store:
+            await history_store.flush()
+        if discord_manager:
+            await discord_manager.close()
 
 
 if __name__ == '__main__':
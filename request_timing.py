@@ -0,0 +1,119 @@
+import random
+import time
+
+import aiohttp
+
+from latency_histogram import LatencyHistogram
+
+# queue - waiting for free connection in the pool, dns - resolving host (cache misses only),
+# connect - tcp connect and tls handshake of new connection, ttfb - from sent headers to response headers,
+# body - reading response body, decode - json decoding of the body
+PHASES = ("queue", "dns", "connect", "ttfb", "body", "decode")
+# every 20th request is traced by default, enough for percentiles of phases without tracing every request
+DEFAULT_SAMPLE_RATE = 0.05
+
+
+async def _on_request_start(session, trace_config_ctx, params):
+    sample = trace_config_ctx.trace_request_ctx
+    if sample is not None:
+        sample["start"] = time.monotonic()
+
+
+def _mark(key):
+    async def hook(session, trace_config_ctx, params):
+        sample = trace_config_ctx.trace_request_ctx
+        if sample is not None:
+            sample[key] = time.monotonic()
+    return hook
+
+
+def timing_trace_config():
+    """
+    TraceConfig writing phase timestamps of sampled requests (requests with trace_request_ctx from
+    RequestTiming.sample()), requests not sampled cost only a check in every hook
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_queued_start.append(_mark("queue_start"))
+    trace_config.on_connection_queued_end.append(_mark("queue_end"))
+    trace_config.on_dns_resolvehost_start.append(_mark("dns_start"))
+    trace_config.on_dns_resolvehost_end.append(_mark("dns_end"))
+    trace_config.on_connection_create_start.append(_mark("connect_start"))
+    trace_config.on_connection_create_end.append(_mark("connect_end"))
+    trace_config.on_request_headers_sent.append(_mark("headers_sent"))
+    trace_config.on_request_end.append(_mark("response"))
+    return trace_config
+
+
+def _phase(sample, start_key, end_key):
+    if start_key in sample and end_key in sample:
+        return sample[end_key] - sample[start_key]
+    return None
+
+
+# Per phase latency of sampled requests of one target.
+# Caller passes sample() as trace_request_ctx of the request, marks body_read() and decoded() and
+# calls finish(). Histograms are kept since the start and since the last take()
+class RequestTiming:
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+        self._new_phases = {phase: LatencyHistogram() for phase in PHASES}
+
+    def sample(self):
+        """Returns dict collecting timestamps of the request if it is sampled, None otherwise"""
+        if self.sample_rate >= 1.0 or random.random() < self.sample_rate:
+            return {}
+        return None
+
+    @staticmethod
+    def body_read(sample):
+        if sample is not None:
+            sample["body_end"] = time.monotonic()
+
+    @staticmethod
+    def decoded(sample):
+        if sample is not None:
+            sample["decoded"] = time.monotonic()
+
+    def finish(self, sample):
+        if sample is None or "response" not in sample:
+            return
+        dns = _phase(sample, "dns_start", "dns_end")
+        connect = _phase(sample, "connect_start", "connect_end")
+        if connect is not None and dns is not None:
+            connect -= dns
+        durations = {
+            "queue": _phase(sample, "queue_start", "queue_end"),
+            "dns": dns,
+            "connect": connect,
+            "ttfb": _phase(sample, "headers_sent", "response"),
+            "body": _phase(sample, "response", "body_end"),
+            "decode": _phase(sample, "body_end", "decoded"),
+        }
+        for phase, duration in durations.items():
+            if duration is not None:
+                self.phases[phase].record(duration)
+                self._new_phases[phase].record(duration)
+
+    def merge(self, phases):
+        """Adds phase histograms (result of take() of other RequestTiming)"""
+        for phase, latency in phases.items():
+            self.phases[phase].merge(latency)
+            self._new_phases[phase].merge(latency)
+
+    def take(self):
+        """Phase histograms recorded since the last call"""
+        phases = self._new_phases
+        self._new_phases = {phase: LatencyHistogram() for phase in PHASES}
+        return phases
+
+
+def timing_summary(phases):
+    """Samples, p50 and p99 of every phase, for the status page"""
+    return [{
+        "phase": phase,
+        "samples": phases[phase].total,
+        "p50": phases[phase].percentile(50),
+        "p99": phases[phase].percentile(99),
+    } for phase in PHASES]
@@ -0,0 +1,131 @@
+import json
+import logging
+import time
+
+import aiohttp
+from batch_rpc_provider import BatchRpcException
+
+from latency_histogram import LatencyHistogram
+from request_timing import DEFAULT_SAMPLE_RATE, RequestTiming, timing_trace_config
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# JSON-RPC client keeping one keep-alive connection pool for the target between bursts
+# (BatchRpcProvider opens new session for every call).
+# New connections and their setup time (tcp connect + tls) are counted separately from request latency,
+# phases of sampled requests are recorded in timing
+class RpcClient:
+    def __init__(self, endpoint, pool_size=100, dns_cache_ttl=300, timing_sample_rate=DEFAULT_SAMPLE_RATE):
+        self._endpoint = endpoint
+        self.timing = RequestTiming(timing_sample_rate)
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connect_latency = LatencyHistogram()
+        # connect latency recorded since last take_connect_latency call
+        self._new_connect_latency = LatencyHistogram()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(self._on_connection_create_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(limit=pool_size, ttl_dns_cache=dns_cache_ttl)
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config, timing_trace_config()],
+                                              headers={"Accept": "application/json"})
+
+    async def _on_connection_create_start(self, session, trace_config_ctx, params):
+        trace_config_ctx.connect_start = time.monotonic()
+
+    async def _on_connection_create_end(self, session, trace_config_ctx, params):
+        connect_time = time.monotonic() - trace_config_ctx.connect_start
+        self.connections_created += 1
+        self.connect_latency.record(connect_time)
+        self._new_connect_latency.record(connect_time)
+
+    async def _on_connection_reuseconn(self, session, trace_config_ctx, params):
+        self.connections_reused += 1
+
+    def take_connect_latency(self):
+        latency = self._new_connect_latency
+        self._new_connect_latency = LatencyHistogram()
+        return latency
+
+    async def _post(self, call_data):
+        sample = self.timing.sample()
+        async with self._session.post(self._endpoint, data=json.dumps(call_data),
+                                      headers={"Content-Type": "application/json"},
+                                      trace_request_ctx=sample) as resp:
+            if resp.status == 413:
+                raise BatchRpcException("Data too big")
+            if resp.status != 200:
+                raise BatchRpcException(f"Other error {resp.status}")
+            content = await resp.read()
+        self.timing.body_read(sample)
+        rpc_resp = json.loads(content)
+        self.timing.decoded(sample)
+        self.timing.finish(sample)
+        return rpc_resp
+
+    async def call(self, method, params):
+        rpc_resp = await self._post({"jsonrpc": "2.0", "method": method, "params": params, "id": 1})
+        if "error" in rpc_resp:
+            raise BatchRpcException(f"RPC returned error: {rpc_resp['error']}")
+        return rpc_resp["result"]
+
+    async def batch_call(self, calls, return_errors=False):
+        """
+        Sends list of (method, params) as single json-rpc batch, returns results in the same order.
+        With return_errors json-rpc error of the call is returned as {"error": error} in place of its result
+        """
+        rpc_resp_array = await self._post([
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": rpc_id}
+            for rpc_id, (method, params) in enumerate(calls)
+        ])
+        if not isinstance(rpc_resp_array, list):
+            raise BatchRpcException(f"Batch request rejected: {rpc_resp_array.get('error', rpc_resp_array)}")
+        results = [None] * len(calls)
+        found = 0
+        for rpc_resp in rpc_resp_array:
+            if "error" in rpc_resp:
+                if not return_errors:
+                    raise BatchRpcException(f"RPC returned error: {rpc_resp['error']}")
+                results[rpc_resp["id"]] = {"error": rpc_resp["error"]}
+            else:
+                results[rpc_resp["id"]] = rpc_resp["result"]
+            found += 1
+        if found != len(calls):
+            raise BatchRpcException(f"Got {found} responses for {len(calls)} calls")
+        return results
+
+    async def get_block_by_number(self, block, full_info):
+        if type(block) == int:
+            block = hex(block)
+        return await self.call("eth_getBlockByNumber", [block, full_info])
+
+    async def close(self):
+        await self._session.close()
+
+
+# Long living RpcClient per target (and per instance of the target queried directly),
+# created on first use and closed on monitor shutdown
+class RpcClientPool:
+    def __init__(self, dns_cache_ttl=300):
+        self._dns_cache_ttl = dns_cache_ttl
+        self._clients = {}
+
+    def get(self, target, url=None):
+        """Client of the target url, or of other url of the target (instance behind its gateway)"""
+        url = url or target.target_url
+        client = self._clients.get((target.name, url))
+        if client is None:
+            client = RpcClient(url, target.pool_size, self._dns_cache_ttl, target.timing_sample_rate)
+            self._clients[(target.name, url)] = client
+        return client
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients = {}
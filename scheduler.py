@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# successful checks after failure still run at the fastest rate
+RECOVERY_CHECKS = 3
+# successful checks in a row after which the target is considered stable and checked less often
+STABLE_CHECKS = 10
+# interval of stable target grows by this factor with every next success, up to max_interval
+SLOWDOWN_FACTOR = 1.5
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    interval: float
+    check: object
+    max_concurrent: int
+    min_interval: float
+    max_interval: float
+    # fraction of the interval by which every tick is randomly moved
+    jitter: float
+    current_interval: float = 0.0
+    consecutive_successes: int = 0
+    recovering: bool = False
+    rescheduled: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def __post_init__(self):
+        self.current_interval = self.interval
+
+    def adapt(self, success):
+        """Chooses next interval from the check result (True, False or None if unknown)"""
+        if success is None:
+            return
+        previous_interval = self.current_interval
+        if not success:
+            self.consecutive_successes = 0
+            self.recovering = True
+            self.current_interval = self.min_interval
+        else:
+            self.consecutive_successes += 1
+            if self.recovering and self.consecutive_successes >= RECOVERY_CHECKS:
+                self.recovering = False
+                self.current_interval = self.interval
+            elif not self.recovering and self.consecutive_successes >= STABLE_CHECKS:
+                self.current_interval = min(max(self.current_interval, self.interval) * SLOWDOWN_FACTOR,
+                                            self.max_interval)
+        if self.current_interval != previous_interval:
+            logger.info(f"Check interval of target {self.name} changed to {self.current_interval:.1f}s")
+            if self.current_interval < previous_interval:
+                self.rescheduled.set()
+
+
+# Runs checks of all targets in one event loop.
+# Every target is ticked on fixed deadlines (start + n * interval) moved by random jitter, so the period does not
+# drift with the duration of checks and targets with the same interval do not fire together.
+# Ticks missed because the loop was blocked are skipped, not run late one after another. New check is started
+# on tick only if the target has less than max_concurrent checks still running, otherwise the tick is skipped.
+# Check returns True / False when it succeeds / fails: failing and recovering targets are checked every
+# min_interval, targets stable for a long time less and less often up to max_interval
+class Scheduler:
+    def __init__(self):
+        self._jobs = []
+
+    def add(self, name, interval, check, max_concurrent=1, min_interval=None, max_interval=None, jitter=0.0):
+        self._jobs.append(ScheduledJob(name, interval, check, max_concurrent,
+                                       min(min_interval or interval, interval),
+                                       max(max_interval or interval, interval), jitter))
+
+    async def run(self):
+        await asyncio.gather(*[self._run_job(job) for job in self._jobs])
+
+    @staticmethod
+    async def _run_check(job):
+        try:
+            success = await job.check()
+        except Exception as ex:
+            logger.error(f"Check of target {job.name} failed with unexpected exception: {ex}")
+            success = False
+        job.adapt(success)
+
+    async def _run_job(self, job):
+        running = set()
+        deadline = time.monotonic()
+        last_tick = deadline
+        while True:
+            fire_at = deadline + random.uniform(-job.jitter, job.jitter) * job.current_interval
+            job.rescheduled.clear()
+            delay = fire_at - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(job.rescheduled.wait(), delay)
+                    # interval got shorter, next deadline is counted from the last tick again
+                    deadline = min(deadline, last_tick + job.current_interval)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+
+            missed = int((time.monotonic() - deadline) // job.current_interval)
+            if missed > 0:
+                logger.warning(f"Skipping {missed} missed ticks of target {job.name}")
+                deadline += missed * job.current_interval
+            last_tick = deadline
+            deadline += job.current_interval
+
+            if len(running) < job.max_concurrent:
+                task = asyncio.create_task(self._run_check(job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            else:
+                logger.info(f"Skipping check of target {job.name}, {len(running)} checks still running")
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import time
+from array import array
+from dataclasses import dataclass, field
+
+from client_info import SETTLE_SECONDS
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+OBJECTIVES = ("error_rate", "latency", "block_age")
+SLO_OPTIONS = ("name", "target", "objective", "goal", "threshold", "burn_windows")
+# (long window, short window, burn rate), both windows have to burn faster than burn rate to fire:
+# 2% of 30 day budget in 1h, 5% in 6h
+DEFAULT_BURN_WINDOWS = [[3600, 300, 14.4], [21600, 1800, 6.0]]
+# every window is kept in this many sub buckets
+WINDOW_SLOTS = 60
+
+
+def _duration(seconds):
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+# Good and bad events of the last `length` seconds, kept in WINDOW_SLOTS sub buckets with running sums,
+# so adding a second, moving the window and reading its sums are O(1)
+class SlidingWindow:
+    def __init__(self, length, slots=WINDOW_SLOTS):
+        self.length = length
+        self._slot_length = max(length // slots, 1)
+        self._size = -(-length // self._slot_length)
+        self._good = array("Q", bytes(8 * self._size))
+        self._bad = array("Q", bytes(8 * self._size))
+        self._last_slot = None
+        self.good = 0
+        self.bad = 0
+
+    def advance(self, epoch_seconds):
+        """Drops sub buckets that are out of the window at given time"""
+        current_slot = epoch_seconds // self._slot_length
+        if self._last_slot is None:
+            self._last_slot = current_slot
+        # every sub bucket is dropped at most once, so this is constant per second on average
+        for slot in range(max(self._last_slot + 1, current_slot - self._size + 1), current_slot + 1):
+            idx = slot % self._size
+            self.good -= self._good[idx]
+            self.bad -= self._bad[idx]
+            self._good[idx] = 0
+            self._bad[idx] = 0
+        self._last_slot = max(self._last_slot, current_slot)
+
+    def add(self, epoch_seconds, good, bad):
+        self.advance(epoch_seconds)
+        idx = (epoch_seconds // self._slot_length) % self._size
+        self._good[idx] += good
+        self._bad[idx] += bad
+        self.good += good
+        self.bad += bad
+
+    def burn_rate(self, error_budget):
+        """How many times faster than allowed by the objective the error budget is spent"""
+        total = self.good + self.bad
+        if not total or error_budget <= 0:
+            return 0.0
+        return self.bad / total / error_budget
+
+
+# Service level objective of one target.
+# error_rate - checks that succeed, latency - requests (checks or baseload calls) faster than threshold ms,
+# block_age - seconds during which the latest block seen by the target is younger than threshold seconds
+@dataclass
+class SloRule:
+    name: str
+    target: str
+    objective: str
+    # fraction of good events, e.g. 0.99
+    goal: float
+    threshold: float = 0.0
+    burn_windows: list = field(default_factory=lambda: [list(windows) for windows in DEFAULT_BURN_WINDOWS])
+    firing: bool = False
+    windows: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.objective not in OBJECTIVES:
+            raise Exception(f"Unknown objective {self.objective} of slo {self.name}, possible values: {OBJECTIVES}")
+        for long_window, short_window, _ in self.burn_windows:
+            for length in (long_window, short_window):
+                if length not in self.windows:
+                    self.windows[length] = SlidingWindow(length)
+
+    @property
+    def error_budget(self):
+        return 1.0 - self.goal
+
+    def describe(self):
+        if self.objective == "latency":
+            return f"{self.goal * 100:g}% of requests of {self.target} under {self.threshold:g}ms"
+        if self.objective == "block_age":
+            return f"{self.goal * 100:g}% of time block of {self.target} younger than {self.threshold:g}s"
+        return f"{self.goal * 100:g}% of checks of {self.target} succeed"
+
+    def burning(self):
+        """Windows of the first burn condition that holds, None if none does"""
+        for long_window, short_window, burn_rate in self.burn_windows:
+            long_burn = self.windows[long_window].burn_rate(self.error_budget)
+            short_burn = self.windows[short_window].burn_rate(self.error_budget)
+            if long_burn >= burn_rate and short_burn >= burn_rate:
+                return long_window, short_window, burn_rate
+        return None
+
+    def summary(self):
+        return {
+            "name": self.name,
+            "target": self.target,
+            "objective": self.describe(),
+            "firing": self.firing,
+            "windows": [{
+                "window": _duration(length),
+                "good": window.good,
+                "bad": window.bad,
+                "burn_rate": window.burn_rate(self.error_budget),
+            } for length, window in sorted(self.windows.items())],
+        }
+
+
+def load_slos(path, target_names):
+    """
+    Loads slo rules from "slos" list of monitor config file:
+    {"slos": [{"name": "polygon_availability", "target": "polygon_baseload", "objective": "error_rate",
+               "goal": 0.99, "burn_windows": [[3600, 300, 14.4], [21600, 1800, 6]]}, ...]}
+    threshold (ms for latency, seconds for block_age) is needed by latency and block_age objectives.
+    Targets are not validated if target_names is None (collector learns them from probes)
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    rules = []
+    for entry in config.get("slos", []):
+        unknown = set(entry) - set(SLO_OPTIONS)
+        if unknown:
+            raise Exception(f"Unknown slo options {sorted(unknown)} for slo {entry.get('name')}")
+        rule = SloRule(**entry)
+        if target_names is not None and rule.target not in target_names:
+            raise Exception(f"Slo {rule.name} refers to unknown target {rule.target}")
+        if any(other.name == rule.name for other in rules):
+            raise Exception(f"Slo {rule.name} defined more than once in {path}")
+        rules.append(rule)
+    return rules
+
+
+# Evaluates slo rules once per second on the per second buckets of ClientInfo.
+# Every finished second is read from ClientInfo once and added to sliding windows of the rules,
+# burn rates are read from running sums of the windows, nothing is rescanned.
+# Only changes of rule state are routed to on_change(rule, message), every rule is a separate topic.
+# on_evaluate(rules) is called after every evaluation, e.g. to export burn rates
+class SloEngine:
+    def __init__(self, rules, on_change=None, on_evaluate=None):
+        self.rules = rules
+        self._on_change = on_change
+        self._on_evaluate = on_evaluate
+        self._next_second = None
+
+    def _events(self, rule, client_info, targets, second):
+        """Good and bad events of the rule in given second"""
+        if rule.objective == "block_age":
+            # age of the latest block seen keeps growing when checks stop reaching new blocks
+            block_timestamp = targets.get(rule.target, {}).get("block_timestamp")
+            if block_timestamp is None:
+                return 0, 0
+            return (1, 0) if second - block_timestamp <= rule.threshold else (0, 1)
+        time_series = client_info.time_buckets_seconds.get(rule.target)
+        bucket = time_series.find_bucket(second) if time_series else None
+        if bucket is None:
+            return 0, 0
+        if rule.objective == "latency":
+            latency = bucket.latency
+            bad = latency.count_above(rule.threshold / 1000.0)
+            return latency.total - bad, bad
+        return bucket.request_count, bucket.request_failed_count
+
+    def evaluate(self, client_info, targets, now):
+        """Adds seconds finished since the last call to windows of all rules, routes rules that changed state"""
+        last_second = now - SETTLE_SECONDS
+        if self._next_second is None or last_second - self._next_second > WINDOW_SLOTS * 2:
+            # start, or the loop was blocked for long, per second buckets of ClientInfo are short
+            self._next_second = last_second
+        while self._next_second <= last_second:
+            for rule in self.rules:
+                good, bad = self._events(rule, client_info, targets, self._next_second)
+                for window in rule.windows.values():
+                    window.add(self._next_second, good, bad)
+            self._next_second += 1
+
+        for rule in self.rules:
+            burning = rule.burning()
+            firing = burning is not None
+            if firing == rule.firing:
+                continue
+            rule.firing = firing
+            if firing:
+                long_window, short_window, burn_rate = burning
+                message = (f"SLO {rule.name} ({rule.describe()}) burns error budget "
+                           f"{rule.windows[long_window].burn_rate(rule.error_budget):.1f}x over "
+                           f"{_duration(long_window)} and "
+                           f"{rule.windows[short_window].burn_rate(rule.error_budget):.1f}x over "
+                           f"{_duration(short_window)} (alert at {burn_rate:g}x)")
+            else:
+                message = f"SLO {rule.name} ({rule.describe()}) no longer burns error budget too fast"
+            logger.debug(message)
+            if self._on_change:
+                self._on_change(rule, message)
+        if self._on_evaluate:
+            self._on_evaluate(self.rules)
+
+    def summary(self):
+        return [rule.summary() for rule in self.rules]
+
+    async def run(self, ctx):
+        while True:
+            now = time.time()
+            # right after the turn of the second
+            await asyncio.sleep(1.0 - now % 1.0 + 0.01)
+            if 'targets' in ctx:
+                self.evaluate(ctx['client_info'], ctx['targets'], int(time.time()))
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp_jinja2
+from aiohttp import web
+
+from client_info import HISTORY_SIZE
+
+HISTORY_VIEWS = [
+    ("time_buckets_seconds", "Seconds", "%Y-%m-%dT%H:%M:%S"),
+    ("time_buckets_minutes", "Minutes", "%Y-%m-%dT%H:%M:00"),
+    ("time_buckets_hours", "Hours", "%Y-%m-%dT%H:00:00"),
+    ("time_buckets_days", "Days", "%Y-%m-%dT00:00:00"),
+]
+
+# target state copied into snapshot, everything else in target context is internal
+TARGET_STATE_KEYS = ["last_result", "block_age", "block_timestamp", "burst_duration", "burst_throughput",
+                     "connections_created", "connections_reused", "connect_p50", "offered_rate", "achieved_rate",
+                     "heads", "timing", "consistency", "circuit"]
+
+
+def _timestamp(value):
+    return value.timestamp() if value else None
+
+
+def target_state(target_ctx):
+    """Fields of the target updated live, besides history: last result, block age and errors"""
+    return {
+        "last_result": target_ctx.get("last_result"),
+        "last_call": _timestamp(target_ctx.get("last_call")),
+        "last_success": _timestamp(target_ctx.get("last_success")),
+        "last_err_time": _timestamp(target_ctx.get("last_err_time")),
+        "last_err": str(target_ctx["last_err"]) if "last_err" in target_ctx else None,
+        "block_timestamp": target_ctx.get("block_timestamp"),
+        "circuit": target_ctx.get("circuit"),
+    }
+
+
+def history_row(bucket_start, el, time_format):
+    if el.request_count > 0 and el.request_failed_count:
+        class_name = "warning"
+    elif el.request_failed_count > 0:
+        class_name = "error"
+    elif el.request_count > 0:
+        class_name = "success"
+    else:
+        class_name = "warning"
+
+    return {
+        "time": datetime.fromtimestamp(bucket_start, timezone.utc).strftime(time_format),
+        "requests": el.request_count,
+        "failures": el.request_failed_count,
+        "p50": el.latency.percentile(50),
+        "p90": el.latency.percentile(90),
+        "p99": el.latency.percentile(99),
+        "max": el.latency.max_ms,
+        'class': class_name
+    }
+
+
+def _history(time_series, title, time_format, now):
+    hist = [history_row(bucket_start, el, time_format) for bucket_start, el in time_series.history(now)]
+    return {
+        "hist": hist,
+        "title": title
+    }
+
+
+def build_snapshot(ctx):
+    now = int(time.time())
+    client_info = ctx['client_info']
+    targets = []
+    for name, target_ctx in ctx['targets'].items():
+        target = target_ctx["target"]
+        history = []
+        if name in client_info.networks:
+            history = [_history(getattr(client_info, attribute)[name], title, time_format, now)
+                       for attribute, title, time_format in HISTORY_VIEWS]
+        state = {key: target_ctx[key] for key in TARGET_STATE_KEYS if key in target_ctx}
+        methods = [{
+            "method": method,
+            "succeeded": method_stats["succeeded"],
+            "failed": method_stats["failed"],
+            "p50": method_stats["latency"].percentile(50),
+            "p99": method_stats["latency"].percentile(99),
+            "failed_p99": method_stats["failed_latency"].percentile(99),
+        } for method, method_stats in sorted(target_ctx.get("methods", {}).items())]
+        slos = [rule.summary() for rule in ctx['slo'].rules if rule.target == name] if 'slo' in ctx else []
+        targets.append({
+            **state,
+            "name": target.name,
+            "work_mode": target.work_mode,
+            "last_call": _timestamp(target_ctx.get("last_call")),
+            "last_success": _timestamp(target_ctx.get("last_success")),
+            "last_err_time": _timestamp(target_ctx.get("last_err_time")),
+            "last_err": str(target_ctx["last_err"]) if "last_err" in target_ctx else None,
+            "methods": methods,
+            "slos": slos,
+            "history": history,
+        })
+    return {
+        "title": ctx['title'],
+        "generated": now,
+        "history_size": HISTORY_SIZE,
+        "targets": targets,
+    }
+
+
+# Status page and /api/status are served from one snapshot of the monitor state.
+# Snapshot, its json and rendered html are rebuilt only after invalidate() was called (new samples arrived),
+# so any number of viewers costs one rebuild per change. Clients revalidate with ETag / If-None-Match
+class StatusSnapshot:
+    def __init__(self):
+        # part of etag, so the etags from before restart are never matched
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._built_version = -1
+        self._snapshot = None
+        self._etag = None
+        self._json = None
+        self._html = None
+        # set on every change, cleared by its consumer (LiveUpdates)
+        self.changed = asyncio.Event()
+
+    def invalidate(self):
+        self._version += 1
+        self.changed.set()
+
+    def get(self, ctx):
+        if self._built_version != self._version:
+            self._snapshot = build_snapshot(ctx)
+            self._etag = f'"{self._instance_id}-{self._version}"'
+            self._json = None
+            self._html = None
+            self._built_version = self._version
+        return self._snapshot
+
+    def _not_modified(self, request):
+        if_none_match = request.headers.get("If-None-Match")
+        if not if_none_match:
+            return False
+        return if_none_match.strip() == "*" or self._etag in [tag.strip() for tag in if_none_match.split(",")]
+
+    def _response(self, request, body, content_type):
+        headers = {"ETag": self._etag, "Cache-Control": "no-cache"}
+        if self._not_modified(request):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=content_type, charset="utf-8", headers=headers)
+
+    def json_response(self, request, ctx):
+        snapshot = self.get(ctx)
+        if self._json is None:
+            self._json = json.dumps(snapshot).encode("utf-8")
+        return self._response(request, self._json, "application/json")
+
+    def html_response(self, request, ctx, template):
+        snapshot = self.get(ctx)
+        if self._html is None:
+            self._html = aiohttp_jinja2.render_string(template, request, snapshot).encode("utf-8")
+        return self._response(request, self._html, "text/html")
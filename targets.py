@@ -0,0 +1,89 @@
+import json
+from dataclasses import dataclass, fields
+
+WORK_MODES = ("health_check", "baseload_check", "openload_check", "consistency_check")
+
+
+# Single monitored endpoint with its own mode, interval and thresholds.
+# Every option not given in config file is taken from command line arguments (or their env defaults)
+@dataclass
+class Target:
+    name: str
+    work_mode: str
+    check_interval: float
+    # failing targets are checked every min_check_interval, stable ones slow down up to max_check_interval
+    # (0 - always check_interval)
+    min_check_interval: float
+    max_check_interval: float
+    check_jitter: float
+    # check still running after check_timeout is cancelled (0 - derived from the work of the check,
+    # at most 3 * check_interval + request_timeout), see check_deadline in monitor
+    check_timeout: float
+    max_concurrent_checks: int
+    # load checks failed in a row after which only single probe request is sent until the target responds
+    # (0 - never), see CircuitBreaker
+    breaker_failures: int
+    # fraction of requests with recorded phase timing
+    timing_sample_rate: float
+    # work mode health_check, consistency_check sends request_burst workload calls to every instance of endpoint
+    endpoint: str
+    expected_instances: int
+    probe_instances: bool
+    # heads of instances followed all the time, alert when one lags behind others
+    track_heads: bool
+    max_lag_blocks: int
+    max_lag_time: float
+    head_poll_interval: float
+    # work mode baseload_check
+    target_url: str
+    token_address: str
+    token_holder: str
+    request_burst: int
+    burst_concurrency: int
+    batch_size: int
+    request_timeout: float
+    pool_size: int
+    workload: str
+    # number of worker processes generating the load (1 - calls are sent by monitor process)
+    load_processes: int
+    # work mode openload_check, load window lasts check_interval
+    target_rps: float
+    arrival: str
+    max_outstanding: int
+    min_achieved_ratio: float
+
+
+TARGET_OPTIONS = [f.name for f in fields(Target) if f.name != "name"]
+
+
+def target_from_args(args, name=None, **overrides):
+    unknown = set(overrides) - set(TARGET_OPTIONS)
+    if unknown:
+        raise Exception(f"Unknown target options {sorted(unknown)} for target {name}")
+    values = {option: getattr(args, option) for option in TARGET_OPTIONS}
+    values.update(overrides)
+    target = Target(name=name or args.title, **values)
+    if target.work_mode not in WORK_MODES:
+        raise Exception(f"Unknown work mode {target.work_mode} for target {target.name}")
+    for option in ("batch_size", "burst_concurrency"):
+        if getattr(target, option) < 1:
+            raise Exception(f"Option {option} of target {target.name} has to be at least 1")
+    return target
+
+
+def load_targets(path, args):
+    """
+    Loads list of targets from json file in format:
+    {"targets": [{"name": "polygon_health", "work_mode": "health_check", "endpoint": "..."}, ...]}
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    targets = []
+    for entry in config["targets"]:
+        entry = dict(entry)
+        name = entry.pop("name")
+        if any(target.name == name for target in targets):
+            raise Exception(f"Target {name} defined more than once in {path}")
+        targets.append(target_from_args(args, name, **entry))
+    return targets
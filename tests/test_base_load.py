@@ -0,0 +1,58 @@
+import asyncio
+
+from base_load import merge_method_latency, send_open_loop
+from workload import Workload
+
+TOKEN = "0x2036807B0B3aaf5b1858EE822D0e111fDdac7018"
+HOLDER = "0xc596aee002ebe98345ce3f967631aaf79cfbdf41"
+
+
+# answers after delay, calls for which fail returns True raise
+class SlowClient:
+    def __init__(self, delay, fail=lambda: False):
+        self._delay = delay
+        self._fail = fail
+
+    async def call(self, method, params):
+        await asyncio.sleep(self._delay)
+        if self._fail():
+            raise Exception("node error")
+        return "0x1"
+
+
+def _open_loop(client, max_outstanding, request_timeout):
+    stats = {}
+    result = asyncio.run(send_open_loop(client, Workload.single_balance(TOKEN, HOLDER), 100, 0.3, "constant",
+                                        max_outstanding, request_timeout, stats))
+    return result, stats
+
+
+def test_timed_out_requests_are_measured():
+    (succeeded, failed, dropped, _, _), stats = _open_loop(SlowClient(0.2), 1000, 0.05)
+    failed_latency = merge_method_latency(stats, "failed_latency")
+    assert (succeeded, dropped) == (0, 0)
+    assert failed_latency.total == failed > 0
+    assert failed_latency.percentile(50) >= 50
+    assert merge_method_latency(stats).total == 0
+
+
+def test_failed_requests_are_measured_apart_from_answered():
+    calls = 0
+
+    def every_other():
+        nonlocal calls
+        calls += 1
+        return calls % 2 == 0
+
+    (succeeded, failed, _, _, _), stats = _open_loop(SlowClient(0.01, every_other), 1000, 1.0)
+    assert merge_method_latency(stats).total == succeeded > 0
+    assert merge_method_latency(stats, "failed_latency").total == failed > 0
+
+
+def test_not_sent_requests_count_with_request_timeout():
+    (_, failed, dropped, scheduled, _), stats = _open_loop(SlowClient(0.5), 2, 0.4)
+    failed_latency = merge_method_latency(stats, "failed_latency")
+    assert dropped == scheduled - 2
+    # requests in flight time out, the rest is not sent
+    assert failed_latency.total == failed + dropped == scheduled
+    assert failed_latency.percentile(1) >= 400 * 0.99
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+from circuit_breaker import CircuitBreaker
+from monitor import check_deadline
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker("polygon", failure_threshold=3)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    assert not breaker.record(True)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    assert breaker.record(False)
+    assert breaker.state == "open"
+
+
+def test_probe_closes_and_next_failure_opens_again():
+    breaker = CircuitBreaker("polygon", failure_threshold=2)
+    breaker.record(False)
+    breaker.record(False)
+    assert not breaker.record_probe(False)
+    assert breaker.state == "open"
+    assert breaker.record_probe(True)
+    assert breaker.state == "half_open"
+    # no waiting for failure_threshold after the circuit was just closed
+    assert breaker.record(False)
+    assert breaker.opened_count == 2
+
+
+def test_full_check_after_probe_closes_for_good():
+    breaker = CircuitBreaker("polygon", failure_threshold=2)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record_probe(True)
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert not breaker.record(False)
+
+
+def test_zero_threshold_never_opens():
+    breaker = CircuitBreaker("polygon", failure_threshold=0)
+    assert not any(breaker.record(False) for _ in range(100))
+    assert breaker.state == "closed"
+
+
+def _target(**options):
+    defaults = dict(check_timeout=0, work_mode="baseload_check", request_burst=500, batch_size=1,
+                    burst_concurrency=1, request_timeout=10.0, check_interval=10.0)
+    return SimpleNamespace(**{**defaults, **options})
+
+
+def test_check_deadline_follows_work_up_to_cap():
+    assert check_deadline(_target(request_burst=20, burst_concurrency=20)) == 20.0
+    # 500 rounds of requests would take up to 5010s, one hung check must not hold the target that long
+    assert check_deadline(_target()) == 40.0
+    assert check_deadline(_target(check_timeout=300)) == 300
+    assert check_deadline(_target(work_mode="openload_check")) == 30.0
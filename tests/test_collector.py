@@ -0,0 +1,75 @@
+import copy
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from client_info import ClientInfo, RequestType
+from collector import Collector, ProbePusher
+from latency_histogram import LatencyHistogram
+from metrics import Metrics
+from status_snapshot import StatusSnapshot
+
+
+def _collector_ctx():
+    metrics = Metrics()
+    metrics.register("rpc_monitor_checks_total", "counter", "")
+    metrics.register("rpc_monitor_request_latency_seconds", "histogram", "")
+    return {'client_info': ClientInfo(1, "key"), 'metrics': metrics, 'status': StatusSnapshot()}
+
+
+def _collector():
+    return Collector(lambda name, work_mode: SimpleNamespace(name=name, work_mode=work_mode))
+
+
+def _push(now, seconds=3):
+    client_info = ClientInfo(1, "key")
+    series = client_info.get_time_series(client_info.time_buckets_seconds, "polygon", 1)
+    latency = LatencyHistogram()
+    latency.record(0.02)
+    for second in range(now - seconds - 2, now - 2):
+        series.add(second, RequestType.Succeeded, latency)
+    ctx = {'client_info': client_info, 'targets': {
+        "polygon": {"target": SimpleNamespace(work_mode="baseload_check"), "last_result": "success",
+                    "block_timestamp": now - 5},
+    }}
+    data, _ = ProbePusher("http://collector", "eu").build_push(ctx, now)
+    return data
+
+
+def test_push_is_merged_per_region_and_target():
+    ctx = _collector_ctx()
+    _collector().merge(ctx, _push(int(time.time())))
+    assert ctx['client_info'].networks["eu/polygon"].request_count == 3
+    assert ctx['client_info'].networks["eu/polygon"].latency.total == 3
+    assert ctx['targets']["eu/polygon"]["last_result"] == "success"
+    assert ctx['targets']["eu/polygon"]["target"].work_mode == "baseload_check"
+
+
+def test_repeated_push_is_not_counted_twice():
+    ctx = _collector_ctx()
+    collector = _collector()
+    data = _push(int(time.time()))
+    collector.merge(ctx, data)
+    collector.merge(ctx, copy.deepcopy(data))
+    assert ctx['client_info'].networks["eu/polygon"].request_count == 3
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: data["targets"]["polygon"]["buckets"][1].__setitem__(1, "1"),
+    lambda data: data["targets"]["polygon"]["buckets"][2][4][2].append([10 ** 6, 1]),
+    lambda data: data["targets"]["polygon"].__setitem__("work_mode", "unknown"),
+    lambda data: data["targets"]["polygon"]["state"].__setitem__("target", "x"),
+    lambda data: data.__setitem__("seconds", [data["seconds"][1] + 1, data["seconds"][1]]),
+])
+def test_malformed_push_is_rejected_without_merging_anything(corrupt):
+    ctx = _collector_ctx()
+    collector = _collector()
+    data = _push(int(time.time()))
+    corrupt(data)
+    for _ in range(2):
+        with pytest.raises((KeyError, TypeError, ValueError)):
+            collector.merge(ctx, data)
+    assert "eu/polygon" not in ctx['client_info'].networks
+    assert "eu/polygon" not in ctx.get('targets', {})
+    assert "rpc_monitor_checks_total" not in ctx['metrics'].render()
@@ -0,0 +1,51 @@
+import asyncio
+
+from consistency_check import NO_DIGEST, compare_digests, find_fork_block, result_digest
+
+
+def test_result_digest_ignores_key_order():
+    assert result_digest({"a": 1, "b": [1, 2]}) == result_digest({"b": [1, 2], "a": 1})
+    assert result_digest({"a": 1}) != result_digest({"a": 2})
+
+
+def test_instances_that_agree_are_not_reported():
+    digests = {"i1": [result_digest(1), result_digest(2)], "i2": [result_digest(1), result_digest(2)]}
+    assert compare_digests(digests) == {"i1": [], "i2": []}
+
+
+def test_minority_is_reported_and_failed_queries_skipped():
+    one, two = result_digest(1), result_digest(2)
+    digests = {
+        "i1": [one, one, one],
+        "i2": [one, NO_DIGEST, one],
+        "i3": [two, one, one],
+    }
+    assert compare_digests(digests) == {"i1": [], "i2": [], "i3": [0]}
+
+
+def test_tied_vote_reports_every_instance():
+    one, two = result_digest(1), result_digest(2)
+    assert compare_digests({"i1": [one], "i2": [two]}) == {"i1": [0], "i2": [0]}
+
+
+# chain of block hashes, blocks from fork_at on have hashes of another chain
+class Chain:
+    def __init__(self, fork_at=None):
+        self._fork_at = fork_at
+        self.requests = 0
+
+    async def get_block_by_number(self, number, full):
+        self.requests += 1
+        fork = self._fork_at is not None and number >= self._fork_at
+        return {"hash": f"{'fork' if fork else 'main'}-{number}"}
+
+
+def test_find_fork_block_bisects_to_first_different_block():
+    client = Chain(fork_at=1234)
+    assert asyncio.run(find_fork_block(client, Chain(), 1000, 2000, 1)) == 1234
+    # bisection, not a scan
+    assert client.requests <= 12
+
+
+def test_find_fork_block_below_search_range():
+    assert asyncio.run(find_fork_block(Chain(fork_at=10), Chain(), 1000, 2000, 1)) is None
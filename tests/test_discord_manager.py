@@ -0,0 +1,35 @@
+import pytest
+
+from discord_manager import DiscordManager
+
+
+def _pending(manager, topic):
+    return manager._pending[topic], manager._merged_count.get(topic, 0)
+
+
+def test_burst_keeps_first_and_newest_messages():
+    manager = DiscordManager("http://webhook", max_messages_per_topic=3)
+    for idx in range(5):
+        manager._enqueue("polygon", f"message {idx}")
+    assert _pending(manager, "polygon") == (["message 0", "message 3", "message 4"], 2)
+
+
+def test_single_message_per_topic_keeps_the_newest():
+    manager = DiscordManager("http://webhook", max_messages_per_topic=1)
+    for idx in range(3):
+        manager._enqueue("polygon", f"message {idx}")
+    assert _pending(manager, "polygon") == (["message 2"], 2)
+    assert "3 notifications for polygon" in manager._format_digest("polygon", *_pending(manager, "polygon"))
+
+
+def test_flip_of_state_is_always_queued():
+    manager = DiscordManager("http://webhook")
+    manager.post_failure_message("polygon", "down")
+    manager.post_failure_message("polygon", "still down")
+    manager.post_success_message("polygon", "up")
+    assert _pending(manager, "polygon") == (["down", "up"], 0)
+
+
+def test_no_room_for_messages_is_rejected():
+    with pytest.raises(Exception, match="max_messages_per_topic"):
+        DiscordManager("http://webhook", max_messages_per_topic=0)
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from client_info import ClientInfo, RequestType
+from history_store import FILE_MAGIC, HistoryStore
+from latency_histogram import LatencyHistogram
+
+
+def _fill(client_info, count):
+    latency = LatencyHistogram()
+    latency.record(0.02)
+    for _ in range(count):
+        client_info.add_request("polygon", RequestType.Succeeded, latency)
+    client_info.add_request("polygon", RequestType.Failed)
+
+
+def _restored(path):
+    client_info = ClientInfo(1, "key")
+    HistoryStore(path, client_info).restore()
+    return client_info
+
+
+def test_flush_and_restore_round_trip(tmp_path):
+    path = str(tmp_path / "history.bin")
+    client_info = ClientInfo(1, "key")
+    _fill(client_info, 3)
+    asyncio.run(HistoryStore(path, client_info).flush())
+
+    now = int(time.time())
+    restored = _restored(path)
+    assert restored.export(now) == client_info.export(now)
+    assert restored.networks["polygon"].latency.total == 3
+
+
+def test_appended_records_win_over_older_ones(tmp_path):
+    path = str(tmp_path / "history.bin")
+    client_info = ClientInfo(1, "key")
+    store = HistoryStore(path, client_info)
+    _fill(client_info, 1)
+    asyncio.run(store.flush())
+    _fill(client_info, 2)
+    asyncio.run(store.flush())
+
+    assert _restored(path).networks["polygon"].request_count == 3
+
+
+def test_counters_above_32_bits(tmp_path):
+    path = str(tmp_path / "history.bin")
+    client_info = ClientInfo(1, "key")
+    _fill(client_info, 1)
+    client_info.networks["polygon"].request_count = 2 ** 40
+    asyncio.run(HistoryStore(path, client_info).flush())
+
+    assert _restored(path).networks["polygon"].request_count == 2 ** 40
+
+
+def test_compaction_rewrites_only_live_records(tmp_path):
+    path = str(tmp_path / "history.bin")
+    client_info = ClientInfo(1, "key")
+    store = HistoryStore(path, client_info, compact_ratio=1)
+    _fill(client_info, 1)
+    for _ in range(3):
+        asyncio.run(store.flush())
+        _fill(client_info, 1)
+    size_before = (tmp_path / "history.bin").stat().st_size
+    # restore schedules a rewrite on the next flush
+    restored_store = HistoryStore(path, client_info, compact_ratio=1)
+    restored_store.restore()
+    asyncio.run(restored_store.flush())
+
+    assert (tmp_path / "history.bin").stat().st_size < size_before
+    assert _restored(path).networks["polygon"].request_count == client_info.networks["polygon"].request_count
+
+
+def test_truncated_tail_is_ignored(tmp_path):
+    path = tmp_path / "history.bin"
+    client_info = ClientInfo(1, "key")
+    _fill(client_info, 2)
+    asyncio.run(HistoryStore(str(path), client_info).flush())
+    data = path.read_bytes()
+    path.write_bytes(data + data[len(FILE_MAGIC):len(FILE_MAGIC) + 7])
+
+    assert _restored(str(path)).networks["polygon"].request_count == 2
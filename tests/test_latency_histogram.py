@@ -0,0 +1,42 @@
+from latency_histogram import BUCKET_COUNT, LatencyHistogram, MAX_TRACKABLE_US, SUB_BUCKET_COUNT, bucket_index, \
+    bucket_range
+
+
+def test_bucket_range_round_trip():
+    for index in range(BUCKET_COUNT):
+        lowest, highest = bucket_range(index)
+        assert bucket_index(lowest) == index
+        assert bucket_index(highest) == index
+        if index + 1 < BUCKET_COUNT:
+            assert bucket_range(index + 1)[0] == highest + 1
+
+
+def test_relative_error_is_bounded():
+    for value in (17, 100, 999, 12345, 1_000_000, MAX_TRACKABLE_US):
+        lowest, highest = bucket_range(bucket_index(value))
+        assert lowest <= value <= highest
+        assert (highest - lowest) / value <= 1 / SUB_BUCKET_COUNT
+
+
+def test_values_above_limit_go_to_last_bucket():
+    assert bucket_index(MAX_TRACKABLE_US * 10) == BUCKET_COUNT - 1
+    assert bucket_index(-5) == 0
+
+
+def test_percentiles_and_count_above():
+    latency = LatencyHistogram()
+    for ms in range(1, 101):
+        latency.record(ms / 1000)
+    assert abs(latency.percentile(50) - 50) <= 50 / SUB_BUCKET_COUNT
+    assert latency.max_ms == 100
+    assert 45 <= latency.count_above(0.05) <= 50
+
+
+def test_merge_adds_counts():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    first.record(0.001)
+    second.record(0.2)
+    first.merge(second)
+    assert first.total == 2
+    assert first.max_us == 200000
+    assert LatencyHistogram().percentile(50) is None
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import scheduler
+from scheduler import ScheduledJob, Scheduler
+
+
+def _job(interval=10.0, min_interval=2.0, max_interval=60.0):
+    return ScheduledJob("polygon", interval, None, 1, min_interval, max_interval, 0.0)
+
+
+def test_failure_speeds_up_until_recovered():
+    job = _job()
+    job.adapt(False)
+    assert job.current_interval == 2.0
+    for _ in range(scheduler.RECOVERY_CHECKS - 1):
+        job.adapt(True)
+        assert job.current_interval == 2.0
+    job.adapt(True)
+    assert job.current_interval == 10.0
+
+
+def test_stable_target_slows_down_up_to_max_interval():
+    job = _job()
+    for _ in range(scheduler.STABLE_CHECKS - 1):
+        job.adapt(True)
+    assert job.current_interval == 10.0
+    job.adapt(True)
+    assert job.current_interval == 10.0 * scheduler.SLOWDOWN_FACTOR
+    for _ in range(20):
+        job.adapt(True)
+    assert job.current_interval == 60.0
+    # unknown result does not change anything
+    job.adapt(None)
+    assert job.current_interval == 60.0
+
+
+def _run_for(sched, seconds):
+    async def run():
+        try:
+            await asyncio.wait_for(sched.run(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(run())
+
+
+def test_ticks_do_not_drift_with_check_duration():
+    started = []
+
+    async def check():
+        started.append(time.monotonic())
+        await asyncio.sleep(0.03)
+        return True
+
+    sched = Scheduler()
+    sched.add("polygon", 0.05, check, max_concurrent=2)
+    _run_for(sched, 0.52)
+    assert 10 <= len(started) <= 11
+    # ticks stay on start + n * interval, duration of checks is not added to the period
+    assert abs((started[-1] - started[0]) - 0.05 * (len(started) - 1)) < 0.03
+
+
+def test_tick_is_skipped_while_max_concurrent_checks_run():
+    started = 0
+
+    async def check():
+        nonlocal started
+        started += 1
+        await asyncio.sleep(0.18)
+        return True
+
+    sched = Scheduler()
+    sched.add("polygon", 0.05, check, max_concurrent=1)
+    _run_for(sched, 0.5)
+    assert started == 3
+
+
+def test_exception_in_check_counts_as_failure():
+    async def check():
+        raise Exception("broken check")
+
+    sched = Scheduler()
+    sched.add("polygon", 0.05, check, min_interval=0.01)
+    _run_for(sched, 0.1)
+    assert sched._jobs[0].current_interval == 0.01
@@ -0,0 +1,49 @@
+from client_info import ClientInfo, RequestType
+from slo import SloEngine, SloRule, SlidingWindow
+
+NOW = 1_700_000_000
+
+
+def test_sliding_window_expires_old_events():
+    window = SlidingWindow(60, slots=6)
+    window.add(NOW, 5, 1)
+    window.add(NOW + 30, 2, 0)
+    assert (window.good, window.bad) == (7, 1)
+    # the first sub bucket leaves the window, the second one is still in it
+    window.advance(NOW + 65)
+    assert (window.good, window.bad) == (2, 0)
+    window.advance(NOW + 1000)
+    assert (window.good, window.bad) == (0, 0)
+
+
+def test_burn_rate():
+    window = SlidingWindow(60)
+    window.add(NOW, 90, 10)
+    # 10% errors with 1% error budget
+    assert abs(window.burn_rate(0.01) - 10) < 1e-9
+    assert SlidingWindow(60).burn_rate(0.01) == 0.0
+
+
+def test_rule_fires_only_when_both_windows_burn():
+    rule = SloRule("availability", "polygon", "error_rate", 0.9, burn_windows=[[60, 10, 2]])
+    for second in range(NOW, NOW + 60):
+        rule.windows[60].add(second, 1, 1 if second < NOW + 40 else 0)
+        rule.windows[10].add(second, 1, 1 if second < NOW + 40 else 0)
+    # long window burns, short one recovered
+    assert rule.burning() is None
+
+
+def test_engine_routes_state_changes_once():
+    client_info = ClientInfo(1, "key")
+    changes = []
+    rule = SloRule("availability", "polygon", "error_rate", 0.99, burn_windows=[[60, 10, 5]])
+    engine = SloEngine([rule], lambda changed, message: changes.append(changed.firing))
+    series = client_info.get_time_series(client_info.time_buckets_seconds, "polygon", 1)
+    for second in range(NOW, NOW + 5):
+        series.add(second, RequestType.Failed)
+        engine.evaluate(client_info, {}, second + 2)
+    assert changes == [True]
+    for second in range(NOW + 5, NOW + 80):
+        series.add(second, RequestType.Succeeded)
+        engine.evaluate(client_info, {}, second + 2)
+    assert changes == [True, False]
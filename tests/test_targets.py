@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+from monitor import parser
+from targets import load_targets, target_from_args
+
+
+def _load(tmp_path, entry):
+    path = tmp_path / "targets.json"
+    path.write_text(json.dumps({"targets": [{"name": "polygon", "work_mode": "baseload_check", **entry}]}))
+    return load_targets(str(path), parser.parse_args(["--no-discord"]))
+
+
+def test_target_options_override_arguments(tmp_path):
+    target, = _load(tmp_path, {"batch_size": 10, "burst_concurrency": 4})
+    assert (target.batch_size, target.burst_concurrency) == (10, 4)
+
+
+@pytest.mark.parametrize("option", ["batch_size", "burst_concurrency"])
+def test_burst_options_below_one_are_rejected(tmp_path, option):
+    with pytest.raises(Exception, match=option):
+        _load(tmp_path, {option: 0})
+    with pytest.raises(Exception, match=option):
+        target_from_args(parser.parse_args(["--no-discord"]), "polygon", **{option: -1})
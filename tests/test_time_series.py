@@ -0,0 +1,77 @@
+import pytest
+
+from client_info import ClientInfo, RequestType, TimeSeries
+from latency_histogram import LatencyHistogram
+
+NOW = 1_700_000_000
+
+
+def _latency(seconds):
+    latency = LatencyHistogram()
+    latency.record(seconds)
+    return latency
+
+
+def test_bucket_is_reused_when_its_slot_comes_around():
+    series = TimeSeries(60, size=4)
+    series.add(NOW, RequestType.Succeeded)
+    series.add(NOW, RequestType.Failed)
+    # four slots later the same index holds the new slot, old counts are gone
+    later = NOW + 4 * 60
+    series.add(later, RequestType.Succeeded)
+    assert series.find_bucket(NOW) is None
+    bucket = series.find_bucket(later)
+    assert (bucket.request_count, bucket.request_failed_count) == (1, 0)
+
+
+def test_history_skips_evicted_and_empty_slots():
+    series = TimeSeries(1, size=5)
+    for second in (NOW, NOW + 1, NOW + 3):
+        series.add(second, RequestType.Succeeded)
+    assert [start for start, _ in series.history(NOW + 3)] == [NOW + 3, NOW + 1, NOW]
+    # NOW falls out of the window of 5 seconds
+    assert [start for start, _ in series.history(NOW + 5)] == [NOW + 3, NOW + 1]
+
+
+def test_export_is_oldest_first():
+    series = TimeSeries(1, size=3)
+    series.add(NOW + 1, RequestType.Backup)
+    series.add(NOW, RequestType.Succeeded)
+    assert series.export(NOW + 1) == [[NOW, 1, 0, 0], [NOW + 1, 0, 0, 1]]
+
+
+def test_latency_is_reset_with_reused_bucket():
+    series = TimeSeries(1, size=2)
+    latency = LatencyHistogram()
+    latency.record(0.01)
+    series.add(NOW, RequestType.Succeeded, latency)
+    assert series.find_bucket(NOW).latency.total == 1
+    series.add(NOW + 2, RequestType.Succeeded)
+    assert series.find_bucket(NOW + 2).latency.total == 0
+
+
+def test_late_merge_does_not_overwrite_newer_bucket():
+    series = TimeSeries(1, size=4)
+    series.add(NOW + 4, RequestType.Succeeded)
+    # NOW uses the same index, it is older than the bucket stored there
+    series.merge(NOW, 10, 0, 0)
+    assert series.find_bucket(NOW + 4).request_count == 1
+    assert series.find_bucket(NOW) is None
+
+
+def test_client_info_merge_updates_totals_and_all_resolutions():
+    client_info = ClientInfo(1, "key")
+    client_info.merge("eu/polygon", NOW, 3, 1, 0)
+    assert client_info.networks["eu/polygon"].request_count == 3
+    assert client_info.time_buckets_days["eu/polygon"].find_bucket(NOW).request_failed_count == 1
+    assert client_info.merged_since == NOW
+
+
+def test_latency_of_empty_bucket_is_read_only():
+    series = TimeSeries(1, size=2)
+    series.add(NOW, RequestType.Succeeded)
+    bucket = series.find_bucket(NOW)
+    with pytest.raises(TypeError):
+        bucket.latency.record(0.01)
+    series.add_latency(NOW, _latency(0.01))
+    assert bucket.latency.total == 1
@@ -0,0 +1,136 @@
+import json
+import random
+from itertools import accumulate
+
+from batch_rpc_provider import BatchRpcException
+
+ERC20_BALANCE_OF = "70a08231000000000000000000000000"
+ERC20_TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+WORKLOAD_METHODS = (
+    "eth_getBalance",
+    "erc20_balanceOf",
+    "eth_getLogs",
+    "eth_getBlockByNumber",
+    "eth_getTransactionReceipt",
+    "eth_gasPrice",
+)
+
+# holders and transaction hashes harvested from responses are kept up to this size
+MAX_POOL_SIZE = 10000
+
+
+# Weighted mix of rpc calls sent by baseload.
+# With block_range set every call asks about random block from last block_range blocks and random holder,
+# so node caches are not hit. Holders and transaction hashes are harvested from eth_getLogs and
+# eth_getBlockByNumber responses, so receipts and balances are asked for real, varied data
+class Workload:
+    def __init__(self, weights, token_address, holders, block_range=0, logs_block_span=100, seed=None):
+        unknown = set(weights) - set(WORKLOAD_METHODS)
+        if unknown:
+            raise Exception(f"Unknown workload methods {sorted(unknown)}, possible values: {WORKLOAD_METHODS}")
+        self._methods = [method for method, weight in weights.items() if weight > 0]
+        self._cum_weights = list(accumulate(weights[method] for method in self._methods))
+        if not self._methods:
+            raise Exception("Workload needs at least one method with positive weight")
+        self._token_address = token_address
+        self._holders = list(holders)
+        self._tx_hashes = []
+        self._block_range = block_range
+        self._logs_block_span = logs_block_span
+        self._random = random.Random(seed)
+        self._latest_block = 0
+
+    @staticmethod
+    def single_balance(token_address, token_holder):
+        """Legacy baseload: one holder balance at latest - 10 block"""
+        return Workload({"erc20_balanceOf": 1}, token_address, [token_holder])
+
+    def reseed(self, seed):
+        """Copies of workload running in parallel should not send the same sequence of calls"""
+        self._random.seed(seed)
+
+    def set_latest_block(self, block_number):
+        self._latest_block = block_number
+
+    def _block_number(self):
+        newest = max(self._latest_block - 10, 0)
+        if not self._block_range:
+            return newest
+        return self._random.randint(max(newest - self._block_range, 0), newest)
+
+    def _add_to_pool(self, pool, value):
+        if len(pool) < MAX_POOL_SIZE:
+            pool.append(value)
+        else:
+            pool[self._random.randrange(MAX_POOL_SIZE)] = value
+
+    def next_call(self):
+        """Returns (method label, rpc method, params) of the next call"""
+        method = self._random.choices(self._methods, cum_weights=self._cum_weights)[0]
+        if method == "eth_getTransactionReceipt" and not self._tx_hashes:
+            # nothing harvested yet, blocks contain transaction hashes
+            method = "eth_getBlockByNumber"
+        block = hex(self._block_number())
+
+        if method == "eth_getBalance":
+            return method, "eth_getBalance", [self._random.choice(self._holders), block]
+        if method == "erc20_balanceOf":
+            holder = self._random.choice(self._holders).replace("0x", "")
+            return method, "eth_call", [{"to": self._token_address, "data": f"0x{ERC20_BALANCE_OF}{holder}"}, block]
+        if method == "eth_getLogs":
+            to_block = self._block_number()
+            return method, "eth_getLogs", [{
+                "address": self._token_address,
+                "topics": [ERC20_TRANSFER_TOPIC],
+                "fromBlock": hex(max(to_block - self._logs_block_span + 1, 0)),
+                "toBlock": hex(to_block),
+            }]
+        if method == "eth_getBlockByNumber":
+            return method, "eth_getBlockByNumber", [block, False]
+        if method == "eth_getTransactionReceipt":
+            return method, "eth_getTransactionReceipt", [self._random.choice(self._tx_hashes)]
+        return method, "eth_gasPrice", []
+
+    def observe(self, method, result):
+        """Validates result of the call and harvests holders and transaction hashes from it"""
+        if method == "erc20_balanceOf":
+            if result == "0x":
+                raise BatchRpcException("Unknown value 0x")
+        elif method == "eth_getBlockByNumber":
+            if result is None:
+                raise BatchRpcException("Block not found")
+            for tx_hash in result.get("transactions", [])[:10]:
+                self._add_to_pool(self._tx_hashes, tx_hash)
+        elif method == "eth_getLogs":
+            for log in result[:10]:
+                self._add_to_pool(self._tx_hashes, log["transactionHash"])
+                for topic in log["topics"][1:3]:
+                    self._add_to_pool(self._holders, "0x" + topic[-40:])
+
+
+def load_workload(path, token_address, token_holder):
+    """
+    Loads workload from json file in format:
+    {
+        "methods": {"eth_getBalance": 2, "erc20_balanceOf": 5, "eth_getLogs": 1, ...},
+        "token_address": "0x...",         (optional, --token-address by default)
+        "holders": ["0x...", ...],        (optional, --token-holder is always included)
+        "holders_file": "holders.txt",    (optional, one address per line)
+        "block_range": 10000,             (optional, 0 - always query latest - 10 block)
+        "logs_block_span": 100            (optional, number of blocks in single eth_getLogs)
+    }
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    holders = [token_holder] + config.get("holders", [])
+    if "holders_file" in config:
+        with open(config["holders_file"]) as f:
+            holders += [line.strip() for line in f if line.strip()]
+
+    return Workload(config["methods"],
+                    config.get("token_address", token_address),
+                    holders,
+                    config.get("block_range", 0),
+                    config.get("logs_block_span", 100))